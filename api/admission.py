@@ -0,0 +1,306 @@
+import asyncio
+import contextvars
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+import metrics
+
+# Admission control for the work that actually costs something: LLM calls,
+# model forwards and batch scans (cache hits and coalesced duplicates never get
+# here). Each route class runs at most CONCURRENCY of them at once and up to
+# QUEUE more wait in line. A request that can no longer finish within DEADLINE
+# seconds of arriving (Vercel gives up after 10 s), judging by the class's
+# recent service time, is turned away at once with 503 + Retry-After instead
+# of timing out along with everyone behind it. Each client also has a token
+# bucket (CLIENT_RATE admissions/s, bursts of CLIENT_BURST); past it, 429.
+LIMITS = {
+    # class: (concurrency, queue, deadline seconds; 0 = no deadline)
+    "chat": (int(os.getenv("ADMIT_CHAT_CONCURRENCY", "32")), int(os.getenv("ADMIT_CHAT_QUEUE", "64")),
+             float(os.getenv("ADMIT_CHAT_DEADLINE_SECONDS", "10"))),
+    "predict": (int(os.getenv("ADMIT_PREDICT_CONCURRENCY", "64")), int(os.getenv("ADMIT_PREDICT_QUEUE", "256")),
+                float(os.getenv("ADMIT_PREDICT_DEADLINE_SECONDS", "10"))),
+    # Batch scans stream for as long as they need, so they only get slots
+    "batch": (int(os.getenv("ADMIT_BATCH_CONCURRENCY", "2")), int(os.getenv("ADMIT_BATCH_QUEUE", "4")), 0.0),
+}
+CLIENT_RATE = float(os.getenv("ADMIT_CLIENT_RATE", "2"))   # 0 disables per-client limits
+CLIENT_BURST = float(os.getenv("ADMIT_CLIENT_BURST", "20"))
+MAX_CLIENTS = 10_000
+# Proxies in front of the app that append the address they received from to
+# X-Forwarded-For. The default, 1, is the Vercel deployment; without it every
+# caller would share the proxy's bucket. The client is the entry the outermost
+# of them appended; entries to its left come from the caller and can be forged.
+# Requests without the header use the socket peer. Set 0 when serving directly,
+# or callers can pick their own client id.
+TRUSTED_PROXIES = int(os.getenv("ADMIT_TRUSTED_PROXIES", "1"))
+
+SERVICE_EWMA = 0.2   # Weight of the newest request in the service-time estimate
+
+_request = contextvars.ContextVar("potato_admission", default=None)
+
+
+class Rejected(Exception):
+    """Raised instead of admitting; main.py answers it with `status` and a Retry-After header."""
+
+    def __init__(self, status, reason, retry_after, detail):
+        super().__init__(detail)
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+        self.detail = detail
+
+
+class Waiter:
+    """A queued request. Its outcome (True or a Rejected) is decided under the limiter's lock."""
+
+    def __init__(self, deadline_at):
+        self.deadline_at = deadline_at
+        self.loop = asyncio.get_running_loop()
+        self.future = self.loop.create_future()
+        self.outcome = None
+
+    def settle(self, outcome):
+        self.outcome = outcome
+        self.loop.call_soon_threadsafe(_wake_future, self.future)
+
+
+def _wake_future(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class RouteLimiter:
+    """Concurrency slots plus a bounded FIFO of waiters that still have time to finish."""
+
+    def __init__(self, name, concurrency, queue_size, deadline):
+        self.name = name
+        self.concurrency = max(1, concurrency)
+        self.queue_size = max(0, queue_size)
+        self.deadline = deadline
+        self.active = 0
+        self.waiters = deque()     # Waiter, oldest first
+        self.service = None        # EWMA of seconds a slot is held
+        self.lock = threading.Lock()
+        self.counts = {"admitted": 0, "queue_full": 0, "deadline": 0}
+
+    def _expected(self):
+        return self.service or 0.0
+
+    def retry_after(self):
+        """Seconds until the current backlog should have drained, rounded up (at least 1)."""
+        backlog = (self.active + len(self.waiters)) / self.concurrency * self._expected()
+        return max(1, math.ceil(backlog))
+
+    def _reject(self, reason, detail):
+        self.counts[reason] += 1
+        return Rejected(503, reason, self.retry_after(), detail)
+
+    async def acquire(self, arrived):
+        """Wait for a slot; raises Rejected when the queue is full or the deadline can no longer be met."""
+        deadline_at = arrived + self.deadline if self.deadline else math.inf
+        with self.lock:
+            if self.active < self.concurrency and not self.waiters:
+                self.active += 1
+                self.counts["admitted"] += 1
+                return
+            if len(self.waiters) >= self.queue_size:
+                raise self._reject("queue_full", f"Too many {self.name} requests queued")
+            # Expected start: once the requests ahead of this one have been served
+            start_at = time.monotonic() + (len(self.waiters) + 1) / self.concurrency * self._expected()
+            if start_at + self._expected() > deadline_at:
+                raise self._reject("deadline", f"{self.name} requests are taking too long to get through")
+            waiter = Waiter(deadline_at)
+            self.waiters.append(waiter)
+
+        timeout = None if deadline_at == math.inf else max(0.0, deadline_at - self._expected() - time.monotonic())
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            with self.lock:
+                outcome = waiter.outcome
+                if outcome is None:
+                    waiter.outcome = False
+                    self.waiters.remove(waiter)
+                    if isinstance(e, asyncio.TimeoutError):
+                        raise self._reject("deadline", f"{self.name} request could not start in time")
+            if isinstance(outcome, Rejected):
+                raise outcome
+            if isinstance(e, asyncio.TimeoutError):
+                return   # Granted a slot just as the wait timed out: keep it
+            self.release(None)   # Cancelled right after being granted a slot: pass it on
+            raise
+        if waiter.outcome is not True:
+            raise waiter.outcome
+
+    def release(self, held):
+        """Free a slot held for `held` seconds (None: never used) and pass it on."""
+        with self.lock:
+            if held is not None:
+                self.service = held if self.service is None else \
+                    (1 - SERVICE_EWMA) * self.service + SERVICE_EWMA * held
+            self.active -= 1
+            self._wake()
+
+    def _wake(self):
+        """Hand free slots to the oldest waiters that can still finish in time (called with the lock held)."""
+        now = time.monotonic()
+        while self.waiters and self.active < self.concurrency:
+            waiter = self.waiters.popleft()
+            if now + self._expected() > waiter.deadline_at:
+                self.counts["deadline"] += 1
+                waiter.settle(Rejected(503, "deadline", self.retry_after(),
+                                       f"{self.name} request could not start in time"))
+                continue
+            self.active += 1
+            self.counts["admitted"] += 1
+            waiter.settle(True)
+
+    def stats(self):
+        with self.lock:
+            return {"concurrency": self.concurrency, "queue_size": self.queue_size, "deadline_seconds": self.deadline,
+                    "active": self.active, "queued": len(self.waiters),
+                    "service_seconds": round(self.service, 4) if self.service is not None else None,
+                    **self.counts}
+
+
+class TokenBuckets:
+    """Per-client token buckets; the least recently seen clients are forgotten past max_clients."""
+
+    def __init__(self, rate=CLIENT_RATE, burst=CLIENT_BURST, max_clients=MAX_CLIENTS):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.buckets = OrderedDict()   # client -> [tokens, last refill]
+        self.lock = threading.Lock()
+        self.limited = 0
+
+    def take(self, client):
+        """0 if the client may go ahead, else the seconds until its next token."""
+        if self.rate <= 0:
+            return 0
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.pop(client, None) or [self.burst, now]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            self.buckets[client] = bucket
+            while len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0
+            self.limited += 1
+            return (1 - bucket[0]) / self.rate
+
+
+limiters = {name: RouteLimiter(name, *limit) for name, limit in LIMITS.items()}
+buckets = TokenBuckets()
+
+
+class Slot:
+    def __init__(self, limiter):
+        self.limiter = limiter
+        self.start = time.monotonic()
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.limiter.release(time.monotonic() - self.start)
+
+
+class RequestState:
+    def __init__(self, client):
+        self.client = client
+        self.arrived = time.monotonic()
+        self.held = []
+
+
+async def _acquire(route_class):
+    state = _request.get()
+    if state is None:
+        return None   # Not inside an HTTP request (scripts, direct calls)
+    wait = buckets.take(state.client)
+    if wait:
+        raise Rejected(429, "rate_limited", max(1, math.ceil(wait)), "Too many requests from this client")
+    limiter = limiters[route_class]
+    queued = time.monotonic()
+    await limiter.acquire(state.arrived)   # The deadline still counts from arrival
+    metrics.observe_stage("admission_wait", time.monotonic() - queued)
+    return Slot(limiter)
+
+
+@asynccontextmanager
+async def slot(route_class):
+    """Hold a `route_class` slot for the duration of the block."""
+    held = await _acquire(route_class)
+    try:
+        yield
+    finally:
+        if held is not None:
+            held.release()
+
+
+async def hold(route_class):
+    """Take a `route_class` slot that is kept until the response has been sent (streamed responses)."""
+    held = await _acquire(route_class)
+    if held is not None:
+        _request.get().held.append(held)
+
+
+def client_id(scope, trusted_proxies=None):
+    trusted_proxies = TRUSTED_PROXIES if trusted_proxies is None else trusted_proxies
+    if trusted_proxies > 0:
+        hops = [hop.strip() for name, value in scope.get("headers", []) if name == b"x-forwarded-for"
+                for hop in value.decode("latin-1").split(",") if hop.strip()]
+        if hops:
+            return hops[max(0, len(hops) - trusted_proxies)]
+    client = scope.get("client")
+    return client[0] if client else "unknown"
+
+
+class AdmissionMiddleware:
+    """ASGI middleware giving each request its client and arrival time, and freeing its slots once answered."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        state = RequestState(client_id(scope))
+        token = _request.set(state)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _request.reset(token)
+            for held in state.held:
+                held.release()
+
+
+def stats():
+    return {"classes": {name: limiter.stats() for name, limiter in limiters.items()},
+            "rate_limited": buckets.limited, "client_rate": buckets.rate, "client_burst": buckets.burst}
+
+
+def metric_lines():
+    current = stats()
+    lines = metrics.counter_lines("potato_admission_rate_limited_total",
+                                  "Requests refused by the per-client token bucket.", current["rate_limited"])
+    for name, kind, help_text in (("admitted", "counter", "Requests admitted"),
+                                  ("queue_full", "counter", "Requests shed because the queue was full"),
+                                  ("deadline", "counter", "Requests shed because they could not finish in time"),
+                                  ("active", "gauge", "Requests holding a slot"),
+                                  ("queued", "gauge", "Requests waiting for a slot")):
+        metric = f"potato_admission_{name}" + ("_total" if kind == "counter" else "")
+        lines += [f"# HELP {metric} {help_text}, per route class.", f"# TYPE {metric} {kind}"]
+        lines += [f'{metric}{{route="{route}"}} {route_stats[name]}'
+                  for route, route_stats in sorted(current["classes"].items())]
+    return lines
+
+metrics.register_collector(metric_lines)
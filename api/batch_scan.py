@@ -0,0 +1,235 @@
+import asyncio
+import functools
+import json
+import os
+import posixpath
+import zipfile
+
+from starlette.concurrency import run_in_threadpool
+
+from heatmaps import has_heatmap
+from prediction_cache import content_key, dhash
+
+# Images per model forward, and how many uploads are decoded at the same time.
+# While one batch runs through the model the next one is decoded, so at most
+# two batches of raw bytes and tensors are held in memory per scan.
+BATCH_SIZE = int(os.getenv("BATCH_SCAN_BATCH_SIZE", "16"))
+DECODE_WORKERS = int(os.getenv("BATCH_SCAN_DECODE_WORKERS", "4"))
+MAX_IMAGES = int(os.getenv("BATCH_SCAN_MAX_IMAGES", "1000"))
+MAX_IMAGE_BYTES = int(os.getenv("BATCH_SCAN_MAX_IMAGE_BYTES", str(20 * 1024 * 1024)))
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".webp", ".tif", ".tiff"}
+DEFAULT_PLOT = "default"
+
+
+class ScanItem:
+    """One image of a scan; `read` returns its bytes and may block (spooled upload or zip member)."""
+
+    def __init__(self, index, filename, plot, read, size=None):
+        self.index = index
+        self.filename = filename
+        self.plot = plot
+        self.read = read
+        self.size = size
+
+
+def is_zip(upload):
+    return (upload.content_type in ("application/zip", "application/x-zip-compressed")
+            or (upload.filename or "").lower().endswith(".zip"))
+
+
+def _zip_members(upload, plot):
+    """Image members of an uploaded zip; a member's top-level folder names its plot."""
+    archive = zipfile.ZipFile(upload.file)
+    for info in archive.infolist():
+        name = info.filename
+        if info.is_dir() or name.startswith("__MACOSX/") or posixpath.basename(name).startswith("."):
+            continue
+        if posixpath.splitext(name)[1].lower() not in IMAGE_EXTENSIONS:
+            continue
+        folder = name.split("/", 1)[0] if "/" in name else None
+        yield name, plot or folder or DEFAULT_PLOT, (lambda info=info: archive.read(info)), info.file_size
+
+
+def iter_items(uploads, plot=None):
+    """Flatten uploaded images and zips into ScanItems without reading any image data.
+
+    Raises ValueError once more than MAX_IMAGES images are found.
+    """
+    index = 0
+    for upload in uploads:
+        if is_zip(upload):
+            members = _zip_members(upload, plot)
+        else:
+            members = [(upload.filename, plot or DEFAULT_PLOT, upload.file.read, upload.size)]
+        for filename, item_plot, read, size in members:
+            if index >= MAX_IMAGES:
+                raise ValueError(f"A scan is limited to {MAX_IMAGES} images")
+            yield ScanItem(index, filename, item_plot, read, size)
+            index += 1
+
+
+class PlotSummary:
+    """Running per-plot aggregate of the severity results."""
+
+    def __init__(self, plot):
+        self.plot = plot
+        self.images = 0
+        self.errors = 0
+        self.classes = {}
+        self.severity_sum = 0.0
+        self.severity_max = 0.0
+        self.severity_count = 0   # Cascade answers from the fast model carry no severity
+        self.diseased = 0
+
+    def add(self, result):
+        self.images += 1
+        self.classes[result["class"]] = self.classes.get(result["class"], 0) + 1
+        if result["severity"] is not None:
+            self.severity_sum += result["severity"]
+            self.severity_max = max(self.severity_max, result["severity"])
+            self.severity_count += 1
+        if result["class"] != "Healthy":
+            self.diseased += 1
+
+    def as_dict(self):
+        return {
+            "type": "summary",
+            "plot": self.plot,
+            "images": self.images,
+            "errors": self.errors,
+            "classes": self.classes,
+            "mean_severity": round(self.severity_sum / self.severity_count, 4) if self.severity_count else None,
+            "max_severity": round(self.severity_max, 4),
+            "diseased_fraction": round(self.diseased / self.images, 4) if self.images else None,
+        }
+
+
+class Prepared:
+    """An item ready for the model (tensor), already answered by the cache (result), or failed (error)."""
+
+    def __init__(self, item, sha=None, phash=None, tensor=None, result=None, cache="miss", error=None):
+        self.item = item
+        self.sha = sha
+        self.phash = phash
+        self.tensor = tensor
+        self.result = result
+        self.cache = cache
+        self.error = error
+
+
+def _prepare(predictor, item, cache, heatmaps=False):
+    if item.size is not None and item.size > MAX_IMAGE_BYTES:
+        raise ValueError(f"Image is larger than {MAX_IMAGE_BYTES} bytes")
+    data = item.read()
+    if cache is None:
+        return Prepared(item, tensor=predictor.preprocess(predictor.decode(data)))
+
+    accept = has_heatmap if heatmaps else None
+    sha = content_key(data)
+    result = cache.get(sha, accept)
+    if result is not None:
+        return Prepared(item, sha, result=result, cache="hit")
+    image = predictor.decode(data)
+    phash = dhash(image) if cache.near_enabled else None
+    result = cache.get_near(phash, accept)
+    if result is not None:
+        cache.put(sha, result, phash)
+        return Prepared(item, sha, phash, result=result, cache="near-hit")
+    cache.record_miss()
+    return Prepared(item, sha, phash, tensor=predictor.preprocess(image))
+
+
+async def _prepare_batch(predictor, items, limit, cache, heatmaps):
+    """Decode and preprocess a batch in parallel, answering what it can from the cache."""
+    async def one(item):
+        async with limit:
+            try:
+                return await run_in_threadpool(_prepare, predictor, item, cache, heatmaps)
+            except Exception as e:
+                return Prepared(item, error=e)
+
+    return await asyncio.gather(*(one(item) for item in items))
+
+
+def _chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+async def scan(predictor, items, batch_size=BATCH_SIZE, decode_workers=DECODE_WORKERS, on_batch=None, cache=None,
+               heatmaps=False):
+    """Yield one result dict per image as its batch finishes, then one summary per plot.
+
+    Batch N+1 is decoded while batch N runs through the model. `on_batch` is
+    called with (batch_size, seconds) after every forward. With a
+    PredictionCache, cached images skip the model and new results are stored.
+    With heatmaps=True every result carries its CAM heatmap.
+    """
+    fingerprint = getattr(predictor, "fingerprint", None)
+    predict_batch = functools.partial(predictor.predict_batch, heatmaps=True) if heatmaps else predictor.predict_batch
+    limit = asyncio.Semaphore(max(1, decode_workers))
+    loop = asyncio.get_running_loop()
+    summaries = {}
+    chunks = _chunks(items, max(1, batch_size))
+
+    def summary(plot):
+        if plot not in summaries:
+            summaries[plot] = PlotSummary(plot)
+        return summaries[plot]
+
+    def next_batch():
+        chunk = next(chunks, None)
+        return asyncio.ensure_future(_prepare_batch(predictor, chunk, limit, cache, heatmaps)) if chunk else None
+
+    pending = next_batch()
+    try:
+        while pending is not None:
+            prepared = await pending
+            pending = next_batch()
+
+            ready = []
+            for prep in prepared:
+                item = prep.item
+                if prep.error is not None:
+                    summary(item.plot).errors += 1
+                    yield {"type": "error", "index": item.index, "filename": item.filename, "plot": item.plot,
+                           "error": f"Could not read image: {prep.error}"}
+                elif prep.result is not None:
+                    summary(item.plot).add(prep.result)
+                    yield _result_line(item, prep.result, prep.cache)
+                else:
+                    ready.append(prep)
+            if not ready:
+                continue
+
+            start = loop.time()
+            results = await run_in_threadpool(predict_batch, [prep.tensor for prep in ready])
+            if on_batch is not None:
+                on_batch(len(ready), loop.time() - start)
+            for prep, result in zip(ready, results):
+                if cache is not None:
+                    cache.put(prep.sha, result, prep.phash, fingerprint)
+                summary(prep.item.plot).add(result)
+                yield _result_line(prep.item, result, prep.cache)
+    finally:
+        if pending is not None:
+            pending.cancel()
+
+    for plot_summary in summaries.values():
+        yield plot_summary.as_dict()
+
+
+def _result_line(item, result, cache):
+    return {"type": "result", "index": item.index, "filename": item.filename, "plot": item.plot,
+            **result, "cache": cache}
+
+
+def ndjson(record):
+    return json.dumps(record) + "\n"
@@ -0,0 +1,142 @@
+"""Decode benchmark: full decode + Resize vs the DCT-domain fast path.
+
+Compares the old serving path (``Image.open(...).convert('RGB')`` followed by
+torchvision's Resize/ToTensor/Normalize) with ``scripts/fast_decode.py``
+(draft/reduce decode straight to 224x224 plus pooled normalization) on phone-
+sized JPEGs. Reports the median time per image and the peak RSS of a fresh
+interpreter decoding one image.
+
+    python benchmarks/decode.py                       # synthetic 12, 24 and 48 MP JPEGs
+    python benchmarks/decode.py --images a.jpg b.jpg  # your own photos
+    python benchmarks/decode.py --json
+"""
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REPO_ROOT = os.path.dirname(API_DIR)
+sys.path.insert(0, os.path.join(REPO_ROOT, "scripts"))
+
+METHODS = ["baseline", "fast"]
+
+
+def make_decoder(method):
+    """Return a function mapping an image path to a normalized (1, 3, 224, 224) tensor."""
+    if method == "baseline":
+        from PIL import Image
+        from torchvision import transforms
+
+        transform = transforms.Compose([
+            transforms.Resize((224, 224)),
+            transforms.ToTensor(),
+            transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+        ])
+        return lambda path: transform(Image.open(path).convert("RGB")).unsqueeze(0)
+
+    import fast_decode
+
+    pool = fast_decode.BufferPool(1)
+
+    def decode(path):
+        buffer = pool.acquire(1)
+        batch = fast_decode.normalize_into([fast_decode.to_uint8(fast_decode.decode_resized(path))], buffer)
+        pool.release(buffer)
+        return batch
+
+    return decode
+
+
+def synthetic_jpegs(megapixels, out_dir):
+    """Upscaled PlantVillage leaves (or noise) saved as 4:3 JPEGs of the given sizes."""
+    from PIL import Image
+
+    leaves = sorted(glob.glob(os.path.join(REPO_ROOT, "PlantVillage", "*", "*")))
+    paths = []
+    for mp in megapixels:
+        width = int((mp * 1e6 * 4 / 3) ** 0.5)
+        height = int(width * 3 / 4)
+        if leaves:
+            image = Image.open(leaves[0]).convert("RGB").resize((width, height), Image.BICUBIC)
+        else:
+            image = Image.effect_noise((width, height), 64).convert("RGB")
+        path = os.path.join(out_dir, f"phone_{mp}mp.jpg")
+        image.save(path, quality=92)
+        paths.append(path)
+    return paths
+
+
+def time_decode(method, path, runs):
+    decode = make_decoder(method)
+    decode(path)
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        decode(path)
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2] * 1000
+
+
+_PROBE = """
+import sys
+sys.path.insert(0, {bench_dir!r})
+from decode import make_decoder
+decode = make_decoder({method!r})
+before = [l for l in open('/proc/self/status') if l.startswith('VmHWM:')][0]
+if {path!r}:
+    decode({path!r})
+after = [l for l in open('/proc/self/status') if l.startswith('VmHWM:')][0]
+print(int(before.split()[1]), int(after.split()[1]))
+"""
+
+
+def peak_rss_mb(method, path):
+    """Extra peak RSS (MB) from decoding `path` once, in a fresh interpreter."""
+    proc = subprocess.run(
+        [sys.executable, "-c", _PROBE.format(bench_dir=os.path.dirname(os.path.abspath(__file__)),
+                                             method=method, path=path)],
+        capture_output=True, text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"RSS probe failed:\n{proc.stderr}")
+    before_kb, after_kb = map(int, proc.stdout.split())
+    return (after_kb - before_kb) / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--images", nargs="+", help="JPEGs to decode (default: synthetic phone photos)")
+    parser.add_argument("--megapixels", nargs="+", type=int, default=[12, 24, 48])
+    parser.add_argument("--runs", type=int, default=5, help="timed decodes per image and method")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = args.images or synthetic_jpegs(args.megapixels, tmp)
+        report = {}
+        for path in paths:
+            name = os.path.basename(path)
+            report[name] = {"bytes": os.path.getsize(path)}
+            for method in METHODS:
+                report[name][method] = {
+                    "decode_ms": round(time_decode(method, path, args.runs), 1),
+                    "peak_rss_mb": round(peak_rss_mb(method, path), 1),
+                }
+            report[name]["speedup"] = round(report[name]["baseline"]["decode_ms"] / report[name]["fast"]["decode_ms"], 2)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"{'image':20s} {'baseline ms':>12s} {'fast ms':>9s} {'speedup':>8s} {'baseline MB':>12s} {'fast MB':>8s}")
+    for name, r in report.items():
+        print(f"{name:20s} {r['baseline']['decode_ms']:12.1f} {r['fast']['decode_ms']:9.1f} {r['speedup']:7.2f}x "
+              f"{r['baseline']['peak_rss_mb']:12.1f} {r['fast']['peak_rss_mb']:8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""Local stand-ins for Gemini and the severity model, used by the load tests."""
+import io
+import random
+import time
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeGemini:
+    """Mimics the parts of genai.GenerativeModel the API uses.
+
+    latency      seconds before the (first) response arrives
+    chunks       number of streamed chunks; chunk_delay seconds between them
+    error_rate   probability that a call raises, like a 429/500 from upstream
+    """
+
+    def __init__(self, latency=0.3, chunks=8, chunk_delay=0.02, error_rate=0.0, reply_words=64, seed=None):
+        self.latency = latency
+        self.chunks = max(1, chunks)
+        self.chunk_delay = chunk_delay
+        self.error_rate = error_rate
+        self.reply_words = reply_words
+        self.random = random.Random(seed)
+        self.calls = 0
+
+    def start_chat(self, history=None):
+        return self
+
+    def _maybe_fail(self):
+        if self.error_rate and self.random.random() < self.error_rate:
+            raise RuntimeError("fake upstream error")
+
+    def _reply(self, message):
+        words = [f"w{i}" for i in range(self.reply_words)]
+        return f"Re: {message[:40]} " + " ".join(words)
+
+    def send_message(self, message, stream=False):
+        self.calls += 1
+        time.sleep(self.latency)
+        self._maybe_fail()
+        reply = self._reply(message)
+        if not stream:
+            return FakeResponse(reply)
+        return self._stream(reply)
+
+    def _stream(self, reply):
+        size = max(1, len(reply) // self.chunks)
+        for start in range(0, len(reply), size):
+            yield FakeResponse(reply[start:start + size])
+            time.sleep(self.chunk_delay)
+
+
+class FakePredictor:
+    """Stand-in for inference.SeverityPredictor without torch.
+
+    Decodes and resizes uploads with PIL like the real model path does, and
+    spends batch_latency + item_latency * len(batch) seconds per forward.
+    """
+
+    def __init__(self, batch_latency=0.02, item_latency=0.005):
+        self.batch_latency = batch_latency
+        self.item_latency = item_latency
+        self.batches = []
+
+    def decode(self, data):
+        from PIL import Image
+
+        return Image.open(io.BytesIO(data)).convert("RGB")
+
+    def preprocess(self, image):
+        return image.resize((224, 224))
+
+    def predict_batch(self, items):
+        self.batches.append(len(items))
+        time.sleep(self.batch_latency + self.item_latency * len(items))
+        return [{"class": "Early Blight", "class_index": 0, "confidence": 0.9, "severity": 0.25} for _ in items]
+
+
+def sample_jpeg(size=(1024, 768), quality=90, seed=None):
+    """A synthetic leaf-sized JPEG upload; each seed draws different spots, so its bytes and hash differ."""
+    from PIL import Image, ImageDraw
+
+    image = Image.new("RGB", size, (60, 140, 60))
+    if seed is not None:
+        rng = random.Random(seed)
+        draw = ImageDraw.Draw(image)
+        for _ in range(12):
+            x, y = rng.randrange(size[0]), rng.randrange(size[1])
+            r = rng.randrange(10, 120)
+            draw.ellipse((x - r, y - r, x + r, y + r), fill=(rng.randrange(60, 140), rng.randrange(40, 110), 30))
+    buf = io.BytesIO()
+    image.save(buf, format="JPEG", quality=quality)
+    return buf.getvalue()
@@ -0,0 +1,228 @@
+"""Load and latency benchmark for the API against local fakes.
+
+Starts main.app under uvicorn on a free local port with FakeGemini in place of
+the Gemini SDK and FakePredictor (or the real severity model) behind
+/api/predict, then drives each scenario at fixed concurrency levels and reports
+throughput and p50/p95/p99 latency as JSON.
+
+    python benchmarks/load_test.py --concurrency 1 8 32 --requests 200 --out report.json
+    python benchmarks/load_test.py --baseline report.json --tolerance 0.2   # exit 1 on regression
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import socket
+import sys
+import threading
+import time
+
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, API_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+os.environ.setdefault("GOOGLE_API_KEY", "benchmark")
+os.environ.setdefault("LLM_PREWARM", "0")
+os.environ.setdefault("PREDICT_PRELOAD", "0")
+# Every simulated user comes from 127.0.0.1, so the per-client rate limit is off
+os.environ.setdefault("ADMIT_CLIENT_RATE", "0")
+
+SCENARIOS = ["chat", "chat_stream", "predict"]
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, math.ceil(q / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def summarize(latencies, errors, elapsed, ttfb=None, shed=0, deadline=10.0):
+    """`goodput_rps` only counts answers that arrived within `deadline` (what a client behind Vercel sees)."""
+    good = sum(1 for latency in latencies if latency <= deadline)
+    result = {
+        "requests": len(latencies) + errors + shed,
+        "errors": errors,
+        "shed": shed,
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed > 0 else 0.0,
+        "goodput_rps": round(good / elapsed, 2) if elapsed > 0 else 0.0,
+    }
+    if latencies:
+        for q in (50, 95, 99):
+            result[f"p{q}_ms"] = round(percentile(latencies, q) * 1000, 2)
+    if ttfb:
+        for q in (50, 95, 99):
+            result[f"ttfb_p{q}_ms"] = round(percentile(ttfb, q) * 1000, 2)
+    return result
+
+
+def start_server(app, port):
+    import uvicorn
+
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, thread
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def run_level(base_url, scenario, concurrency, total, images, distinct_messages):
+    import httpx
+
+    latencies, ttfb, errors, shed = [], [], 0, 0
+    issued = 0
+
+    async def one(client, i):
+        nonlocal errors, shed
+        start = time.perf_counter()
+        try:
+            if scenario == "predict":
+                image = images[i % len(images)]
+                r = await client.post("/api/predict", files={"file": ("leaf.jpg", image, "image/jpeg")})
+                ok = r.status_code == 200
+            else:
+                n = i % distinct_messages if distinct_messages else i
+                body = {"message": f"How do I treat this? #{n}", "context": "Early Blight"}
+                if scenario == "chat":
+                    r = await client.post("/api/chat", json=body)
+                    ok = r.status_code == 200
+                else:
+                    body["stream"] = True
+                    ok, first = False, None
+                    async with client.stream("POST", "/api/chat", json=body) as r:
+                        if r.status_code in (429, 503):
+                            shed += 1
+                            return float(r.headers.get("Retry-After", 1))
+                        async for chunk in r.aiter_text():
+                            if first is None:
+                                first = time.perf_counter() - start
+                            if "event: done" in chunk:
+                                ok = True
+                    if ok and first is not None:
+                        ttfb.append(first)
+        except Exception:
+            ok = False
+        else:
+            if r.status_code in (429, 503):
+                shed += 1   # Refused by admission control; back off like a well-behaved client
+                return float(r.headers.get("Retry-After", 1))
+        if ok:
+            latencies.append(time.perf_counter() - start)
+        else:
+            errors += 1
+
+    async def worker(client):
+        nonlocal issued
+        while issued < total:
+            i = issued
+            issued += 1
+            retry_after = await one(client, i)
+            if retry_after:
+                await asyncio.sleep(retry_after)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=60, limits=limits) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    return summarize(latencies, errors, elapsed, ttfb, shed)
+
+
+def compare(report, baseline, tolerance):
+    """Return regressions: p95 latency up or throughput down by more than tolerance."""
+    regressions = []
+    for scenario, levels in report["results"].items():
+        for level, current in levels.items():
+            previous = baseline.get("results", {}).get(scenario, {}).get(level)
+            if not previous or "p95_ms" not in previous or "p95_ms" not in current:
+                continue
+            if current["p95_ms"] > previous["p95_ms"] * (1 + tolerance):
+                regressions.append(f"{scenario}@{level}: p95 {previous['p95_ms']} -> {current['p95_ms']} ms")
+            if current["throughput_rps"] < previous["throughput_rps"] * (1 - tolerance):
+                regressions.append(f"{scenario}@{level}: throughput {previous['throughput_rps']} -> "
+                                   f"{current['throughput_rps']} rps")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=200, help="requests per concurrency level")
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="fake Gemini latency (s)")
+    parser.add_argument("--llm-chunks", type=int, default=8, help="chunks per streamed reply")
+    parser.add_argument("--llm-chunk-delay", type=float, default=0.02, help="delay between chunks (s)")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0, help="fraction of failing upstream calls")
+    parser.add_argument("--distinct-messages", type=int, default=0,
+                        help="cycle through this many questions (0 = every question unique, no cache hits)")
+    parser.add_argument("--distinct-images", type=int, default=0,
+                        help="cycle through this many uploads (0 = every upload unique, no prediction cache hits)")
+    parser.add_argument("--real-model", action="store_true",
+                        help="serve /api/predict with the real severity model instead of FakePredictor")
+    parser.add_argument("--out", help="write the JSON report here as well as to stdout")
+    parser.add_argument("--baseline", help="earlier report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression")
+    args = parser.parse_args()
+
+    import llm
+    import main as api
+    import registry
+    from chat_cache import ResponseCache
+    from prediction_cache import PredictionCache
+    from fakes import FakeGemini, FakePredictor, sample_jpeg
+
+    llm._model = FakeGemini(latency=args.llm_latency, chunks=args.llm_chunks,
+                            chunk_delay=args.llm_chunk_delay, error_rate=args.llm_error_rate, seed=0)
+    if not args.real_model:
+        registry.models.install(registry.models.default, FakePredictor())
+
+    port = free_port()
+    server, thread = start_server(api.app, port)
+    # Generated up front so JPEG encoding is not timed
+    images = ([sample_jpeg(seed=i) for i in range(args.distinct_images or args.requests)]
+              if "predict" in args.scenarios else [])
+    report = {
+        "config": {k: v for k, v in vars(args).items() if k not in ("out", "baseline")},
+        "results": {},
+    }
+    try:
+        for scenario in args.scenarios:
+            report["results"][scenario] = {}
+            for concurrency in args.concurrency:
+                api.response_cache = ResponseCache()   # every level starts cold
+                api.prediction_cache = PredictionCache(db_path=None)
+                api.version_caches.clear()
+                result = asyncio.run(run_level(f"http://127.0.0.1:{port}", scenario, concurrency,
+                                               args.requests, images, args.distinct_messages))
+                if scenario == "predict":
+                    # Answers that never reached the model, so forwards = misses
+                    stats = api.prediction_cache.stats()
+                    result["prediction_cache"] = {k: stats[k] for k in ("hits", "near_hits", "coalesced", "misses")}
+                report["results"][scenario][str(concurrency)] = result
+                print(f"{scenario:12s} c={concurrency:<4d} {result}", file=sys.stderr)
+    finally:
+        server.should_exit = True
+        thread.join()
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["regressions"] = compare(report, json.load(f), args.tolerance)
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(output)
+    sys.exit(1 if report.get("regressions") else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""Cold-start benchmark for the API entry points.
+
+Imports each entry point in a fresh interpreter with ``python -X importtime``
+and reports the wall time plus the cost of each module it imports directly.
+
+    python benchmarks/startup.py                 # human-readable table
+    python benchmarks/startup.py --json          # machine-readable report
+    python benchmarks/startup.py --max-ms 1500   # exit 1 if any entry point is slower
+
+Modules listed in LAZY_MODULES must not be imported at startup; finding one is
+reported as a regression too.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ENTRY_POINTS = ["index", "main", "chat"]
+LAZY_MODULES = ["google.generativeai", "torch", "torchvision", "uvicorn"]
+
+_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"wall_ms": elapsed * 1000, "loaded": [m for m in {lazy!r} if m in sys.modules]}}))
+"""
+
+
+def profile_import(module, runs=3):
+    """Import `module` in `runs` fresh interpreters; keep the fastest run."""
+    best = None
+    for _ in range(runs):
+        proc = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", _PROBE.format(module=module, lazy=LAZY_MODULES)],
+            cwd=API_DIR, capture_output=True, text=True,
+            env={**os.environ, "GOOGLE_API_KEY": os.getenv("GOOGLE_API_KEY", "benchmark")},
+        )
+        if proc.returncode != 0:
+            raise RuntimeError(f"importing {module} failed:\n{proc.stderr}")
+        result = json.loads(proc.stdout.strip().splitlines()[-1])
+        result["modules"] = _parse_importtime(proc.stderr, module)
+        if best is None or result["wall_ms"] < best["wall_ms"]:
+            best = result
+    return best
+
+
+def _parse_importtime(stderr, module):
+    """Cumulative import time (ms) of each module imported directly by `module`.
+
+    Lines look like ``import time:   self_us |   cumulative_us | <indent>name``,
+    two spaces of indent per nesting level, and children are printed before
+    their parent. Each direct import's time includes everything it pulled in.
+    """
+    children, totals = [], {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative_us, name = line.split("|", 2)
+        level = (len(name) - len(name.lstrip(" ")) - 1) // 2
+        if level == 1:
+            children.append((name.strip(), int(cumulative_us) / 1000))
+        elif level == 0:
+            if name.strip() == module:
+                for child, ms in children:
+                    totals[child] = totals.get(child, 0) + ms
+            children = []
+    return dict(sorted(totals.items(), key=lambda kv: kv[1], reverse=True))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--runs", type=int, default=3, help="fresh interpreters per entry point")
+    parser.add_argument("--top", type=int, default=10, help="modules to list per entry point")
+    parser.add_argument("--max-ms", type=float, help="fail if an entry point imports slower than this")
+    args = parser.parse_args()
+
+    report = {}
+    for module in ENTRY_POINTS:
+        result = profile_import(module, args.runs)
+        result["modules"] = dict(list(result["modules"].items())[:args.top])
+        report[module] = result
+
+    failures = []
+    for module, result in report.items():
+        if result["loaded"]:
+            failures.append(f"{module} imports {', '.join(result['loaded'])} at startup")
+        if args.max_ms is not None and result["wall_ms"] > args.max_ms:
+            failures.append(f"{module} took {result['wall_ms']:.0f} ms (limit {args.max_ms:.0f} ms)")
+
+    if args.json:
+        print(json.dumps({"entry_points": report, "failures": failures}, indent=2))
+    else:
+        for module, result in report.items():
+            print(f"{module}: {result['wall_ms']:.1f} ms")
+            for name, ms in result["modules"].items():
+                print(f"    {ms:8.1f} ms  {name}")
+        for failure in failures:
+            print(f"FAIL: {failure}")
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
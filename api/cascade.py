@@ -0,0 +1,180 @@
+import io
+import json
+import os
+import threading
+import time
+
+import metrics
+
+# With PREDICT_CASCADE=1 a small Keras CNN (models/<n>/model.keras) answers
+# first and only uploads it is unsure about go through the severity model.
+# Thresholds come from scripts/calibrate_cascade.py (CASCADE_CONFIG); the
+# CASCADE_MIN_* variables override them.
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CASCADE_ENABLED = os.getenv("PREDICT_CASCADE", "0") == "1"
+CASCADE_CONFIG = os.getenv("CASCADE_CONFIG", os.path.join(REPO_ROOT, "models", "cascade.json"))
+FAST_MODEL_PATH = os.getenv("CASCADE_FAST_MODEL")
+MIN_CONFIDENCE = os.getenv("CASCADE_MIN_CONFIDENCE")
+MIN_MARGIN = os.getenv("CASCADE_MIN_MARGIN")
+
+DEFAULT_FAST_MODEL = os.path.join(REPO_ROOT, "models", "5", "model.keras")
+DEFAULT_MIN_CONFIDENCE = 0.95
+# Off until calibrated: a top probability p leaves at most 1 - p for the runner-up,
+# so the margin is always >= 2p - 1 and a margin gate at or below
+# 2 * min_confidence - 1 can never fire. Only cascade.json or CASCADE_MIN_MARGIN turn it on.
+DEFAULT_MIN_MARGIN = 0.0
+FAST_SIZE = 256
+FULL_SIZE = 224
+
+
+class CascadeStats:
+    """Counts of images answered by the fast model and escalations by reason."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.images = 0
+        self.escalations = {"confidence": 0, "margin": 0}
+
+    def record(self, reasons):
+        with self.lock:
+            self.images += len(reasons)
+            for reason in reasons:
+                if reason is not None:
+                    self.escalations[reason] += 1
+
+    def snapshot(self):
+        with self.lock:
+            escalated = sum(self.escalations.values())
+            return {
+                "images": self.images,
+                "escalations": dict(self.escalations),
+                "escalation_rate": round(escalated / self.images, 4) if self.images else 0.0,
+            }
+
+    def metric_lines(self):
+        stats = self.snapshot()
+        lines = metrics.counter_lines("potato_cascade_images_total", "Images scored through the cascade.",
+                                      stats["images"])
+        name = "potato_cascade_escalations_total"
+        lines += [f"# HELP {name} Images escalated to the severity model, by gate.", f"# TYPE {name} counter"]
+        lines += [f'{name}{{reason="{reason}"}} {count}' for reason, count in sorted(stats["escalations"].items())]
+        lines += metrics.counter_lines("potato_cascade_escalation_rate",
+                                       "Fraction of cascade images escalated so far.", stats["escalation_rate"], "gauge")
+        return lines
+
+
+stats = CascadeStats()
+metrics.register_collector(stats.metric_lines)
+
+
+def escalation(probs, min_confidence, min_margin):
+    """Per row of class probabilities: None if the fast answer stands, else the gate it failed."""
+    reasons = []
+    for row in probs:
+        second, first = sorted(float(p) for p in row)[-2:]
+        if first < min_confidence:
+            reasons.append("confidence")
+        elif first - second < min_margin:
+            reasons.append("margin")
+        else:
+            reasons.append(None)
+    return reasons
+
+
+class CascadePredictor:
+    """Fast Keras classifier in front of a SeverityPredictor, with the same decode/preprocess/predict_batch API.
+
+    Uploads are decoded once at 256x256 (the Keras input size). Images whose
+    top probability is below min_confidence, or whose top-two margin is below
+    min_margin, are resized to 224x224 and scored by the severity model in one
+    sub-batch. The fast model has no severity head, so its answers carry
+    "severity": None; every result says which model produced it. Heatmap
+    batches skip the fast model, since only the severity model has CAMs.
+    """
+
+    def __init__(self, full, fast, min_confidence, min_margin, stats=stats):
+        from inference import CLASS_NAMES, MAX_PIXELS, file_digest
+
+        self.full = full
+        self.fast = fast
+        self.min_confidence = min_confidence
+        self.min_margin = min_margin
+        self.stats = stats
+        self.class_names = CLASS_NAMES
+        self.max_pixels = MAX_PIXELS
+        self.fingerprint = (f"{full.fingerprint}|{os.path.basename(fast.path)}:{file_digest(fast.path)}"
+                            f"|{min_confidence}/{min_margin}")
+
+    def decode(self, data):
+        return self.full.fast_decode.decode_resized(io.BytesIO(data), size=FAST_SIZE, max_pixels=self.max_pixels)
+
+    def preprocess(self, image):
+        return self.full.fast_decode.to_uint8(image)
+
+    def predict_batch(self, arrays, heatmaps=False):
+        if heatmaps:
+            resized = [self.full.fast_decode.resize_array(array, FULL_SIZE) for array in arrays]
+            return [{**result, "model": "full"} for result in self.full.predict_batch(resized, heatmaps=True)]
+
+        start = time.perf_counter()
+        probs = self.fast.predict(arrays)
+        metrics.observe_stage("fast_forward", time.perf_counter() - start)
+        reasons = escalation(probs, self.min_confidence, self.min_margin)
+        self.stats.record(reasons)
+
+        results = []
+        for row in probs:
+            confidence, idx = max((float(p), i) for i, p in enumerate(row))
+            results.append({"class": self.class_names[idx], "class_index": idx,
+                            "confidence": round(confidence, 4), "severity": None, "model": "fast"})
+
+        escalated = [i for i, reason in enumerate(reasons) if reason is not None]
+        if escalated:
+            start = time.perf_counter()
+            full_results = self.full.predict_batch(
+                [self.full.fast_decode.resize_array(arrays[i], FULL_SIZE) for i in escalated])
+            metrics.observe_stage("escalated_forward", time.perf_counter() - start)
+            for i, result in zip(escalated, full_results):
+                results[i] = {**result, "model": "full", "escalated": reasons[i]}
+        return results
+
+
+def margin_gate_active(min_confidence, min_margin):
+    """Whether the margin gate can escalate anything the confidence gate lets through."""
+    return min_margin > 2 * min_confidence - 1
+
+
+def read_config(path=CASCADE_CONFIG):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def load_cascade(full):
+    """Wrap a loaded SeverityPredictor in the cascade, or return it unchanged if the fast model can't be served."""
+    config = read_config()
+    fast_path = FAST_MODEL_PATH or config.get("fast_model") or DEFAULT_FAST_MODEL
+    if not os.path.isabs(fast_path):
+        fast_path = os.path.join(REPO_ROOT, fast_path)
+    if not config and MIN_CONFIDENCE is None:
+        print(f"Cascade: {CASCADE_CONFIG} not found, using default thresholds. "
+              f"Run scripts/calibrate_cascade.py to pick them for your accuracy target.")
+    min_confidence = float(MIN_CONFIDENCE or config.get("min_confidence", DEFAULT_MIN_CONFIDENCE))
+    min_margin = float(MIN_MARGIN or config.get("min_margin", DEFAULT_MIN_MARGIN))
+
+    if not os.path.exists(fast_path):
+        print(f"Cascade disabled: {fast_path} not found.")
+        return full
+    try:
+        from calibrate_cascade import KerasClassifier
+        fast = KerasClassifier(fast_path)
+    except ImportError as e:
+        print(f"Cascade disabled: {e}")
+        return full
+    if min_margin > 0 and not margin_gate_active(min_confidence, min_margin):
+        print(f"Cascade: margin {min_margin} can never fire at confidence {min_confidence} "
+              f"(the margin is always at least {2 * min_confidence - 1:.2f}); only confidence gates.")
+    print(f"Cascade: {os.path.relpath(fast_path, REPO_ROOT)} first, escalating below "
+          f"confidence {min_confidence}" + (f" or margin {min_margin}" if min_margin > 0 else ""))
+    return CascadePredictor(full, fast, min_confidence, min_margin)
@@ -1,7 +1,8 @@
 from http.server import BaseHTTPRequestHandler
 import json
-import os
-import google.generativeai as genai
+
+import llm
+import metrics
 
 class handler(BaseHTTPRequestHandler):
     def do_OPTIONS(self):
@@ -12,56 +13,30 @@ class handler(BaseHTTPRequestHandler):
         self.end_headers()
 
     def do_POST(self):
-        try:
-            # Check API Key
-            api_key = os.getenv("GOOGLE_API_KEY")
-            if not api_key:
-                raise ValueError("GOOGLE_API_KEY environment variable is not set")
-
-            # Configure Gemini
-            genai.configure(api_key=api_key)
-            generation_config = {
-                "temperature": 0.7,
-                "top_p": 1,
-                "top_k": 1,
-                "max_output_tokens": 2048,
-            }
-            
-            # Use flash model which is generally available
-            model = genai.GenerativeModel(model_name="gemini-2.5-flash-lite", generation_config=generation_config)
+        # Times the invocation and logs a stage breakdown when it is slow (SLOW_REQUEST_MS)
+        with metrics.track_request('POST', '/api/chat') as record:
+            self.handle_chat(record)
 
+    def handle_chat(self, record):
+        try:
             # Get content length and read body
             content_length = int(self.headers['Content-Length'])
             post_data = self.rfile.read(content_length)
             data = json.loads(post_data.decode('utf-8'))
+            metrics.mark_decoded()
             
             message = data.get('message', '')
             context = data.get('context')
             
-            system_prompt = """You are 'Potato Doc', an expert agricultural AI assistant specializing in potato crops. 
-            Your goal is to help farmers and users diagnose diseases, suggest treatments, and provide advice on potato farming.
-            
-            Traits:
-            - Professional yet accessible.
-            - Highly knowledgeable about Early Blight, Late Blight, and general crop health.
-            - Concise and conversational. Speak naturally like a human expert, not a robot.
-            - Avoid excessive bulleted lists. Use paragraphs and natural language to explain things briefly.
-            - Only use lists if describing a strict step-by-step process.
-            
-            If a context is provided (e.g., "Early Blight detected"), tailor your advice specifically to that diagnosis.
-            If the user asks about something unrelated to agriculture or potatoes, politely steer them back to the topic.
-            """
-            
-            chat = model.start_chat(history=[
-                {"role": "user", "parts": [system_prompt]},
-                {"role": "model", "parts": ["Understood. I am Potato Doc, ready to assist with potato crop diagnostics and advice."]}
-            ])
-            
-            user_message = message
-            if context:
-                user_message = f"[Context: Current scan detected {context}] User Question: {message}"
-            
-            response = chat.send_message(user_message)
+            if data.get('stream') or 'text/event-stream' in (self.headers.get('Accept') or ''):
+                record.status = 200
+                with metrics.span('upstream_llm'):
+                    self.stream_reply(message, context)
+                return
+
+            # Shared, per-process Gemini client (configured once, reused across invocations)
+            with metrics.span('upstream_llm'):
+                reply = llm.complete(message, context)
             
             # Send response
             self.send_response(200)
@@ -71,8 +46,10 @@ class handler(BaseHTTPRequestHandler):
             self.send_header('Access-Control-Allow-Headers', 'Content-Type')
             self.end_headers()
             
-            response_data = json.dumps({"response": response.text})
+            with metrics.span('response_encode'):
+                response_data = json.dumps({"response": reply})
             self.wfile.write(response_data.encode('utf-8'))
+            record.status = 200
             
         except Exception as e:
             print(f"Error: {str(e)}") # Log error to Vercel logs
@@ -82,3 +59,37 @@ class handler(BaseHTTPRequestHandler):
             self.end_headers()
             error_response = json.dumps({"error": str(e)})
             self.wfile.write(error_response.encode('utf-8'))
+
+    def stream_reply(self, message, context):
+        """Write the reply as server-sent events, flushing each chunk as it arrives."""
+        self.send_response(200)
+        self.send_header('Content-type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+
+        parts = []
+        try:
+            for text in llm.stream(message, context):
+                parts.append(text)
+                self.send_event({'text': text})
+            reply = "".join(parts)
+        except Exception as e:
+            print(f"Error: {str(e)}") # Log error to Vercel logs
+            if parts:
+                self.send_event({"detail": str(e)}, event='error')
+                return
+            # Nothing sent yet: fall back to a regular completion delivered as one chunk (as main.py does)
+            try:
+                reply = llm.complete(message, context)
+            except Exception as e:
+                print(f"Error: {str(e)}")
+                self.send_event({"detail": str(e)}, event='error')
+                return
+            self.send_event({'text': reply})
+        self.send_event({"response": reply}, event='done')
+
+    def send_event(self, data, event=None):
+        prefix = f"event: {event}\n" if event else ""
+        self.wfile.write(f"{prefix}data: {json.dumps(data)}\n\n".encode('utf-8'))
+        self.wfile.flush()
@@ -0,0 +1,124 @@
+import asyncio
+import os
+import re
+import time
+from collections import OrderedDict
+
+CHAT_CACHE_TTL = float(os.getenv("CHAT_CACHE_TTL", "3600"))          # seconds, 0 disables caching
+CHAT_CACHE_MAX_ENTRIES = int(os.getenv("CHAT_CACHE_MAX_ENTRIES", "1024"))
+CHAT_CACHE_MAX_BYTES = int(os.getenv("CHAT_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+
+_TRAILING_PUNCTUATION = re.compile(r"[\s?.!]+$")
+
+
+def _normalize(text):
+    if not text:
+        return ""
+    return _TRAILING_PUNCTUATION.sub("", " ".join(text.lower().split()))
+
+
+def make_key(context, message):
+    """Cache key for a chat question: case, spacing and trailing punctuation are ignored."""
+    return (_normalize(context), _normalize(message))
+
+
+class ResponseCache:
+    """TTL + LRU cache of chat replies with single-flight request coalescing.
+
+    Concurrent misses for the same key share one upstream call. The call runs
+    as its own task, so a client that disconnects does not cancel it for the
+    others that are waiting on the same answer.
+    """
+
+    def __init__(self, ttl=CHAT_CACHE_TTL, max_entries=CHAT_CACHE_MAX_ENTRIES, max_bytes=CHAT_CACHE_MAX_BYTES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()   # key -> (expires_at, value, size)
+        self.inflight = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _size(key, value):
+        return sum(len(part.encode("utf-8")) for part in key) + len(value.encode("utf-8"))
+
+    def _evict(self, key):
+        _, _, size = self.entries.pop(key)
+        self.bytes -= size
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            self._evict(key)
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def lookup(self, key):
+        """get() that also counts the hit or miss, for callers that fill the cache themselves."""
+        value = self.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        size = self._size(key, value)
+        if self.ttl <= 0 or size > self.max_bytes:
+            return
+        if key in self.entries:
+            self._evict(key)
+        self.entries[key] = (time.monotonic() + self.ttl, value, size)
+        self.bytes += size
+        while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+            self._evict(next(iter(self.entries)))
+            self.evictions += 1
+
+    async def get_or_compute(self, key, compute):
+        """Return the cached reply for key, or await compute() exactly once across callers."""
+        value = self.get_hit(key)
+        if value is not None:
+            return value
+        return await self.compute_once(key, compute)
+
+    def get_hit(self, key):
+        """get() that counts a hit when the key is cached (misses are counted by compute_once)."""
+        value = self.get(key)
+        if value is not None:
+            self.hits += 1
+        return value
+
+    async def compute_once(self, key, compute):
+        """Await compute() for key, joining a call that is already in flight."""
+        task = self.inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = asyncio.ensure_future(compute())
+            self.inflight[key] = task
+            task.add_done_callback(lambda t: self._finish(key, t))
+        return await asyncio.shield(task)
+
+    def _finish(self, key, task):
+        self.inflight.pop(key, None)
+        if not task.cancelled() and task.exception() is None:
+            self.put(key, task.result())
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "inflight": len(self.inflight),
+        }
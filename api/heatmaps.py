@@ -0,0 +1,46 @@
+import base64
+import io
+
+# Heatmaps travel and are cached as the model's native 7x7 class activation
+# map quantized to 0-255 (49 small ints). "png" responses turn that grid into
+# a semi-transparent 224x224 overlay for the scanned leaf on the fly.
+FORMATS = ("array", "png")
+OVERLAY_SIZE = 224
+OVERLAY_ALPHA = 0.6
+
+
+def quantize(cams):
+    """(B, H, W) maps in 0-1 (torch tensor) -> one list of uint8 rows per image."""
+    return (cams * 255).round().byte().tolist()
+
+
+def check_format(heatmap):
+    if heatmap is not None and heatmap not in FORMATS:
+        raise ValueError(f"heatmap must be one of {', '.join(FORMATS)}")
+
+
+def has_heatmap(result):
+    return result.get("heatmap") is not None
+
+
+def render_png(grid, size=OVERLAY_SIZE):
+    """Bilinear-upscale a quantized grid and color it (blue -> red), with alpha following the activation."""
+    import numpy as np
+    from PIL import Image
+
+    v = np.asarray(Image.fromarray(np.array(grid, dtype=np.uint8)).resize((size, size), Image.BILINEAR),
+                   dtype=np.float32) / 255
+    channels = [np.clip(1.5 - np.abs(4 * v - shift), 0, 1) for shift in (3, 2, 1)]   # "jet" colormap
+    rgba = np.stack(channels + [v * OVERLAY_ALPHA], axis=-1)
+    buffer = io.BytesIO()
+    Image.fromarray((rgba * 255).astype(np.uint8), "RGBA").save(buffer, format="PNG", optimize=True)
+    return "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode()
+
+
+def shape(result, heatmap):
+    """The result as sent to a client that asked for `heatmap` (None, "array" or "png")."""
+    if heatmap is None or not has_heatmap(result):
+        return {k: v for k, v in result.items() if k != "heatmap"}
+    if heatmap == "png":
+        return {**result, "heatmap": render_png(result["heatmap"])}
+    return result
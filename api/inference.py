@@ -0,0 +1,294 @@
+import asyncio
+import hashlib
+import io
+import os
+import sys
+import threading
+
+from heatmaps import quantize
+
+# The severity model lives next to the training code in scripts/, which is not
+# shipped to Vercel. Prediction is therefore only available on self-hosted
+# deployments that have torch installed and a trained checkpoint on disk.
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPTS_DIR = os.path.join(REPO_ROOT, "scripts")
+
+MODEL_PATH = os.getenv("SEVERITY_MODEL_PATH", os.path.join(REPO_ROOT, "models", "severity_model.pth"))
+# Written by scripts/export_models.py. "auto" serves the fastest exported artifact
+# that passed the parity checks, "checkpoint" always serves MODEL_PATH, and any
+# other value names a manifest entry (e.g. "severity.torchscript.int8_static").
+EXPORT_MANIFEST = os.getenv("SEVERITY_EXPORT_MANIFEST", os.path.join(REPO_ROOT, "models", "export", "manifest.json"))
+SEVERITY_ARTIFACT = os.getenv("SEVERITY_ARTIFACT", "auto")
+MAX_BATCH_SIZE = int(os.getenv("PREDICT_MAX_BATCH_SIZE", "16"))
+MAX_WAIT_MS = float(os.getenv("PREDICT_MAX_WAIT_MS", "10"))
+# Uploads with more pixels than this are rejected from their header, before decoding
+MAX_PIXELS = int(os.getenv("PREDICT_MAX_PIXELS", "50000000"))
+
+# ImageFolder order of PlantVillage/: Potato___Early_blight, Potato___Late_blight, Potato___healthy
+CLASS_NAMES = ["Early Blight", "Late Blight", "Healthy"]
+
+
+class SeverityPredictor:
+    """Wraps PotatoSeverityModel for batched CPU/GPU inference."""
+
+    def __init__(self, model_path=MODEL_PATH, artifact=SEVERITY_ARTIFACT, manifest_path=EXPORT_MANIFEST):
+        import torch
+
+        if SCRIPTS_DIR not in sys.path:
+            sys.path.append(SCRIPTS_DIR)
+        import fast_decode
+        from export_models import load_artifact
+        from train_severity import PotatoSeverityModel
+
+        self.torch = torch
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.model_path = model_path
+
+        entry = select_artifact(artifact, model_path, manifest_path, gpu=self.device.type == "cuda")
+        self.checkpoint_path = model_path
+        self.model_class = PotatoSeverityModel
+        self.cam_model = None      # Eager model, which can return CAM heatmaps from the same forward
+        self.cam_lock = threading.Lock()
+        if entry is not None:
+            # Exported artifacts are built and benchmarked for CPU serving
+            self.device = torch.device("cpu")
+            self.model_path = entry["path"]
+            self.model = load_artifact(entry["format"], entry["path"])
+            print(f"Serving {entry['name']} ({entry['per_image_ms']} ms/image, "
+                  f"agreement {entry['agreement']}, severity MAE {entry.get('severity_mae')})")
+        else:
+            self.model = self.cam_model = self._load_checkpoint()
+
+        # Identifies the loaded weights, so cached predictions are dropped when they change
+        self.fingerprint = f"{os.path.basename(self.model_path)}:{file_digest(self.model_path)}"
+        self.fast_decode = fast_decode
+        self.buffers = fast_decode.BufferPool(MAX_BATCH_SIZE)
+
+    def decode(self, data):
+        """Decode raw upload bytes straight to a 224x224 RGB PIL image (DCT-domain downscaling for JPEGs)."""
+        return self.fast_decode.decode_resized(io.BytesIO(data), max_pixels=MAX_PIXELS)
+
+    def preprocess(self, image):
+        """Turn a decoded image into a (224, 224, 3) uint8 array; normalization happens per batch."""
+        return self.fast_decode.to_uint8(image)
+
+    def _load_checkpoint(self):
+        model = self.model_class(num_classes=len(CLASS_NAMES), pretrained=False)
+        model.load_state_dict(self.torch.load(self.checkpoint_path, map_location=self.device))
+        return model.to(self.device).eval()
+
+    def _get_cam_model(self):
+        """The eager model; loaded on the first heatmap request when an exported artifact is served."""
+        if self.cam_model is None:
+            with self.cam_lock:
+                if self.cam_model is None:
+                    self.cam_model = self._load_checkpoint()
+        return self.cam_model
+
+    def predict_batch(self, arrays, heatmaps=False):
+        """Normalize a list of preprocessed arrays into a pooled buffer and run one dual-head forward.
+
+        When the eager model is served every result carries its quantized CAM
+        ("heatmap"), which costs next to nothing. Exported artifacts have no
+        CAM output, so with heatmaps=True they are bypassed for the eager model.
+        """
+        torch = self.torch
+        buffer = self.buffers.acquire(len(arrays))
+        cams = None
+        try:
+            with torch.no_grad():
+                batch = self.fast_decode.normalize_into(arrays, buffer).to(self.device)
+                if self.cam_model is self.model or heatmaps:
+                    cls_logits, sev_pred, cams = self._get_cam_model().forward_with_cam(batch)
+                    cams = quantize(cams.cpu())
+                else:
+                    cls_logits, sev_pred = self.model(batch)
+                probs = torch.softmax(cls_logits, dim=1)
+                confidence, class_idx = probs.max(dim=1)
+        finally:
+            self.buffers.release(buffer)
+
+        results = []
+        rows = zip(confidence.tolist(), class_idx.tolist(), sev_pred.squeeze(1).tolist())
+        for i, (conf, idx, sev) in enumerate(rows):
+            result = {
+                "class": CLASS_NAMES[idx],
+                "class_index": idx,
+                "confidence": round(conf, 4),
+                "severity": round(sev, 4),
+            }
+            if cams is not None:
+                result["heatmap"] = cams[i]
+            results.append(result)
+        return results
+
+
+class ClassifierPredictor(SeverityPredictor):
+    """best_classifier.pth (ResNet34 with a class head only) behind the same interface; severity is None."""
+
+    def __init__(self, model_path):
+        super().__init__(model_path, artifact="checkpoint")
+
+    def _load_checkpoint(self):
+        from export_models import build_model
+
+        return build_model("classifier", self.checkpoint_path).to(self.device)
+
+    def predict_batch(self, arrays, heatmaps=False):
+        torch = self.torch
+        buffer = self.buffers.acquire(len(arrays))
+        try:
+            with torch.no_grad():
+                batch = self.fast_decode.normalize_into(arrays, buffer).to(self.device)
+                confidence, class_idx = torch.softmax(self.model(batch), dim=1).max(dim=1)
+        finally:
+            self.buffers.release(buffer)
+        return [{"class": CLASS_NAMES[idx], "class_index": idx, "confidence": round(conf, 4), "severity": None}
+                for conf, idx in zip(confidence.tolist(), class_idx.tolist())]
+
+
+class KerasPredictor:
+    """One of the models/<n>/model.keras CNNs (256x256 input, classes only; severity is None)."""
+
+    def __init__(self, model_path):
+        if SCRIPTS_DIR not in sys.path:
+            sys.path.append(SCRIPTS_DIR)
+        import fast_decode
+        from calibrate_cascade import FAST_SIZE, KerasClassifier
+
+        self.model = KerasClassifier(model_path)
+        self.size = FAST_SIZE
+        self.fast_decode = fast_decode
+        self.fingerprint = f"{os.path.basename(os.path.dirname(model_path))}:{file_digest(model_path)}"
+
+    def decode(self, data):
+        return self.fast_decode.decode_resized(io.BytesIO(data), size=self.size, max_pixels=MAX_PIXELS)
+
+    def preprocess(self, image):
+        return self.fast_decode.to_uint8(image)
+
+    def predict_batch(self, arrays, heatmaps=False):
+        results = []
+        for row in self.model.predict(arrays):
+            idx = int(row.argmax())
+            results.append({"class": CLASS_NAMES[idx], "class_index": idx,
+                            "confidence": round(float(row[idx]), 4), "severity": None})
+        return results
+
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()[:16]
+
+
+def select_artifact(artifact=SEVERITY_ARTIFACT, model_path=MODEL_PATH, manifest_path=EXPORT_MANIFEST, gpu=False):
+    """Manifest entry of the exported severity model to serve, or None for the checkpoint."""
+    from export_models import read_manifest, select_fastest
+
+    if artifact == "checkpoint" or (artifact == "auto" and gpu):
+        return None
+    if artifact == "auto":
+        return select_fastest("severity", manifest_path, model_path)
+
+    manifest = read_manifest(manifest_path) or {}
+    for entry in manifest.get("artifacts", []):
+        if entry["name"] == artifact:
+            return entry
+    raise ValueError(f"SEVERITY_ARTIFACT={artifact} is not in {manifest_path}")
+
+
+def load_predictor(model_path=MODEL_PATH):
+    """Load the severity model, or return None if serving it is not possible here."""
+    if not os.path.exists(model_path):
+        print(f"Prediction disabled: {model_path} not found.")
+        return None
+    try:
+        predictor = SeverityPredictor(model_path)
+    except ImportError as e:
+        print(f"Prediction disabled: {e}")
+        return None
+
+    import cascade
+    if cascade.CASCADE_ENABLED:
+        return cascade.load_cascade(predictor)
+    return predictor
+
+
+class MicroBatcher:
+    """Queues concurrent requests and runs them together in one batched call.
+
+    A batch is dispatched as soon as it holds ``max_batch_size`` items or the
+    oldest queued item has waited ``max_wait_ms``, whichever comes first. The
+    batch function runs in the default executor so the event loop stays free.
+    """
+
+    def __init__(self, predict_batch, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS, on_batch=None):
+        self.predict_batch = predict_batch
+        self.on_batch = on_batch   # Called with (batch_size, seconds) after every forward
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000.0
+        self.queue = None
+        self.worker = None
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self.worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+            self.worker = None
+
+    async def drain(self):
+        """Finish everything already queued, then stop (used when a model is swapped out)."""
+        if self.worker is not None:
+            await self.queue.join()
+        await self.stop()
+
+    async def submit(self, item):
+        if self.worker is None:
+            await self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, future))
+        return await future
+
+    async def _collect(self):
+        batch = [await self.queue.get()]
+        deadline = asyncio.get_running_loop().time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            items = [item for item, _ in batch]
+            start = loop.time()
+            try:
+                results = await loop.run_in_executor(None, self.predict_batch, items)
+                if self.on_batch is not None:
+                    self.on_batch(len(items), loop.time() - start)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for (_, future), result in zip(batch, results):
+                    if not future.done():
+                        future.set_result(result)
+            for _ in batch:
+                self.queue.task_done()
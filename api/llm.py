@@ -0,0 +1,137 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# google.generativeai is imported on first use (see get_model): it takes most of
+# the API's cold-start import time and routes like /ping never need it.
+MODEL_NAME = "gemini-2.5-flash-lite"
+generation_config = {
+  "temperature": 0.7,
+  "top_p": 1,
+  "top_k": 1,
+  "max_output_tokens": 2048,
+}
+
+# Upper bound on Gemini calls in flight per process; further requests wait for a free slot
+CHAT_MAX_WORKERS = int(os.getenv("CHAT_MAX_WORKERS", "32"))
+
+system_prompt = """You are 'Potato Doc', an expert agricultural AI assistant specializing in potato crops.
+Your goal is to help farmers and users diagnose diseases, suggest treatments, and provide advice on potato farming.
+
+Traits:
+- Professional yet accessible.
+- Highly knowledgeable about Early Blight, Late Blight, and general crop health.
+- Concise and conversational. Speak naturally like a human expert, not a robot.
+- Avoid excessive bulleted lists. Use paragraphs and natural language to explain things briefly.
+- Only use lists if describing a strict step-by-step process.
+
+If a context is provided (e.g., "Early Blight detected"), tailor your advice specifically to that diagnosis.
+If the user asks about something unrelated to agriculture or potatoes, politely steer them back to the topic.
+"""
+
+_model = None
+_executor = None
+_lock = threading.Lock()
+
+
+def get_model():
+    """Return the process-wide GenerativeModel, configuring the SDK on first use.
+
+    The SDK keeps a single gRPC client per process, so every request shares its
+    connection pool instead of re-configuring and rebuilding a model per call.
+    """
+    global _model
+    if _model is None:
+        with _lock:
+            if _model is None:
+                api_key = os.getenv("GOOGLE_API_KEY")
+                if not api_key:
+                    raise ValueError("GOOGLE_API_KEY environment variable is not set")
+                import google.generativeai as genai
+                genai.configure(api_key=api_key)
+                _model = genai.GenerativeModel(model_name=MODEL_NAME, generation_config=generation_config,
+                                               system_instruction=system_prompt)
+    return _model
+
+
+def warm_up():
+    """Import and configure the SDK ahead of the first chat (meant for a background thread)."""
+    try:
+        get_model()
+    except Exception as e:
+        print(f"Gemini warm-up skipped: {e}")
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=CHAT_MAX_WORKERS, thread_name_prefix="gemini")
+    return _executor
+
+
+def build_user_message(message, context=None):
+    if context:
+        return f"[Context: Current scan detected {context}] User Question: {message}"
+    return message
+
+
+def complete(message, context=None, history=None):
+    """Blocking chat completion; returns the reply text.
+
+    `history` holds earlier turns as {"role": "user"|"model", "parts": [text]};
+    the system prompt is sent as the model's system instruction, not as a turn.
+    """
+    chat = get_model().start_chat(history=history or [])
+    response = chat.send_message(build_user_message(message, context))
+    return response.text
+
+
+def stream(message, context=None, history=None):
+    """Blocking generator over reply text chunks as the model produces them."""
+    chat = get_model().start_chat(history=history or [])
+    response = chat.send_message(build_user_message(message, context), stream=True)
+    for chunk in response:
+        if chunk.text:
+            yield chunk.text
+
+
+async def complete_async(message, context=None, history=None):
+    """Run complete() on the bounded Gemini pool so the event loop is never blocked."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), complete, message, context, history)
+
+
+async def stream_async(message, context=None, history=None):
+    """Async generator over stream(), pumped from the bounded Gemini pool."""
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    done = object()
+    stop = threading.Event()
+
+    def pump():
+        try:
+            for text in stream(message, context, history):
+                if stop.is_set():
+                    break
+                loop.call_soon_threadsafe(queue.put_nowait, text)
+        except Exception as e:
+            loop.call_soon_threadsafe(queue.put_nowait, e)
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, done)
+
+    producer = loop.run_in_executor(get_executor(), pump)
+    try:
+        while True:
+            item = await queue.get()
+            if item is done:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # Client went away or we are done: let the worker thread wind down
+        stop.set()
+        await producer
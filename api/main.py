@@ -1,29 +1,149 @@
 import sys
 
-from fastapi import FastAPI, HTTPException
+import asyncio
+import functools
+import json
+import os
+import time
+import traceback
+import zipfile
+from contextlib import asynccontextmanager, nullcontext
+from fastapi import FastAPI, File, Form, Header, HTTPException, Request, UploadFile
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-import uvicorn
-import google.generativeai as genai
-import os
 from dotenv import load_dotenv
 from typing import Optional
 
+import admission
+import heatmaps
+import llm
+import metrics
+import registry
+from admission import AdmissionMiddleware
+from batch_scan import MAX_IMAGE_BYTES, iter_items, ndjson, scan
+from chat_cache import ResponseCache, make_key
+from inference import MicroBatcher
+from metrics import MetricsMiddleware, mark_decoded, span
+from prediction_cache import PredictionCache, content_key, dhash
+from sessions import SessionStore
+
 load_dotenv()
 
-app = FastAPI()
+# Replies to repeated (context, message) pairs, shared by all chat routes
+response_cache = ResponseCache()
+
+# Severity results by upload hash, scoped to the fingerprint of the loaded model
+prediction_cache = PredictionCache()
+
+# Server-side conversation histories, addressed by the session_id returned with each reply
+sessions = SessionStore()
+
+# Heavy dependencies (the Gemini SDK, torch and the severity model) load on
+# first use so cold starts, /ping and / stay cheap. With a lifespan-aware
+# server they are also warmed in the background right after startup.
+PREDICT_PRELOAD = os.getenv("PREDICT_PRELOAD", "1") == "1"
+LLM_PREWARM = os.getenv("LLM_PREWARM", "1") == "1"
+
+# Micro-batchers by (model version, with heatmaps), each over that version's predictor
+batchers = {}
+
+# Results of non-default versions pinned for A/B comparison, memory only, one cache per version
+version_caches = {}
+
+
+def get_predictor(version=None):
+    """The predictor serving `version` (default if None); None if it cannot be served."""
+    return registry.models.get(version)
+
+
+def record_batch(version, size, seconds):
+    metrics.BATCH_SIZE.observe(size)
+    metrics.STAGE_SECONDS.observe(seconds, "model_forward")
+    registry.FORWARD_SECONDS.observe(seconds, version)
+
+
+async def load_model(version=None):
+    """The predictor for a requested version, or the HTTP error explaining why it cannot be served."""
+    try:
+        predictor = await run_in_threadpool(get_predictor, version)
+    except registry.UnknownVersion:
+        raise HTTPException(status_code=404, detail=f"Unknown model version: {version}")
+    if predictor is None:
+        raise HTTPException(status_code=503, detail="Prediction model is not loaded")
+    return predictor
+
 
-# Configure Gemini
-# Ensure you have GOOGLE_API_KEY in your .env file
-genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
-generation_config = {
-  "temperature": 0.7,
-  "top_p": 1,
-  "top_k": 1,
-  "max_output_tokens": 2048,
-}
+async def get_batcher(predictor, version, with_heatmaps=False):
+    """Return the micro-batcher over `predictor`, the current model of `version`.
 
-model = genai.GenerativeModel(model_name="gemini-2.5-flash-lite", generation_config=generation_config)
+    When a version's checkpoint was hot-swapped, the old batcher is drained in
+    the background: requests already queued on the old model finish there.
+    """
+    for key in [k for k in batchers if k[0] != version and not registry.models.is_resident(k[0])]:
+        asyncio.ensure_future(batchers.pop(key)[1].drain())   # Evicted
+    key = (version, with_heatmaps)
+    current = batchers.get(key)
+    if current is None or current[0] is not predictor:
+        predict_batch = functools.partial(predictor.predict_batch, heatmaps=True) if with_heatmaps \
+            else predictor.predict_batch
+        batcher = MicroBatcher(predict_batch, on_batch=functools.partial(record_batch, version))
+        await batcher.start()
+        batchers[key] = (predictor, batcher)
+        if current is not None:
+            asyncio.ensure_future(current[1].drain())
+    return batchers[key][1]
+
+
+def cache_for(version):
+    """Prediction cache for a version: the shared (optionally SQLite-backed) one for the default."""
+    version = registry.models.resolve(version)
+    if version == registry.models.default:
+        return prediction_cache
+    if version not in version_caches:
+        version_caches[version] = PredictionCache(db_path=None)
+    return version_caches[version]
+
+
+@asynccontextmanager
+async def lifespan(app):
+    warmups = []
+    if LLM_PREWARM:
+        warmups.append(asyncio.get_running_loop().run_in_executor(None, llm.warm_up))
+    if PREDICT_PRELOAD:
+        warmups.append(asyncio.ensure_future(run_in_threadpool(get_predictor)))
+    yield
+    for task in warmups:
+        task.cancel()
+    for _, running in batchers.values():
+        await running.stop()
+    batchers.clear()
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(AdmissionMiddleware)
+app.add_middleware(MetricsMiddleware)
+
+
+@app.exception_handler(admission.Rejected)
+async def admission_rejected(request: Request, error: admission.Rejected):
+    return JSONResponse({"detail": error.detail}, status_code=error.status,
+                        headers={"Retry-After": str(error.retry_after)})
+
+
+def cache_metrics():
+    stats = response_cache.stats()
+    lines = []
+    for name in ("hits", "misses", "coalesced", "evictions"):
+        lines += metrics.counter_lines(f"potato_chat_cache_{name}_total", f"Chat reply cache {name}.", stats[name])
+    lines += metrics.counter_lines("potato_chat_cache_entries", "Cached chat replies.", stats["entries"], "gauge")
+    stats = prediction_cache.stats()
+    for name in ("hits", "near_hits", "misses", "coalesced", "evictions"):
+        lines += metrics.counter_lines(f"potato_predict_cache_{name}_total", f"Prediction cache {name}.", stats[name])
+    lines += metrics.counter_lines("potato_predict_cache_entries", "Cached predictions.", stats["entries"], "gauge")
+    return lines
+
+metrics.register_collector(cache_metrics)
 
 origins = [
     "http://localhost",
@@ -42,41 +162,120 @@ app.add_middleware(
 class ChatRequest(BaseModel):
     message: str
     context: Optional[str] = None
+    stream: bool = False
+    session_id: Optional[str] = None
+
+async def open_session(request: ChatRequest):
+    """Return (session_id, history) for the request, starting a new session if needed."""
+    if request.session_id:
+        # SQLite-backed stores read from disk, so this stays off the event loop
+        return request.session_id, await run_in_threadpool(sessions.get, request.session_id)
+    return sessions.new_id(), []
+
+async def record_exchange(session_id, request: ChatRequest, reply):
+    await run_in_threadpool(sessions.append, session_id,
+                            llm.build_user_message(request.message, request.context), reply)
+
+async def complete_chat(request: ChatRequest, history, admitted=False):
+    async def upstream():
+        # A streamed reply falling back to this already holds its slot
+        async with nullcontext() if admitted else admission.slot("chat"):
+            with span("upstream_llm"):
+                return await llm.complete_async(request.message, request.context, history)
+
+    # Only opening questions are cached; later replies depend on the conversation so far
+    if history:
+        return await upstream()
+    key = make_key(request.context, request.message)
+    with span("cache_lookup"):
+        reply = response_cache.get_hit(key)
+    if reply is not None:
+        return reply
+    return await response_cache.compute_once(key, upstream)
+
+def encode_response(payload, headers=None):
+    with span("response_encode"):
+        return JSONResponse(payload, headers=headers)
+
+def encode_prediction(result, heatmap, status, version):
+    """A prediction as the client asked for it (heatmap None, "array" or "png"), with its cache status."""
+    with span("response_encode"):
+        return JSONResponse(heatmaps.shape(result, heatmap),
+                            headers={"X-Prediction-Cache": status, "X-Model-Version": version})
+
+def check_heatmap_format(heatmap):
+    try:
+        heatmaps.check_format(heatmap)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 async def process_chat(request: ChatRequest):
     """Shared chat processing logic"""
     try:
-        system_prompt = """You are 'Potato Doc', an expert agricultural AI assistant specializing in potato crops. 
-        Your goal is to help farmers and users diagnose diseases, suggest treatments, and provide advice on potato farming.
-        
-        Traits:
-        - Professional yet accessible.
-        - Highly knowledgeable about Early Blight, Late Blight, and general crop health.
-        - Concise and conversational. Speak naturally like a human expert, not a robot.
-        - Avoid excessive bulleted lists. Use paragraphs and natural language to explain things briefly.
-        - Only use lists if describing a strict step-by-step process.
-        
-        If a context is provided (e.g., "Early Blight detected"), tailor your advice specifically to that diagnosis.
-        If the user asks about something unrelated to agriculture or potatoes, politely steer them back to the topic.
-        """
-        
-        chat = model.start_chat(history=[
-            {"role": "user", "parts": [system_prompt]},
-            {"role": "model", "parts": ["Understood. I am Potato Doc, ready to assist with potato crop diagnostics and advice."]}
-        ])
-        
-        user_message = request.message
-        if request.context:
-            user_message = f"[Context: Current scan detected {request.context}] User Question: {request.message}"
-            
-        response = chat.send_message(user_message)
-        return {"response": response.text}
+        session_id, history = await open_session(request)
+        reply = await complete_chat(request, history)
+        await record_exchange(session_id, request, reply)
+        return encode_response({"response": reply, "session_id": session_id})
+    except admission.Rejected:
+        raise
     except Exception as e:
-        import traceback
         traceback.print_exc()
         print(f"Error in chat endpoint: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+def sse_event(data, event=None):
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+async def stream_chat(request: ChatRequest):
+    """Server-sent events: one `data: {"text": ...}` per chunk, then `event: done` with the full reply."""
+    session_id, history = await open_session(request)
+    key = make_key(request.context, request.message)
+    with span("cache_lookup"):
+        cached = None if history else response_cache.lookup(key)
+    if cached is None:
+        # Admitted (or refused with a status code) before the stream starts
+        await admission.hold("chat")
+
+    async def events():
+        reply = cached
+        if reply is not None:
+            yield sse_event({"text": reply})
+        else:
+            parts = []
+            start = time.perf_counter()
+            try:
+                async for text in llm.stream_async(request.message, request.context, history):
+                    if not parts:
+                        metrics.observe_stage("upstream_first_token", time.perf_counter() - start)
+                    parts.append(text)
+                    yield sse_event({"text": text})
+                metrics.observe_stage("upstream_llm", time.perf_counter() - start)
+                reply = "".join(parts)
+                if not history:
+                    response_cache.put(key, reply)
+            except Exception as e:
+                traceback.print_exc()
+                if parts:
+                    yield sse_event({"detail": str(e)}, event="error")
+                    return
+                # Nothing sent yet: fall back to a regular completion delivered as one chunk
+                try:
+                    reply = await complete_chat(request, history, admitted=True)
+                except Exception as e:
+                    yield sse_event({"detail": str(e)}, event="error")
+                    return
+                yield sse_event({"text": reply})
+
+        await record_exchange(session_id, request, reply)
+        yield sse_event({"response": reply, "session_id": session_id}, event="done")
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def wants_stream(request: ChatRequest, http_request: Request):
+    return request.stream or "text/event-stream" in http_request.headers.get("accept", "")
+
 @app.get("/")
 async def root():
     return {"message": "Potato Doc API", "status": "online"}
@@ -90,16 +289,152 @@ async def ping():
     return {"message": "Hello, I am alive"}
 
 @app.post("/chat")
-async def chat(request: ChatRequest):
+async def chat(request: ChatRequest, http_request: Request):
+    mark_decoded()
+    if wants_stream(request, http_request):
+        return await stream_chat(request)
     return await process_chat(request)
 
 @app.post("/api/chat")
-async def api_chat(request: ChatRequest):
+async def api_chat(request: ChatRequest, http_request: Request):
+    mark_decoded()
+    if wants_stream(request, http_request):
+        return await stream_chat(request)
     return await process_chat(request)
 
+@app.get("/api/chat/cache")
+async def api_chat_cache():
+    return response_cache.stats()
+
+@app.get("/api/predict/cache")
+async def api_predict_cache():
+    return prediction_cache.stats()
+
+@app.get("/api/admission")
+async def api_admission():
+    return admission.stats()
+
+@app.get("/api/models")
+async def api_models():
+    return await run_in_threadpool(registry.models.stats)
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.post("/api/predict")
+async def api_predict(file: UploadFile = File(...), heatmap: Optional[str] = None, version: Optional[str] = None,
+                      version_header: Optional[str] = Header(None, alias="X-Model-Version")):
+    """Score one image. `?heatmap=array` adds the 7x7 CAM (0-255) and `?heatmap=png` a 224x224 overlay.
+
+    `?version=` (or an X-Model-Version header) pins a model version from GET /api/models.
+    """
+    start = time.perf_counter()
+    check_heatmap_format(heatmap)
+    # One byte past the limit is enough to tell, without holding an oversized upload in memory
+    data = await file.read(MAX_IMAGE_BYTES + 1)
+    if len(data) > MAX_IMAGE_BYTES:
+        raise HTTPException(status_code=413, detail=f"Image is larger than {MAX_IMAGE_BYTES} bytes")
+    mark_decoded()
+
+    version = version or version_header
+    with span("model_load"):   # Only takes time for a cold or swapped version
+        predictor = await load_model(version)
+        version = registry.models.resolve(version)
+        predict_batcher = await get_batcher(predictor, version, heatmap is not None)
+
+    cache = cache_for(version)
+    fingerprint = getattr(predictor, "fingerprint", None)
+    cache.bind(fingerprint)
+    accept = heatmaps.has_heatmap if heatmap else None
+
+    def respond(result, status):
+        response = encode_prediction(result, heatmap, status, version)
+        registry.PREDICT_SECONDS.observe(time.perf_counter() - start, version)
+        return response
+
+    # Re-uploads and client retries of the same photo skip the model entirely
+    with span("cache_lookup"):
+        sha = await run_in_threadpool(content_key, data)
+        cached = cache.get(sha, accept)
+    if cached is not None:
+        return respond(cached, "hit")
+
+    async def score():
+        async with admission.slot("predict"):
+            try:
+                with span("image_decode"):
+                    image = await run_in_threadpool(predictor.decode, data)
+            except Exception as e:
+                raise HTTPException(status_code=400, detail=f"Could not read image: {e}")
+
+            phash = None
+            if cache.near_enabled:
+                with span("cache_lookup"):
+                    phash = await run_in_threadpool(dhash, image)
+                    near = cache.get_near(phash, accept)
+                if near is not None:
+                    cache.put(sha, near, phash, fingerprint)
+                    return near, "near-hit"
+
+            with span("preprocess"):
+                tensor = await run_in_threadpool(predictor.preprocess, image)
+            # Queue wait plus this request's share of the batched forward
+            with span("inference"):
+                result = await predict_batcher.submit(tensor)
+            cache.put(sha, result, phash, fingerprint)
+            return result, "miss"
+
+    # Heatmap requests may need a different forward, so they only join each other
+    key = f"{sha}:heatmap" if heatmap else sha
+    result, status = await cache.compute_once(key, score)
+    return respond(result, status)
+
+
+@app.post("/api/predict/batch")
+async def api_predict_batch(files: list[UploadFile] = File(...), plot: Optional[str] = Form(None),
+                            heatmap: Optional[str] = None, version: Optional[str] = None,
+                            version_header: Optional[str] = Header(None, alias="X-Model-Version")):
+    """Score many images (and/or zips of images) and stream one NDJSON line per image.
+
+    Lines arrive as each batch finishes, followed by one "summary" line per
+    plot. Zip members are grouped into plots by their top-level folder unless
+    a `plot` form field is given. `?heatmap=` and `?version=` work as for /api/predict.
+    """
+    check_heatmap_format(heatmap)
+    mark_decoded()
+    version = version or version_header
+    with span("model_load"):
+        predictor = await load_model(version)
+        version = registry.models.resolve(version)
+
+    cache = cache_for(version)
+    cache.bind(getattr(predictor, "fingerprint", None))
+    try:
+        items = list(iter_items(files, plot))
+    except (ValueError, zipfile.BadZipFile) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    await admission.hold("batch")
+
+    async def lines():
+        try:
+            async for record in scan(predictor, items, on_batch=functools.partial(record_batch, version), cache=cache,
+                                     heatmaps=heatmap is not None):
+                if heatmap == "png":
+                    record = await run_in_threadpool(heatmaps.shape, record, heatmap)
+                else:
+                    record = heatmaps.shape(record, heatmap)
+                yield ndjson(record)
+        except Exception as e:
+            traceback.print_exc()
+            yield ndjson({"type": "error", "error": str(e)})
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson", headers={"X-Model-Version": version})
+
 # Handler for Vercel serverless - must be named 'app'
 handler = app
 
 if __name__ == "__main__":
+    import uvicorn
     uvicorn.run(app, host='localhost', port=8000)
 
@@ -0,0 +1,159 @@
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Requests slower than this are printed with their per-stage breakdown (0 disables)
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "2000"))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """Prometheus-style cumulative histogram with one series per label set."""
+
+    def __init__(self, name, help_text, label_names, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self.series = {}   # label values -> [bucket counts..., sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            items = sorted(self.series.items())
+        for label_values, series in items:
+            labels = ",".join(f'{k}="{v}"' for k, v in zip(self.label_names, label_values))
+            sep = "," if labels else ""
+            for bound, count in zip(self.buckets, series):
+                lines.append(f'{self.name}_bucket{{{labels}{sep}le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{labels}{sep}le="+Inf"}} {series[-1]}')
+            suffix = f"{{{labels}}}" if labels else ""
+            lines.append(f"{self.name}_sum{suffix} {series[-2]:.6f}")
+            lines.append(f"{self.name}_count{suffix} {series[-1]}")
+        return lines
+
+
+REQUEST_SECONDS = Histogram("potato_request_seconds", "End-to-end request latency.",
+                            ["method", "route", "status"])
+STAGE_SECONDS = Histogram("potato_stage_seconds", "Time spent in each request stage.", ["stage"])
+BATCH_SIZE = Histogram("potato_predict_batch_size", "Images per batched model forward.", [],
+                       buckets=(1, 2, 4, 8, 16, 32, 64))
+
+_histograms = [REQUEST_SECONDS, STAGE_SECONDS, BATCH_SIZE]
+_collectors = []
+_current = contextvars.ContextVar("potato_request", default=None)
+
+
+def register(histogram):
+    _histograms.append(histogram)
+    return histogram
+
+
+def register_collector(collect):
+    """Add a callable returning extra exposition lines (e.g. counters owned by another module)."""
+    _collectors.append(collect)
+
+
+def counter_lines(name, help_text, value, kind="counter"):
+    return [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {value}"]
+
+
+def render():
+    lines = []
+    for histogram in _histograms:
+        lines.extend(histogram.render())
+    for collect in _collectors:
+        lines.extend(collect())
+    return "\n".join(lines) + "\n"
+
+
+class RequestRecord:
+    def __init__(self, method, route):
+        self.method = method
+        self.route = route
+        self.status = 500
+        self.start = time.perf_counter()
+        self.stages = {}
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+
+def observe_stage(stage, seconds):
+    STAGE_SECONDS.observe(seconds, stage)
+    record = _current.get()
+    if record is not None:
+        record.add(stage, seconds)
+
+
+@contextmanager
+def span(stage):
+    """Time a block as `stage`, both in the histogram and the current request's breakdown."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
+
+
+def mark_decoded():
+    """Record the time from request arrival until the handler got its parsed arguments."""
+    record = _current.get()
+    if record is not None and "request_decode" not in record.stages:
+        observe_stage("request_decode", time.perf_counter() - record.start)
+
+
+@contextmanager
+def track_request(method, route):
+    record = RequestRecord(method, route)
+    token = _current.set(record)
+    try:
+        yield record
+    finally:
+        _current.reset(token)
+        elapsed = time.perf_counter() - record.start
+        REQUEST_SECONDS.observe(elapsed, record.method, record.route, str(record.status))
+        if SLOW_REQUEST_MS and elapsed * 1000 >= SLOW_REQUEST_MS:
+            breakdown = ", ".join(f"{k}={v * 1000:.0f}ms" for k, v in record.stages.items())
+            print(f"Slow request: {record.method} {record.route} {record.status} "
+                  f"{elapsed * 1000:.0f} ms [{breakdown or 'no stages'}]")
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing each HTTP request until its last body chunk is sent."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        with track_request(scope["method"], "unmatched") as record:
+            async def send_with_status(message):
+                if message["type"] == "http.response.start":
+                    record.status = message["status"]
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_with_status)
+            finally:
+                route = scope.get("route")
+                if route is not None and hasattr(route, "path"):
+                    record.route = route.path
@@ -0,0 +1,225 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+PREDICT_CACHE_MAX_ENTRIES = int(os.getenv("PREDICT_CACHE_MAX_ENTRIES", "4096"))   # 0 disables caching
+PREDICT_CACHE_DB = os.getenv("PREDICT_CACHE_DB")   # Optional SQLite file that keeps results across restarts
+# Near-duplicate tier: uploads whose 64-bit difference hash is within this many
+# bits of an entry in the memory tier reuse its result (recompressed or resized
+# copies). -1 disables it.
+PREDICT_CACHE_PHASH_DISTANCE = int(os.getenv("PREDICT_CACHE_PHASH_DISTANCE", "-1"))
+
+
+def content_key(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def dhash(image):
+    """64-bit difference hash of a PIL image: one bit per horizontally adjacent pixel pair of a 9x8 thumbnail."""
+    from PIL import Image
+
+    pixels = list(image.convert("L").resize((9, 8), Image.BILINEAR).getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return bits
+
+
+def hamming(a, b):
+    """Number of differing bits (int.bit_count() needs Python 3.10)."""
+    return bin(a ^ b).count("1")
+
+
+def phash_bands(distance):
+    """(shift, mask) of distance + 1 disjoint slices of a 64-bit hash.
+
+    Two hashes at most `distance` bits apart agree exactly on at least one
+    slice (pigeonhole), so only entries sharing a slice need comparing.
+    """
+    count = distance + 1
+    bands, shift = [], 0
+    for i in range(count):
+        width = 64 // count + (i < 64 % count)
+        bands.append((shift, (1 << width) - 1))
+        shift += width
+    return bands
+
+
+class PredictionCache:
+    """Prediction results by upload SHA-256: in-memory LRU, optionally written through to SQLite.
+
+    Every entry belongs to the model fingerprint it was computed with. bind()
+    is called with the fingerprint of the model being served; when it changes,
+    the memory tier is dropped and disk rows of other models stop matching
+    (and are deleted), so a new checkpoint never serves old results.
+    """
+
+    def __init__(self, max_entries=PREDICT_CACHE_MAX_ENTRIES, db_path=PREDICT_CACHE_DB,
+                 phash_distance=PREDICT_CACHE_PHASH_DISTANCE):
+        self.max_entries = max_entries
+        self.phash_distance = phash_distance
+        self.fingerprint = None
+        self.entries = OrderedDict()   # sha256 -> (result, phash)
+        # Near-duplicate index: per band, slice value -> shas whose phash has it
+        self.bands = phash_bands(phash_distance) if 0 <= phash_distance < 64 else []
+        self.buckets = [{} for _ in self.bands]
+        self.inflight = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.db = None
+        if db_path:
+            self.db = sqlite3.connect(db_path, check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS predictions (sha256 TEXT PRIMARY KEY, fingerprint TEXT NOT NULL, "
+                "phash TEXT, result TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            self.db.commit()
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    @property
+    def near_enabled(self):
+        return self.enabled and self.phash_distance >= 0
+
+    def bind(self, fingerprint):
+        """Serve entries computed by the model with this fingerprint only."""
+        with self.lock:
+            if fingerprint == self.fingerprint:
+                return
+            self.fingerprint = fingerprint
+            self.entries.clear()
+            self.buckets = [{} for _ in self.bands]
+            if self.db is not None:
+                self.db.execute("DELETE FROM predictions WHERE fingerprint != ?", (str(fingerprint),))
+                self.db.commit()
+
+    def get(self, sha, accept=None):
+        """Cached result for exact content, counting a hit (misses are counted by compute_once).
+
+        With `accept`, entries it rejects (e.g. stored without a heatmap) are treated as absent.
+        """
+        if not self.enabled:
+            return None
+        with self.lock:
+            entry = self.entries.get(sha)
+            if entry is None and self.db is not None:
+                row = self.db.execute("SELECT result, phash FROM predictions WHERE sha256 = ? AND fingerprint = ?",
+                                      (sha, str(self.fingerprint))).fetchone()
+                if row is not None:
+                    entry = (json.loads(row[0]), int(row[1], 16) if row[1] else None)
+                    self._remember(sha, entry)
+            if entry is None or (accept is not None and not accept(entry[0])):
+                return None
+            self.entries.move_to_end(sha)
+            self.hits += 1
+            return entry[0]
+
+    def get_near(self, phash, accept=None):
+        """Result of the closest cached image within phash_distance bits (and passing `accept`), or None."""
+        if not self.near_enabled or phash is None:
+            return None
+        with self.lock:
+            best, best_distance = None, self.phash_distance + 1
+            for sha in self._candidates(phash):
+                result, other = self.entries[sha]
+                if accept is not None and not accept(result):
+                    continue
+                distance = hamming(phash, other)
+                if distance < best_distance:
+                    best, best_distance = sha, distance
+            if best is None:
+                return None
+            self.entries.move_to_end(best)
+            self.near_hits += 1
+            return self.entries[best][0]
+
+    def put(self, sha, result, phash=None, fingerprint=None):
+        """Store a result computed by the model with `fingerprint` (ignored if that is no longer bound)."""
+        if not self.enabled:
+            return
+        with self.lock:
+            if fingerprint is not None and fingerprint != self.fingerprint:
+                return
+            self._remember(sha, (result, phash))
+            if self.db is not None:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO predictions (sha256, fingerprint, phash, result, created) VALUES (?, ?, ?, ?, ?)",
+                    (sha, str(self.fingerprint), f"{phash:016x}" if phash is not None else None,
+                     json.dumps(result), time.time()),
+                )
+                self.db.commit()
+
+    def _candidates(self, phash):
+        """Shas sharing at least one band with phash (called with the lock held)."""
+        if not self.bands:
+            return [sha for sha, (_, other) in self.entries.items() if other is not None]
+        found = set()
+        for (shift, mask), buckets in zip(self.bands, self.buckets):
+            found.update(buckets.get((phash >> shift) & mask, ()))
+        return found
+
+    def _index(self, sha, phash, add):
+        if phash is None:
+            return
+        for (shift, mask), buckets in zip(self.bands, self.buckets):
+            key = (phash >> shift) & mask
+            if add:
+                buckets.setdefault(key, set()).add(sha)
+            else:
+                bucket = buckets.get(key)
+                if bucket is not None:
+                    bucket.discard(sha)
+                    if not bucket:
+                        del buckets[key]
+
+    def _remember(self, sha, entry):
+        old = self.entries.get(sha)
+        if old is not None:
+            self._index(sha, old[1], add=False)
+        self.entries[sha] = entry
+        self.entries.move_to_end(sha)
+        self._index(sha, entry[1], add=True)
+        while len(self.entries) > self.max_entries:
+            evicted, (_, phash) = self.entries.popitem(last=False)
+            self._index(evicted, phash, add=False)
+            self.evictions += 1
+
+    def record_miss(self):
+        """Count a miss for callers that score uploads themselves instead of through compute_once."""
+        with self.lock:
+            self.misses += 1
+
+    async def compute_once(self, sha, compute):
+        """Await compute() for an upload, joining an identical upload that is already being scored."""
+        task = self.inflight.get(sha)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = asyncio.ensure_future(compute())
+            self.inflight[sha] = task
+            task.add_done_callback(lambda t: self.inflight.pop(sha, None))
+        return await asyncio.shield(task)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "near_hits": self.near_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+            "fingerprint": self.fingerprint,
+        }
@@ -0,0 +1,273 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+from metrics import Histogram
+
+# Model versions found on disk, loaded on first request and kept resident up to
+# MODEL_MAX_RESIDENT models / MODEL_MAX_CHECKPOINT_MB of checkpoint files
+# (least recently used go first). Requests pick a version with ?version= or X-Model-Version; everything
+# else is served by MODEL_DEFAULT_VERSION.
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODELS_DIR = os.getenv("MODELS_DIR", os.path.join(REPO_ROOT, "models"))
+DEFAULT_VERSION = os.getenv("MODEL_DEFAULT_VERSION", "severity")
+MAX_RESIDENT = int(os.getenv("MODEL_MAX_RESIDENT", "3"))
+# Budget on the checkpoint files' size on disk, not measured process memory
+MAX_CHECKPOINT_MB = float(os.getenv("MODEL_MAX_CHECKPOINT_MB", "1024"))
+# Resident models are re-checked on disk this often; a changed file is loaded in
+# the background and swapped in once it has not been modified for SETTLE_SECONDS
+# (the training scripts write checkpoints in place).
+CHECK_SECONDS = float(os.getenv("MODEL_CHECK_SECONDS", "5"))
+SETTLE_SECONDS = 2.0
+
+FORWARD_SECONDS = metrics.register(Histogram("potato_model_forward_seconds",
+                                             "Batched model forward time per model version.", ["version"]))
+PREDICT_SECONDS = metrics.register(Histogram("potato_model_predict_seconds",
+                                             "Time to answer /api/predict per model version.", ["version"]))
+
+
+class UnknownVersion(KeyError):
+    pass
+
+
+def discover(root=MODELS_DIR):
+    """Servable versions on disk: {version: (kind, path)}.
+
+    "severity" is the dual-head checkpoint (SEVERITY_MODEL_PATH), "classifier"
+    is best_classifier.pth and every numbered folder with a model.keras is a
+    Keras version ("1", "3", "5").
+    """
+    from inference import MODEL_PATH
+
+    versions = {}
+    if os.path.exists(MODEL_PATH):
+        versions["severity"] = ("severity", MODEL_PATH)
+    if os.path.exists(os.path.join(root, "best_classifier.pth")):
+        versions["classifier"] = ("classifier", os.path.join(root, "best_classifier.pth"))
+    if os.path.isdir(root):
+        for name in sorted(os.listdir(root)):
+            path = os.path.join(root, name, "model.keras")
+            if name.isdigit() and os.path.exists(path):
+                versions[name] = ("keras", path)
+    return versions
+
+
+def load_version(kind, path):
+    """Load one version, or return None if it cannot be served here (missing runtime, corrupt file)."""
+    import inference
+
+    try:
+        if kind == "severity":
+            return inference.load_predictor(path)   # Exported artifacts and the cascade apply as configured
+        if kind == "classifier":
+            return inference.ClassifierPredictor(path)
+        return inference.KerasPredictor(path)
+    except ImportError as e:
+        print(f"Model {path} disabled: {e}")
+    except Exception as e:
+        print(f"Model {path} failed to load: {e}")
+    return None
+
+
+def file_stamp(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class Resident:
+    """A loaded version and the file state it was loaded from."""
+
+    def __init__(self, version, predictor, path=None, stamp=None, pinned=False):
+        self.version = version
+        self.predictor = predictor
+        self.path = path
+        self.stamp = stamp
+        self.pinned = pinned      # Installed by hand: never evicted or reloaded
+        self.checkpoint_mb = os.path.getsize(path) / 1e6 if path else 0.0
+        self.loaded_at = time.time()
+        self.checked = time.monotonic()
+        self.swapping = False
+        self.failed_stamp = None
+
+
+class ModelRegistry:
+    """Lazily loaded, LRU-evicted, hot-swapped model versions.
+
+    get() hands out the current predictor object of a version. A swap only
+    replaces that reference once the new checkpoint is fully loaded, so
+    requests already holding the old predictor finish on it.
+    """
+
+    def __init__(self, root=MODELS_DIR, default=DEFAULT_VERSION, max_resident=MAX_RESIDENT,
+                 max_checkpoint_mb=MAX_CHECKPOINT_MB, loader=load_version, check_seconds=CHECK_SECONDS):
+        self.root = root
+        self.default = default
+        self.max_resident = max(1, max_resident)
+        self.max_checkpoint_mb = max_checkpoint_mb
+        self.loader = loader
+        self.check_seconds = check_seconds
+        self.resident = OrderedDict()   # version -> Resident, least recently used first
+        self.failed = {}                # version -> file stamp that could not be loaded
+        self.counts = {}                # version -> {"requests", "loads", "evictions", "swaps"}
+        self.lock = threading.Lock()
+        self.load_locks = {}
+
+    def resolve(self, version=None):
+        return version or self.default
+
+    def _count(self, version, name):
+        counts = self.counts.setdefault(version, {"requests": 0, "loads": 0, "evictions": 0, "swaps": 0})
+        counts[name] += 1
+
+    def get(self, version=None):
+        """The predictor serving `version` (default if None), loading it if needed.
+
+        Returns None if the version exists but cannot be served (or the default
+        is not on disk); raises UnknownVersion for any other missing version.
+        """
+        version = self.resolve(version)
+        with self.lock:
+            entry = self.resident.get(version)
+            if entry is not None:
+                self.resident.move_to_end(version)
+                self._count(version, "requests")
+                self._maybe_swap(entry)
+                return entry.predictor
+
+        spec = discover(self.root).get(version)
+        if spec is None:
+            if version == self.default:
+                return None
+            raise UnknownVersion(version)
+        with self.lock:
+            load_lock = self.load_locks.setdefault(version, threading.Lock())
+        with load_lock:
+            with self.lock:
+                entry = self.resident.get(version)
+                if entry is not None:
+                    self._count(version, "requests")
+                    return entry.predictor
+            kind, path = spec
+            stamp = file_stamp(path)
+            if self.failed.get(version) == stamp:
+                return None
+            try:
+                predictor = self.loader(kind, path)
+            except Exception as e:
+                # Not retried until the file changes (a half-written checkpoint is replaced in place)
+                print(f"Model {version}: loading {path} failed: {e}")
+                predictor = None
+            with self.lock:
+                self._count(version, "requests")
+                if predictor is None:
+                    self.failed[version] = stamp
+                    return None
+                self._count(version, "loads")
+                self._admit(Resident(version, predictor, path, stamp))
+            return predictor
+
+    def install(self, version, predictor):
+        """Serve an already built predictor as `version` (benchmarks and tests)."""
+        with self.lock:
+            self.resident[version] = Resident(version, predictor, pinned=True)
+
+    def _admit(self, entry):
+        self.resident[entry.version] = entry
+        self.resident.move_to_end(entry.version)
+        while len(self.resident) > 1:
+            total_mb = sum(e.checkpoint_mb for e in self.resident.values())
+            if len(self.resident) <= self.max_resident and total_mb <= self.max_checkpoint_mb:
+                break
+            victim = next((e for e in self.resident.values() if not e.pinned and e is not entry), None)
+            if victim is None:
+                break
+            del self.resident[victim.version]
+            self._count(victim.version, "evictions")
+            print(f"Model {victim.version} evicted ({len(self.resident)} resident, {total_mb:.0f} MB of checkpoints before)")
+
+    def _maybe_swap(self, entry):
+        """Start a background reload if the version's file changed (called with the lock held)."""
+        now = time.monotonic()
+        if entry.pinned or entry.swapping or now - entry.checked < self.check_seconds:
+            return
+        entry.checked = now
+        stamp = file_stamp(entry.path)
+        if stamp is None or stamp == entry.stamp or stamp == entry.failed_stamp:
+            return
+        if time.time() - stamp[0] / 1e9 < SETTLE_SECONDS:
+            return   # Still being written; look again on a later request
+        entry.swapping = True
+        threading.Thread(target=self._swap, args=(entry, stamp), daemon=True).start()
+
+    def _swap(self, entry, stamp):
+        kind, path = discover(self.root).get(entry.version, (None, entry.path))
+        try:
+            predictor = self.loader(kind, path) if kind else None
+        except Exception as e:
+            print(f"Model {entry.version}: reloading {path} failed: {e}")
+            predictor = None
+        with self.lock:
+            entry.swapping = False
+            if predictor is None:
+                entry.failed_stamp = stamp
+                return
+            if self.resident.get(entry.version) is not entry:
+                return   # Evicted while loading
+            swapped = Resident(entry.version, predictor, path, stamp)
+            self.resident[entry.version] = swapped
+            self._count(entry.version, "swaps")
+        print(f"Model {entry.version}: swapped in new {os.path.basename(path)}")
+
+    def is_resident(self, version):
+        with self.lock:
+            return self.resolve(version) in self.resident
+
+    def stats(self):
+        with self.lock:
+            resident = {v: e for v, e in self.resident.items()}
+            counts = {v: dict(c) for v, c in self.counts.items()}
+        versions = {}
+        for version, (kind, path) in discover(self.root).items():
+            versions[version] = {"kind": kind, "path": os.path.relpath(path, REPO_ROOT)}
+        for version in resident:
+            versions.setdefault(version, {"kind": "installed", "path": None})
+        for version, info in versions.items():
+            entry = resident.get(version)
+            info["resident"] = entry is not None
+            info["default"] = version == self.default
+            if entry is not None:
+                info["checkpoint_mb"] = round(entry.checkpoint_mb, 1)
+                info["loaded_at"] = entry.loaded_at
+                info["fingerprint"] = getattr(entry.predictor, "fingerprint", None)
+            info.update(counts.get(version, {"requests": 0, "loads": 0, "evictions": 0, "swaps": 0}))
+        return {
+            "default": self.default,
+            "max_resident": self.max_resident,
+            "max_checkpoint_mb": self.max_checkpoint_mb,
+            "resident_checkpoint_mb": round(sum(e.checkpoint_mb for e in resident.values()), 1),
+            "versions": versions,
+        }
+
+    def metric_lines(self):
+        stats = self.stats()
+        lines = metrics.counter_lines("potato_models_resident", "Model versions currently loaded.",
+                                      sum(v["resident"] for v in stats["versions"].values()), "gauge")
+        for name in ("requests", "loads", "evictions", "swaps"):
+            metric = f"potato_model_{name}_total"
+            lines += [f"# HELP {metric} Model registry {name} per version.", f"# TYPE {metric} counter"]
+            lines += [f'{metric}{{version="{v}"}} {info[name]}' for v, info in sorted(stats["versions"].items())]
+        return lines
+
+
+models = ModelRegistry()
+
+
+def metric_lines():
+    return models.metric_lines()
+
+metrics.register_collector(metric_lines)
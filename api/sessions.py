@@ -0,0 +1,98 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+CHAT_MAX_SESSIONS = int(os.getenv("CHAT_MAX_SESSIONS", "10000"))
+CHAT_HISTORY_TOKEN_BUDGET = int(os.getenv("CHAT_HISTORY_TOKEN_BUDGET", "2000"))
+CHAT_SESSION_DB = os.getenv("CHAT_SESSION_DB")   # Optional SQLite file that keeps sessions across restarts
+
+
+def estimate_tokens(text):
+    """Rough token count (~4 characters per token) that needs no upstream call."""
+    return len(text) // 4 + 1
+
+
+def trim_history(history, budget=CHAT_HISTORY_TOKEN_BUDGET):
+    """Keep the newest turns that fit in budget, starting on a user turn."""
+    kept, used = [], 0
+    for turn in reversed(history):
+        cost = sum(estimate_tokens(part) for part in turn["parts"])
+        if used + cost > budget:
+            break
+        kept.append(turn)
+        used += cost
+    kept.reverse()
+    while kept and kept[0]["role"] != "user":
+        kept.pop(0)
+    return kept
+
+
+class SessionStore:
+    """Chat histories by session id: in-memory LRU, optionally written through to SQLite.
+
+    Histories are stored already trimmed to the token budget, so the prompt
+    sent upstream stays bounded however long a conversation runs.
+    """
+
+    def __init__(self, max_sessions=CHAT_MAX_SESSIONS, token_budget=CHAT_HISTORY_TOKEN_BUDGET, db_path=CHAT_SESSION_DB):
+        self.max_sessions = max_sessions
+        self.token_budget = token_budget
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+        self.db = None
+        if db_path:
+            self.db = sqlite3.connect(db_path, check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, history TEXT NOT NULL, updated REAL NOT NULL)"
+            )
+            self.db.commit()
+
+    @staticmethod
+    def new_id():
+        return uuid.uuid4().hex
+
+    def get(self, session_id):
+        """Return a copy of the session's history ([] for unknown ids)."""
+        with self.lock:
+            history = self.sessions.get(session_id)
+            if history is not None:
+                self.sessions.move_to_end(session_id)
+                return list(history)
+            if self.db is None:
+                return []
+            row = self.db.execute("SELECT history FROM sessions WHERE id = ?", (session_id,)).fetchone()
+            if row is None:
+                return []
+            history = json.loads(row[0])
+            self._remember(session_id, history)
+            return list(history)
+
+    def append(self, session_id, user_message, reply):
+        """Record one exchange and trim the session to the token budget."""
+        with self.lock:
+            history = self.sessions.get(session_id)
+            if history is None and self.db is not None:
+                row = self.db.execute("SELECT history FROM sessions WHERE id = ?", (session_id,)).fetchone()
+                history = json.loads(row[0]) if row else None
+            history = list(history or []) + [
+                {"role": "user", "parts": [user_message]},
+                {"role": "model", "parts": [reply]},
+            ]
+            history = trim_history(history, self.token_budget)
+            self._remember(session_id, history)
+            if self.db is not None:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO sessions (id, history, updated) VALUES (?, ?, ?)",
+                    (session_id, json.dumps(history), time.time()),
+                )
+                self.db.commit()
+
+    def _remember(self, session_id, history):
+        self.sessions[session_id] = history
+        self.sessions.move_to_end(session_id)
+        while len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
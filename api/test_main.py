@@ -1,5 +1,26 @@
+import asyncio
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+import zipfile
+
+import httpx
 from fastapi.testclient import TestClient
+
+import admission
+import cascade
+import llm
+import main
+import registry
+from batch_scan import ScanItem, scan
+from chat_cache import ResponseCache, make_key
+from inference import MicroBatcher
 from main import app
+from prediction_cache import PredictionCache
+from sessions import SessionStore, trim_history
 
 client = TestClient(app)
 
@@ -12,3 +33,507 @@ def test_ping():
     response = client.get("/ping")
     assert response.status_code == 200
     assert response.json() == {"message": "Hello, I am alive"}
+
+def test_predict_without_model():
+    response = client.post("/api/predict", files={"file": ("leaf.jpg", b"not an image", "image/jpeg")})
+    assert response.status_code == 503
+
+def test_predict_rejects_oversized_upload(monkeypatch):
+    monkeypatch.setattr(main, "MAX_IMAGE_BYTES", 16)
+    response = client.post("/api/predict", files={"file": ("leaf.jpg", b"x" * 17, "image/jpeg")})
+    assert response.status_code == 413
+
+def test_micro_batcher_coalesces_concurrent_requests():
+    batches = []
+
+    def predict_batch(items):
+        batches.append(list(items))
+        return [item * 2 for item in items]
+
+    async def run():
+        batcher = MicroBatcher(predict_batch, max_batch_size=4, max_wait_ms=50)
+        await batcher.start()
+        results = await asyncio.gather(*(batcher.submit(i) for i in range(6)))
+        await batcher.stop()
+        return results
+
+    assert asyncio.run(run()) == [0, 2, 4, 6, 8, 10]
+    assert [len(b) for b in batches] == [4, 2]
+
+
+class StubPredictor:
+    """Stands in for inference.SeverityPredictor; an upload's bytes are its severity."""
+
+    def __init__(self):
+        self.batches = []
+
+    def decode(self, data):
+        return float(data)
+
+    def preprocess(self, image):
+        return image
+
+    def predict_batch(self, items, heatmaps=False):
+        self.batches.append(len(items))
+        results = [{"class": "Healthy" if s == 0 else "Late Blight", "class_index": 1, "confidence": 0.9, "severity": s}
+                   for s in items]
+        if heatmaps:
+            for result in results:
+                result["heatmap"] = [[round(result["severity"] * 255)]]
+        return results
+
+def test_batch_scan_streams_ndjson_with_plot_summaries(monkeypatch):
+    predictor = StubPredictor()
+    monkeypatch.setattr(main, "get_predictor", lambda version=None: predictor)
+    monkeypatch.setattr(main, "prediction_cache", PredictionCache())
+
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as z:
+        z.writestr("north/a.jpg", "0.5")
+        z.writestr("north/b.jpg", "0.3")
+        z.writestr("south/c.jpg", "0")
+        z.writestr("south/notes.txt", "not an image")
+    files = [("files", ("leaf1.jpg", b"0.2", "image/jpeg")),
+             ("files", ("broken.jpg", b"garbage", "image/jpeg")),
+             ("files", ("plot.zip", archive.getvalue(), "application/zip"))]
+
+    response = client.post("/api/predict/batch", files=files)
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.text.splitlines()]
+
+    results = {line["filename"]: line for line in lines if line["type"] == "result"}
+    assert sorted(results) == ["leaf1.jpg", "north/a.jpg", "north/b.jpg", "south/c.jpg"]
+    assert [line["filename"] for line in lines if line["type"] == "error"] == ["broken.jpg"]
+    summaries = {line["plot"]: line for line in lines if line["type"] == "summary"}
+    assert lines[-len(summaries):] == list(summaries.values())
+    assert summaries["north"]["images"] == 2 and summaries["north"]["mean_severity"] == 0.4
+    assert summaries["south"]["diseased_fraction"] == 0.0
+    assert summaries["default"]["errors"] == 1
+
+    # Fixed-size batches, decoded ahead of the model
+    async def run():
+        items = [ScanItem(i, f"{i}.jpg", "p", lambda: b"0.1") for i in range(5)]
+        return [record async for record in scan(predictor, items, batch_size=2)]
+
+    predictor.batches.clear()
+    records = asyncio.run(run())
+    assert predictor.batches == [2, 2, 1]
+    assert records[-1]["images"] == 5
+
+def test_repeated_uploads_hit_prediction_cache(monkeypatch):
+    predictor = StubPredictor()
+    predictor.fingerprint = "v1"
+    monkeypatch.setattr(main, "get_predictor", lambda version=None: predictor)
+    monkeypatch.setattr(main, "batchers", {})
+    monkeypatch.setattr(main, "prediction_cache", PredictionCache(max_entries=8))
+
+    async def run():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as ac:
+            def upload():
+                return ac.post("/api/predict", files={"file": ("leaf.jpg", b"0.25", "image/jpeg")})
+
+            retries = await asyncio.gather(*(upload() for _ in range(5)))
+            again = await upload()
+            predictor.fingerprint = "v2"   # A new checkpoint was loaded
+            reloaded = await upload()
+            for _, batcher in main.batchers.values():
+                await batcher.stop()
+            return retries, again, reloaded
+
+    retries, again, reloaded = asyncio.run(run())
+    assert all(r.json()["severity"] == 0.25 for r in retries + [again, reloaded])
+    assert again.headers["X-Prediction-Cache"] == "hit"
+    assert reloaded.headers["X-Prediction-Cache"] == "miss"
+    assert sum(predictor.batches) == 2
+    stats = client.get("/api/predict/cache").json()
+    assert stats["misses"] == 2 and stats["coalesced"] == 4 and stats["hits"] == 1
+    assert 'potato_stage_seconds_count{stage="model_load"}' in client.get("/metrics").text
+
+def test_prediction_cache_near_duplicates():
+    cache = PredictionCache(max_entries=2, phash_distance=3)
+    cache.bind("v1")
+    cache.put("a", {"severity": 0.1}, phash=0b1111_0000)
+    assert cache.get_near(0b1111_0011) == {"severity": 0.1}   # 2 bits apart
+    assert cache.get_near(0b0000_1111) is None
+    cache.put("b", {"severity": 0.2}, fingerprint="v0")        # Computed by a model no longer loaded
+    assert cache.get("b") is None
+
+def test_heatmaps_are_cached_with_predictions(monkeypatch):
+    predictor = StubPredictor()
+    predictor.fingerprint = "v1"
+    monkeypatch.setattr(main, "get_predictor", lambda version=None: predictor)
+    monkeypatch.setattr(main, "batchers", {})
+    monkeypatch.setattr(main, "prediction_cache", PredictionCache(max_entries=8))
+
+    async def run():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as ac:
+            def upload(heatmap=None):
+                params = {"heatmap": heatmap} if heatmap else {}
+                return ac.post("/api/predict", params=params, files={"file": ("leaf.jpg", b"0.5", "image/jpeg")})
+
+            responses = [await upload(), await upload("array"), await upload(), await upload("array"),
+                         await upload("jpeg")]
+            for _, batcher in main.batchers.values():
+                await batcher.stop()
+            return responses
+
+    plain, first, plain_again, again, bad = asyncio.run(run())
+    assert "heatmap" not in plain.json() and plain.headers["X-Prediction-Cache"] == "miss"
+    # The cached plain result has no heatmap, so the first heatmap request runs the model
+    assert first.json()["heatmap"] == [[128]] and first.headers["X-Prediction-Cache"] == "miss"
+    assert "heatmap" not in plain_again.json() and plain_again.headers["X-Prediction-Cache"] == "hit"
+    assert again.json()["heatmap"] == [[128]] and again.headers["X-Prediction-Cache"] == "hit"
+    assert bad.status_code == 400
+    assert predictor.batches == [1, 1]
+
+def test_model_registry_budgets_checkpoint_bytes(tmp_path):
+    for version, size in (("1", 600_000), ("3", 600_000)):
+        (tmp_path / version).mkdir()
+        (tmp_path / version / "model.keras").write_bytes(b"0" * size)
+
+    models = registry.ModelRegistry(root=str(tmp_path), default="3", max_resident=3, max_checkpoint_mb=1,
+                                    loader=lambda kind, path: StubPredictor(), check_seconds=0)
+    models.get("1")
+    models.get("3")   # 1.2 MB of checkpoints: over budget though under max_resident
+    assert list(models.resident) == ["3"]
+    assert models.stats()["resident_checkpoint_mb"] == 0.6
+
+
+def test_model_registry_disables_a_corrupt_checkpoint_until_it_changes(tmp_path):
+    (tmp_path / "best_classifier.pth").write_bytes(b"half-written")
+    assert registry.load_version("classifier", str(tmp_path / "best_classifier.pth")) is None
+
+    (tmp_path / "5").mkdir()
+    (tmp_path / "5" / "model.keras").write_bytes(b"truncated")
+    loads = []
+
+    def loader(kind, path):
+        loads.append(path)
+        if open(path, "rb").read() == b"truncated":
+            raise ValueError("bad zip file")
+        return StubPredictor()
+
+    models = registry.ModelRegistry(root=str(tmp_path), default="severity", loader=loader, check_seconds=0)
+    assert models.get("5") is None and models.get("5") is None
+    assert len(loads) == 1   # Not retried on every request
+
+    (tmp_path / "5" / "model.keras").write_bytes(b"fixed weights")
+    assert models.get("5") is not None and len(loads) == 2
+
+def test_model_registry_loads_lazily_evicts_and_hot_swaps(tmp_path, monkeypatch):
+    for version in ("1", "3", "5"):
+        (tmp_path / version).mkdir()
+        (tmp_path / version / "model.keras").write_bytes(b"weights")
+    loads = []
+
+    def loader(kind, path):
+        loads.append(path)
+        predictor = StubPredictor()
+        predictor.fingerprint = open(path, "rb").read().decode()
+        return predictor
+
+    models = registry.ModelRegistry(root=str(tmp_path), default="5", max_resident=2, loader=loader, check_seconds=0)
+    monkeypatch.setattr(registry, "models", models)
+    monkeypatch.setattr(main, "batchers", {})
+    monkeypatch.setattr(main, "prediction_cache", PredictionCache())
+    assert loads == []
+
+    first = models.get("1")
+    assert models.get("1") is first and len(loads) == 1
+    models.get("3")
+    models.get("5")   # Third resident model: the least recently used one ("1") goes
+    assert sorted(models.resident) == ["3", "5"]
+    assert models.stats()["versions"]["1"]["evictions"] == 1
+
+    # A new checkpoint is loaded in the background and swapped in whole
+    old = models.get("3")
+    (tmp_path / "3" / "model.keras").write_bytes(b"retrained")
+    os.utime(tmp_path / "3" / "model.keras", (time.time() - 10, time.time() - 10))
+    assert models.get("3") is old
+    for _ in range(100):
+        if models.get("3") is not old:
+            break
+        time.sleep(0.01)
+    assert models.get("3").fingerprint == "retrained"
+
+    async def run():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as ac:
+            def upload(**kwargs):
+                return ac.post("/api/predict", files={"file": ("leaf.jpg", b"0.5", "image/jpeg")}, **kwargs)
+
+            responses = [await upload(), await upload(params={"version": "3"}),
+                         await upload(headers={"X-Model-Version": "1"}), await upload(params={"version": "7"})]
+            for _, batcher in main.batchers.values():
+                await batcher.stop()
+            return responses
+
+    default, pinned, by_header, unknown = asyncio.run(run())
+    assert [r.headers.get("X-Model-Version") for r in (default, pinned, by_header)] == ["5", "3", "1"]
+    assert unknown.status_code == 404
+    assert pinned.headers["X-Prediction-Cache"] == "miss"   # Each version has its own cache
+    body = client.get("/metrics").text
+    assert 'potato_model_forward_seconds_count{version="3"} 1' in body
+    assert 'potato_model_swaps_total{version="3"} 1' in body
+
+def test_cascade_escalates_uncertain_images(tmp_path):
+    class FastStub:
+        """An upload's value is the fast model's top probability for Healthy; the rest goes to Late Blight."""
+        path = str(tmp_path / "model.keras")
+
+        def predict(self, items):
+            return [[0.0, 1 - p, p] for p in items]
+
+    full = StubPredictor()
+    full.fingerprint = "v1"
+    full.fast_decode = type("FastDecode", (), {"resize_array": staticmethod(lambda array, size: array)})
+    (tmp_path / "model.keras").write_bytes(b"weights")
+    stats = cascade.CascadeStats()
+    predictor = cascade.CascadePredictor(full, FastStub(), min_confidence=0.9, min_margin=0.85, stats=stats)
+
+    results = predictor.predict_batch([0.99, 0.6, 0.91])
+    assert [r["model"] for r in results] == ["fast", "full", "full"]
+    assert results[0] == {"class": "Healthy", "class_index": 2, "confidence": 0.99, "severity": None, "model": "fast"}
+    assert [r.get("escalated") for r in results] == [None, "confidence", "margin"]
+    assert full.batches == [2]   # Escalations run as one sub-batch
+    assert stats.snapshot() == {"images": 3, "escalations": {"confidence": 1, "margin": 1}, "escalation_rate": 0.6667}
+    assert 'potato_cascade_escalations_total{reason="margin"} 1' in stats.metric_lines()
+    # The shipped defaults gate on confidence only; a margin below 2 * confidence - 1 is redundant
+    assert not cascade.margin_gate_active(cascade.DEFAULT_MIN_CONFIDENCE, cascade.DEFAULT_MIN_MARGIN)
+    assert not cascade.margin_gate_active(0.95, 0.5) and cascade.margin_gate_active(0.9, 0.85)
+
+
+class StubLLM:
+    """Stands in for genai.GenerativeModel with a fixed, blocking round-trip."""
+
+    def __init__(self, latency=0.2):
+        self.latency = latency
+        self.calls = 0
+
+    def start_chat(self, history=None):
+        self.history = history
+        return self
+
+    def send_message(self, message, stream=False):
+        self.calls += 1
+        time.sleep(self.latency)
+        if stream:
+            return [type("Chunk", (), {"text": word})() for word in f"echo: {message}".split(" ")]
+        return type("Response", (), {"text": f"echo: {message}"})()
+
+class StreamFailsLLM(StubLLM):
+    """Fails to open a stream, but answers plain completions."""
+
+    def send_message(self, message, stream=False):
+        if stream:
+            raise ConnectionError("stream refused")
+        return super().send_message(message)
+
+def test_vercel_chat_stream_falls_back_to_completion(monkeypatch):
+    import chat
+
+    monkeypatch.setattr(llm, "_model", StreamFailsLLM(latency=0))
+    handler = chat.handler.__new__(chat.handler)
+    handler.wfile = io.BytesIO()
+    handler.send_response = handler.send_header = lambda *args: None
+    handler.end_headers = lambda: None
+
+    handler.stream_reply("hi", None)
+    events = handler.wfile.getvalue().decode().split("\n\n")
+    assert events[0] == 'data: {"text": "echo: hi"}'
+    assert events[1] == 'event: done\ndata: {"response": "echo: hi"}'
+
+def test_chat_uses_shared_model(monkeypatch):
+    monkeypatch.setattr(llm, "_model", StubLLM(latency=0))
+    monkeypatch.setattr(main, "response_cache", ResponseCache(ttl=0))
+    response = client.post("/api/chat", json={"message": "How do I treat this?", "context": "Early Blight"})
+    assert response.status_code == 200
+    assert response.json()["response"] == "echo: [Context: Current scan detected Early Blight] User Question: How do I treat this?"
+    assert response.json()["session_id"]
+
+def test_chat_requests_run_concurrently(monkeypatch):
+    monkeypatch.setattr(llm, "_model", StubLLM(latency=0.2))
+    monkeypatch.setattr(main, "response_cache", ResponseCache(ttl=0))
+
+    async def run():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as ac:
+            start = time.perf_counter()
+            responses = await asyncio.gather(*(ac.post("/api/chat", json={"message": f"q{i}"}) for i in range(10)))
+            return time.perf_counter() - start, responses
+
+    elapsed, responses = asyncio.run(run())
+    assert all(r.status_code == 200 for r in responses)
+    # Ten 200 ms upstream calls would take 2 s if they serialized on the event loop
+    assert elapsed < 1.0
+
+def test_session_reads_stay_off_the_event_loop(monkeypatch):
+    class StalledDisk(SessionStore):
+        def get(self, session_id):
+            time.sleep(0.2)   # Like a SQLite read stuck on disk
+            return super().get(session_id)
+
+    monkeypatch.setattr(llm, "_model", StubLLM(latency=0))
+    monkeypatch.setattr(main, "response_cache", ResponseCache(ttl=0))
+    monkeypatch.setattr(main, "sessions", StalledDisk())
+
+    async def run():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as ac:
+            start = time.perf_counter()
+            responses = await asyncio.gather(*(ac.post("/api/chat", json={"message": "hi", "session_id": f"s{i}"})
+                                               for i in range(5)))
+            return time.perf_counter() - start, responses
+
+    elapsed, responses = asyncio.run(run())
+    assert all(r.status_code == 200 for r in responses)
+    assert elapsed < 0.8   # 1 s if every stalled read blocked the loop
+
+def test_identical_chat_questions_coalesce(monkeypatch):
+    stub = StubLLM(latency=0.1)
+    monkeypatch.setattr(llm, "_model", stub)
+    monkeypatch.setattr(main, "response_cache", ResponseCache())
+
+    async def run():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as ac:
+            burst = await asyncio.gather(*(
+                ac.post("/api/chat", json={"message": "How do I treat this?", "context": "Late Blight"})
+                for _ in range(200)
+            ))
+            again = await ac.post("/api/chat", json={"message": "how do I  treat this", "context": "late blight"})
+            return burst, again
+
+    burst, again = asyncio.run(run())
+    assert all(r.status_code == 200 for r in burst) and again.status_code == 200
+    assert stub.calls == 1
+    stats = client.get("/api/chat/cache").json()
+    assert stats["misses"] == 1 and stats["coalesced"] == 199 and stats["hits"] == 1
+
+def test_chat_admission_sheds_load_with_retry_after(monkeypatch):
+    monkeypatch.setattr(llm, "_model", StubLLM(latency=0.3))
+    monkeypatch.setattr(main, "response_cache", ResponseCache(ttl=0))
+    chat = admission.RouteLimiter("chat", concurrency=1, queue_size=2, deadline=10)
+    monkeypatch.setattr(admission, "limiters", {**admission.limiters, "chat": chat})
+    monkeypatch.setattr(admission, "buckets", admission.TokenBuckets(rate=0))
+
+    async def burst(n):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as ac:
+            return await asyncio.gather(*(ac.post("/api/chat", json={"message": f"q{i}"}) for i in range(n)))
+
+    # One running, two queued, the fourth refused at once
+    responses = asyncio.run(burst(4))
+    assert sorted(r.status_code for r in responses) == [200, 200, 200, 503]
+    shed = next(r for r in responses if r.status_code == 503)
+    assert int(shed.headers["Retry-After"]) >= 1 and "queued" in shed.json()["detail"]
+
+    # With ~0.3 s per call measured, a 0.75 s deadline leaves room for one queued request only
+    chat.deadline = 0.75
+    responses = asyncio.run(burst(3))
+    assert sorted(r.status_code for r in responses) == [200, 200, 503]
+    assert chat.stats()["queue_full"] == 1 and chat.stats()["deadline"] == 1 and chat.stats()["active"] == 0
+
+    # Cache hits and coalesced duplicates never take a slot or a token
+    monkeypatch.setattr(main, "response_cache", ResponseCache())
+    monkeypatch.setattr(admission, "buckets", admission.TokenBuckets(rate=0.01, burst=1))
+    answered = client.post("/api/chat", json={"message": "once"})
+    again = client.post("/api/chat", json={"message": "once"})
+    limited = client.post("/api/chat", json={"message": "twice"})
+    assert answered.status_code == again.status_code == 200
+    assert limited.status_code == 429 and int(limited.headers["Retry-After"]) >= 99
+    assert 'potato_admission_deadline_total{route="chat"} 1' in client.get("/metrics").text
+
+    # Only the hop the trusted proxy appended identifies the client; forged entries to its left don't
+    scope = {"client": ("10.0.0.9", 1234), "headers": [(b"x-forwarded-for", b"6.6.6.6, 203.0.113.7")]}
+    assert admission.client_id(scope, trusted_proxies=0) == "10.0.0.9"
+    assert admission.client_id(scope, trusted_proxies=1) == "203.0.113.7"
+    assert admission.client_id(scope) == "203.0.113.7"   # Default: one proxy (Vercel)
+
+def test_admission_keeps_a_slot_granted_as_the_wait_times_out(monkeypatch):
+    limiter = admission.RouteLimiter("predict", concurrency=1, queue_size=1, deadline=10)
+
+    def granted_then_timed_out(future, timeout):
+        limiter.release(0.01)   # Hands the slot to the waiter...
+        future.cancel()
+        raise asyncio.TimeoutError   # ...in the same moment its wait gives up
+
+    async def run():
+        await limiter.acquire(time.monotonic())
+        with monkeypatch.context() as m:
+            m.setattr(asyncio, "wait_for", granted_then_timed_out)
+            await limiter.acquire(time.monotonic())
+
+    asyncio.run(run())
+    stats = limiter.stats()
+    assert stats["active"] == 1 and stats["admitted"] == 2 and stats["deadline"] == 0
+
+def test_response_cache_bounds():
+    cache = ResponseCache(ttl=60, max_entries=2, max_bytes=1024)
+    for i in range(3):
+        cache.put(make_key(None, f"q{i}"), "answer")
+    assert cache.get(make_key(None, "q0")) is None
+    assert cache.get(make_key(None, "q2")) == "answer"
+    assert cache.evictions == 1
+
+    cache.put(make_key(None, "big"), "x" * 2048)
+    assert cache.get(make_key(None, "big")) is None
+
+def test_chat_streams_server_sent_events(monkeypatch):
+    monkeypatch.setattr(llm, "_model", StubLLM(latency=0))
+    monkeypatch.setattr(main, "response_cache", ResponseCache())
+
+    response = client.post("/api/chat", json={"message": "hi there", "stream": True})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = [e for e in response.text.split("\n\n") if e]
+    assert events[:3] == ['data: {"text": "echo:"}', 'data: {"text": "hi"}', 'data: {"text": "there"}']
+    assert events[-1].startswith('event: done\ndata: {"response": "echo:hithere", "session_id": ')
+
+    # The streamed reply is cached for the plain JSON path
+    assert client.post("/api/chat", json={"message": "hi there"}).json()["response"] == "echo:hithere"
+
+def test_chat_session_keeps_history(monkeypatch):
+    stub = StubLLM(latency=0)
+    monkeypatch.setattr(llm, "_model", stub)
+    monkeypatch.setattr(main, "sessions", SessionStore())
+
+    first = client.post("/api/chat", json={"message": "My leaves have brown rings"}).json()
+    assert stub.history == []
+
+    client.post("/api/chat", json={"message": "What should I spray?", "session_id": first["session_id"]})
+    assert [turn["role"] for turn in stub.history] == ["user", "model"]
+    assert stub.history[0]["parts"] == ["My leaves have brown rings"]
+
+def test_history_trimmed_to_token_budget(tmp_path):
+    store = SessionStore(token_budget=100, db_path=str(tmp_path / "sessions.db"))
+    for i in range(50):
+        store.append("s1", f"question {i} " + "x" * 40, f"answer {i} " + "y" * 40)
+    history = store.get("s1")
+    assert history[0]["role"] == "user" and history[-1]["parts"][0].startswith("answer 49")
+    assert len(history) < 10
+
+    # Sessions survive a restart when backed by SQLite
+    assert SessionStore(db_path=str(tmp_path / "sessions.db")).get("s1") == history
+    assert trim_history(history, budget=0) == []
+
+def test_heavy_sdks_load_lazily():
+    probe = "import sys, main; print(sorted(m for m in ('google.generativeai', 'torch') if m in sys.modules))"
+    out = subprocess.run([sys.executable, "-c", probe], capture_output=True, text=True, check=True)
+    assert out.stdout.strip() == "[]"
+
+def test_metrics_report_request_and_stage_latency(monkeypatch):
+    monkeypatch.setattr(llm, "_model", StubLLM(latency=0))
+    monkeypatch.setattr(main, "response_cache", ResponseCache())
+    client.post("/api/chat", json={"message": "Is late blight contagious?"})
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    body = response.text
+    assert 'potato_request_seconds_count{method="POST",route="/api/chat",status="200"}' in body
+    assert 'potato_stage_seconds_count{stage="upstream_llm"}' in body
+    assert 'potato_stage_seconds_count{stage="request_decode"}' in body
+    assert "potato_chat_cache_misses_total" in body
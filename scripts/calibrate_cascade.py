@@ -0,0 +1,184 @@
+import os
+# The Keras models run on the torch backend, so serving needs no TensorFlow install
+os.environ.setdefault('KERAS_BACKEND', 'torch')
+
+import torch
+import numpy as np
+from PIL import Image
+from torchvision import datasets
+import json
+import random
+import sys
+import time
+
+from fast_decode import normalize_into, resize_array
+from label_store import normalize_path
+from train_classifier import SPLIT_FILE, load_split
+from train_severity import PotatoSeverityModel
+
+# The escalation rule is shared with serving, so calibration scores exactly what the API does
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'api'))
+from cascade import escalation
+
+# ---------- CONFIG ----------
+DATA_DIR = 'PlantVillage'
+FAST_MODEL_PATH = 'models/5/model.keras'   # Small Keras CNN that answers first
+FULL_MODEL_PATH = 'models/severity_model.pth'
+CONFIG_FILE = 'models/cascade.json'        # Read by api/cascade.py
+HELDOUT_IMAGES = 600        # Seeded subset of train_classifier.py's validation split used for calibration
+TARGET_ACCURACY = 0.98      # Cascade accuracy to reach at the lowest mean latency
+BATCH_SIZE = 16
+SEED = 1
+# ----------------------------
+
+FAST_SIZE = 256   # The Keras models take 256x256 RGB in 0-255 (rescaling is part of the model)
+FULL_SIZE = 224
+
+# 0.0 never escalates on confidence and 1.01 always escalates, so both single-model setups are candidates
+CONFIDENCE_GRID = [0.0, 0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.95, 0.97, 0.98, 0.99, 0.995, 0.999, 1.01]
+MARGIN_GRID = [0.0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 0.99]
+
+class KerasClassifier:
+    """One of the models/<n>/model.keras CNNs; class order matches ImageFolder (Early, Late, healthy)."""
+
+    def __init__(self, path=FAST_MODEL_PATH):
+        import keras
+
+        self.keras = keras
+        self.path = path
+        self.model = keras.saving.load_model(path, compile=False)
+
+    def predict(self, arrays):
+        """Softmax probabilities (N, 3) for a list of (256, 256, 3) uint8 arrays."""
+        batch = np.stack(arrays).astype(np.float32)
+        with torch.no_grad():
+            probs = self.model(batch, training=False)
+        return self.keras.ops.convert_to_numpy(probs)
+
+def heldout_split(dataset, n=HELDOUT_IMAGES, seed=SEED, split_file=SPLIT_FILE):
+    """Up to n seeded indices from the validation split train_classifier.py saved, or None without it.
+
+    Images the models trained on would make escalation look rarer and the
+    cascade more accurate than they are, so there is no fallback to a shuffle.
+    """
+    wanted = load_split(split_file)
+    if wanted is None:
+        return None
+    indices = [i for i, (path, _) in enumerate(dataset.samples) if normalize_path(path) in wanted]
+    if len(indices) < len(wanted):
+        print(f"Warning: {len(wanted) - len(indices)} held-out images from {split_file} are not in {DATA_DIR}.")
+    random.Random(seed).shuffle(indices)
+    return sorted(indices[:n])
+
+def timed(fn, batches):
+    """Outputs of fn over batches and its mean wall time per image (ms)."""
+    outputs, elapsed, count = [], 0.0, 0
+    fn(batches[0])   # Warm-up
+    for batch in batches:
+        start = time.perf_counter()
+        outputs.append(fn(batch))
+        elapsed += time.perf_counter() - start
+        count += len(batch)
+    return np.concatenate(outputs), elapsed / count * 1000
+
+def choose_thresholds(fast_probs, full_correct, labels, fast_ms, full_ms, target=TARGET_ACCURACY):
+    """Grid-search (min_confidence, min_margin) for the lowest mean latency at >= target accuracy.
+
+    If no setting reaches the target, the most accurate one is returned (with 'reached': False).
+    """
+    fast_correct = fast_probs.argmax(axis=1) == labels
+    best, most_accurate = None, None
+    for min_confidence in CONFIDENCE_GRID:
+        for min_margin in MARGIN_GRID:
+            escalated = np.array([r is not None for r in escalation(fast_probs, min_confidence, min_margin)])
+            accuracy = np.where(escalated, full_correct, fast_correct).mean()
+            latency = fast_ms + escalated.mean() * full_ms
+            candidate = {
+                'min_confidence': min_confidence, 'min_margin': min_margin,
+                'accuracy': round(float(accuracy), 4), 'escalation_rate': round(float(escalated.mean()), 4),
+                'mean_latency_ms': round(float(latency), 2),
+            }
+            if accuracy >= target and (best is None or latency < best['mean_latency_ms']):
+                best = candidate
+            if most_accurate is None or (accuracy, -latency) > (most_accurate['accuracy'],
+                                                                 -most_accurate['mean_latency_ms']):
+                most_accurate = candidate
+    if best is not None:
+        return {**best, 'reached': True}
+    return {**most_accurate, 'reached': False}
+
+def calibrate(target=TARGET_ACCURACY):
+    if not os.path.exists(DATA_DIR):
+        print(f"Error: '{DATA_DIR}' not found. Please set DATA_DIR in the script.")
+        return
+    if not os.path.exists(FULL_MODEL_PATH):
+        print(f"Error: {FULL_MODEL_PATH} not found. Run train_severity.py first.")
+        return
+    torch.manual_seed(SEED)
+
+    dataset = datasets.ImageFolder(DATA_DIR)
+    indices = heldout_split(dataset)
+    if not indices:
+        print(f"Error: no held-out split in {SPLIT_FILE}. Run train_classifier.py first; calibrating on "
+              f"training images would bias the thresholds.")
+        return
+    print(f"Calibrating on {len(indices)} held-out images from {SPLIT_FILE} (seed {SEED}).")
+
+    # PlantVillage images are 256x256 already, so both models see what serving gives them
+    arrays, labels = [], []
+    for i in indices:
+        path, label = dataset.samples[i]
+        arrays.append(resize_array(np.array(Image.open(path).convert('RGB')), FAST_SIZE))
+        labels.append(label)
+    labels = np.array(labels)
+    batches = [arrays[i:i + BATCH_SIZE] for i in range(0, len(arrays), BATCH_SIZE)]
+
+    fast = KerasClassifier(FAST_MODEL_PATH)
+    fast_probs, fast_ms = timed(fast.predict, batches)
+
+    full = PotatoSeverityModel(num_classes=3, pretrained=False)
+    full.load_state_dict(torch.load(FULL_MODEL_PATH, map_location='cpu'))
+    full.eval()
+    buffer = torch.empty(BATCH_SIZE, 3, FULL_SIZE, FULL_SIZE)
+
+    def run_full(batch):
+        with torch.no_grad():
+            x = normalize_into([resize_array(a, FULL_SIZE) for a in batch], buffer)
+            return full(x)[0].argmax(dim=1).numpy()
+
+    full_preds, full_ms = timed(run_full, batches)
+    full_correct = full_preds == labels
+    fast_accuracy = float((fast_probs.argmax(axis=1) == labels).mean())
+    print(f"Fast model ({FAST_MODEL_PATH}): accuracy {fast_accuracy:.4f}, {fast_ms:.1f} ms/image")
+    print(f"Full model ({FULL_MODEL_PATH}): accuracy {full_correct.mean():.4f}, {full_ms:.1f} ms/image")
+
+    best = choose_thresholds(fast_probs, full_correct, labels, fast_ms, full_ms, target)
+    if not best['reached']:
+        print(f"No thresholds reach {target:.2%}; using the most accurate setting instead.")
+    if best['mean_latency_ms'] >= full_ms:
+        print("Note: the cascade is not faster than the full model alone at this target on this machine.")
+
+    config = {
+        'fast_model': FAST_MODEL_PATH, 'full_model': FULL_MODEL_PATH,
+        'target_accuracy': target, 'heldout_images': len(indices), 'seed': SEED,
+        'split': {'source': 'saved', 'file': SPLIT_FILE, 'images': len(indices)},
+        'fast_accuracy': round(fast_accuracy, 4), 'full_accuracy': round(float(full_correct.mean()), 4),
+        'fast_ms': round(fast_ms, 2), 'full_ms': round(full_ms, 2),
+        **best,
+    }
+    tmp_file = CONFIG_FILE + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(config, f, indent=2)
+    os.replace(tmp_file, CONFIG_FILE)
+    print(f"min_confidence={best['min_confidence']} min_margin={best['min_margin']}: accuracy {best['accuracy']:.4f}, "
+          f"{best['escalation_rate']:.1%} escalated, {best['mean_latency_ms']:.1f} ms/image")
+    print(f"Done! Thresholds saved to {CONFIG_FILE}")
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Pick cascade thresholds on a held-out PlantVillage split.")
+    parser.add_argument('--target', type=float, default=TARGET_ACCURACY, help="Required cascade accuracy")
+    parser.add_argument('--fast-model', default=FAST_MODEL_PATH)
+    args = parser.parse_args()
+    FAST_MODEL_PATH = args.fast_model
+    calibrate(target=args.target)
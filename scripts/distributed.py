@@ -0,0 +1,129 @@
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader, Subset
+from torch.utils.data.distributed import DistributedSampler
+import os
+import socket
+import time
+
+# ---------- CONFIG ----------
+# Data-parallel CPU training with torch.distributed (gloo). Run one process per
+# socket or core group, e.g. --nproc 4 on a 32-core box gives each process 8 cores.
+BACKEND = 'gloo'
+NUM_WORKERS = 2        # DataLoader workers per process (persistent, prefetching)
+PREFETCH_FACTOR = 4    # Batches each worker keeps ready
+WARMUP_STEPS = 3       # Steps left out of the images/sec measurement
+SCALING_STEPS = 30     # Default steps per process count in --scaling
+# ----------------------------
+
+def threads_per_process(world_size, num_workers=NUM_WORKERS):
+    """Split the machine's cores between the training processes and their loader workers."""
+    cores = os.cpu_count() or 1
+    return max(1, cores // world_size - num_workers)
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def setup(rank, world_size, threads=None, num_workers=NUM_WORKERS):
+    torch.set_num_threads(threads or threads_per_process(world_size, num_workers))
+    if world_size > 1:
+        dist.init_process_group(BACKEND, rank=rank, world_size=world_size)
+
+def cleanup(world_size):
+    if world_size > 1:
+        dist.destroy_process_group()
+
+def _worker(rank, fn, world_size, threads, num_workers, queue, args):
+    setup(rank, world_size, threads, num_workers)
+    try:
+        result = fn(rank, world_size, *args)
+        if rank == 0:
+            queue.put(result)
+    finally:
+        cleanup(world_size)
+
+def launch(fn, world_size=1, threads=None, args=(), num_workers=NUM_WORKERS):
+    """Run fn(rank, world_size, *args) in `world_size` processes and return rank 0's result.
+
+    A single process runs in place, without a process group, so the
+    non-distributed path behaves exactly as before. `num_workers` is the
+    DataLoader workers each process starts, which the default thread count
+    leaves cores for.
+    """
+    if world_size == 1:
+        setup(0, 1, threads, num_workers)
+        return fn(0, 1, *args)
+
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', str(_free_port()))
+    queue = mp.get_context('spawn').SimpleQueue()
+    mp.spawn(_worker, args=(fn, world_size, threads, num_workers, queue, args), nprocs=world_size, join=True)
+    return queue.get()
+
+def make_loader(dataset, batch_size, shuffle, rank=0, world_size=1, num_workers=NUM_WORKERS):
+    """DataLoader that shards `dataset` across processes and keeps its workers alive between epochs.
+
+    Call ``loader.sampler.set_epoch(epoch)`` when distributed so every epoch
+    gets a different shuffle. Without shuffle (validation) each process gets
+    an unpadded slice, so summed counts score every image exactly once;
+    DistributedSampler would repeat images to even out the shards.
+    """
+    sampler = None
+    if world_size > 1 and shuffle:
+        sampler = DistributedSampler(dataset, num_replicas=world_size, rank=rank, shuffle=True)
+    elif world_size > 1:
+        dataset = Subset(dataset, range(rank, len(dataset), world_size))
+    extra = {'persistent_workers': True, 'prefetch_factor': PREFETCH_FACTOR} if num_workers > 0 else {}
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle and sampler is None, sampler=sampler,
+                      num_workers=num_workers, pin_memory=torch.cuda.is_available(), **extra)
+
+def all_reduce_sum(values, world_size):
+    """Sum a list of numbers over all processes (no-op for one process)."""
+    if world_size == 1:
+        return values
+    t = torch.tensor(values, dtype=torch.float64)
+    dist.all_reduce(t, op=dist.ReduceOp.SUM)
+    return t.tolist()
+
+class Throughput:
+    """Images/sec over all processes, ignoring the first WARMUP_STEPS steps."""
+
+    def __init__(self, warmup=WARMUP_STEPS):
+        self.warmup = warmup
+        self.steps = 0
+        self.images = 0
+        self.start = None
+
+    def step(self, n):
+        self.steps += 1
+        if self.steps == self.warmup:
+            self.start = time.perf_counter()
+        elif self.steps > self.warmup:
+            self.images += n
+
+    def result(self, world_size):
+        elapsed = time.perf_counter() - self.start if self.start is not None else 0.0
+        images, elapsed = all_reduce_sum([self.images, elapsed], world_size)
+        # Every process runs for about the same time, so use the mean wall time
+        elapsed /= world_size
+        return images / elapsed if elapsed > 0 else 0.0
+
+def scaling_report(fn, world_sizes, max_steps, threads=None, args=(), extra_args=(), num_workers=NUM_WORKERS):
+    """Train for max_steps steps at each world size and print images/sec and speedup.
+
+    fn is called as fn(rank, world_size, *args, max_steps, *extra_args).
+    """
+    results = {}
+    for world_size in world_sizes:
+        results[world_size] = launch(fn, world_size, threads, args=(*args, max_steps, *extra_args), num_workers=num_workers)
+        print(f"{world_size} process(es): {results[world_size]:.1f} images/sec")
+
+    base = results[world_sizes[0]]
+    print("\nprocs  images/sec  speedup  efficiency")
+    for world_size, ips in results.items():
+        speedup = ips / base if base else 0.0
+        print(f"{world_size:5d}  {ips:10.1f}  {speedup:6.2f}x  {speedup / world_size * world_sizes[0]:9.0%}")
+    return results
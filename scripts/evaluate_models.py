@@ -0,0 +1,347 @@
+import os
+# The Keras models run on the torch backend, so evaluating them needs no TensorFlow install
+os.environ.setdefault('KERAS_BACKEND', 'torch')
+
+import torch
+import numpy as np
+from PIL import Image
+from torchvision import datasets
+from torch.utils.data import DataLoader, Dataset, random_split
+import json
+import time
+import zipfile
+
+from calibrate_cascade import FAST_SIZE, KerasClassifier
+from distributed import NUM_WORKERS
+from export_models import build_model, load_artifact, read_manifest, runtime_available
+from fast_decode import normalize_into, resize_array
+from label_store import load_labels, normalize_path
+from train_classifier import SPLIT_FILE, SPLIT_SEED, load_split
+from train_severity import CSV_FILE, LABELS_DIR, _file_digest
+
+# ---------- CONFIG ----------
+DATA_DIR = 'PlantVillage'
+MODELS_DIR = 'models'
+MANIFEST_FILE = 'models/export/manifest.json'   # Exported artifacts are evaluated too, if present
+REPORT_FILE = 'models/eval_report.json'
+VAL_FRACTION = 0.2          # Only used to re-derive train_classifier.py's split when SPLIT_FILE is missing
+EVAL_BATCH_SIZE = 32        # Batch size of the accuracy pass
+BENCH_BATCH_SIZES = [1, 8, 32]
+BENCH_THREADS = [1, 2, 4, 0]   # Intra-op threads; 0 = all cores. Counts above the core count are skipped
+BENCH_RUNS = 10             # Timed forwards per (batch size, threads); the median is reported
+# ----------------------------
+
+FULL_SIZE = 224
+
+class HeldoutImages(Dataset):
+    """(uint8 HWC array at FAST_SIZE, class, index) of the held-out images, decoded by DataLoader workers."""
+
+    def __init__(self, samples, indices):
+        self.samples = samples
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, i):
+        path, label = self.samples[self.indices[i]]
+        with Image.open(path) as img:
+            array = resize_array(np.asarray(img.convert('RGB')), FAST_SIZE)
+        return array, label, i
+
+def heldout_split(dataset, split_file=SPLIT_FILE, seed=SPLIT_SEED, val_fraction=VAL_FRACTION):
+    """(indices into dataset, source) of the images train_classifier.py validated on.
+
+    The classifier saves its validation paths to split_file, which is exact
+    whatever dataset (ImageFolder or shard) it trained on. Without it the
+    seeded random_split is re-derived over dataset ('reproduced'), which only
+    matches if the classifier saw the same images in the same order.
+    """
+    wanted = load_split(split_file)
+    if wanted is not None:
+        indices = [i for i, (path, _) in enumerate(dataset.samples) if normalize_path(path) in wanted]
+        if len(indices) < len(wanted):
+            print(f"Warning: {len(wanted) - len(indices)} held-out images from {split_file} are not in {DATA_DIR}.")
+        return indices, 'saved'
+    n = len(dataset)
+    train_size = int((1 - val_fraction) * n)
+    _, val = random_split(range(n), [train_size, n - train_size], generator=torch.Generator().manual_seed(seed))
+    return sorted(val.indices), 'reproduced'
+
+def load_heldout(dataset, indices, num_workers=NUM_WORKERS):
+    """Decode the held-out images once (in parallel); every model is scored on these same arrays."""
+    loader = DataLoader(HeldoutImages(dataset.samples, indices), batch_size=EVAL_BATCH_SIZE,
+                        num_workers=num_workers)
+    arrays, labels = [None] * len(indices), np.zeros(len(indices), dtype=np.int64)
+    for batch, batch_labels, positions in loader:
+        for array, label, i in zip(batch.numpy(), batch_labels.tolist(), positions.tolist()):
+            arrays[i] = array
+            labels[i] = label
+    return arrays, labels
+
+def heldout_severity(paths):
+    """Pseudo severity of each path (NaN where unlabeled), or None without severity labels."""
+    if not os.path.exists(CSV_FILE) and not os.path.exists(os.path.join(LABELS_DIR, 'meta.json')):
+        return None
+    store = load_labels(CSV_FILE, LABELS_DIR)
+    position = {normalize_path(p): i for i, p in enumerate(paths)}
+    severity = np.full(len(paths), np.nan, dtype=np.float32)
+    for row, path in enumerate(store.paths()):
+        i = position.get(normalize_path(path))
+        if i is not None:
+            severity[i] = store.severity[row]
+    return severity
+
+# ---------- Models ----------
+
+class TorchRunner:
+    """A .pth checkpoint or exported artifact: 224x224 normalized input, (logits[, severity]) out."""
+
+    def __init__(self, model):
+        self.model = model
+
+    def __call__(self, arrays):
+        x = normalize_into([resize_array(a, FULL_SIZE) for a in arrays],
+                           torch.empty(len(arrays), 3, FULL_SIZE, FULL_SIZE))
+        with torch.no_grad():
+            outputs = self.model(x)
+        outputs = outputs if isinstance(outputs, (tuple, list)) else (outputs,)
+        probs = torch.softmax(outputs[0].float(), dim=1).numpy()
+        severity = outputs[1].float().reshape(-1).numpy() if len(outputs) > 1 else None
+        return probs, severity
+
+class KerasRunner:
+    def __init__(self, path):
+        self.model = KerasClassifier(path)
+
+    def __call__(self, arrays):
+        return self.model.predict(arrays), None
+
+def checkpoint_kind(path):
+    """'keras', 'onnx', 'torchscript' (artifacts of export_models.py), 'severity' (dual-head
+    PotatoSeverityModel state dict) or 'classifier' (plain ResNet34 state dict).
+
+    Raises ValueError for anything else.
+    """
+    if path.endswith('.keras'):
+        return 'keras'
+    if path.endswith('.onnx'):
+        return 'onnx'
+    # TorchScript archives carry their code next to the weights; torch.load can't unpickle them
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            if any(name.split('/')[1:2] == ['code'] for name in archive.namelist()):
+                return 'torchscript'
+    try:
+        state = torch.load(path, map_location='cpu')
+    except Exception as e:
+        raise ValueError(f"{path} is not a .keras, .onnx, TorchScript or state-dict checkpoint "
+                         f"(torch.load: {type(e).__name__})")
+    if isinstance(state, dict) and 'model_state' in state: state = state['model_state']
+    if not isinstance(state, dict):
+        raise ValueError(f"{path} holds a {type(state).__name__}, not a state dict")
+    return 'severity' if any(k.startswith('fc_severity.') for k in state) else 'classifier'
+
+def describe(path, manifest_file=MANIFEST_FILE):
+    """(name, kind, path) of a checkpoint or exported artifact named on the command line."""
+    if not os.path.exists(path):
+        raise ValueError(f"{path} not found")
+    for entry in (read_manifest(manifest_file) or {}).get('artifacts', []):
+        if os.path.abspath(entry['path']) == os.path.abspath(path):
+            return entry['name'], entry['format'], path
+    return model_name(path), checkpoint_kind(path), path
+
+def model_name(path):
+    """models/severity_model.pth -> severity_model, models/5/model.keras -> keras_5."""
+    if path.endswith('.keras'):
+        return f"keras_{os.path.basename(os.path.dirname(os.path.abspath(path)))}"
+    return os.path.splitext(os.path.basename(path))[0]
+
+def discover(models_dir=MODELS_DIR, manifest_file=MANIFEST_FILE):
+    """Every checkpoint under models_dir, plus the exported artifacts that passed parity: [(name, kind, path)]."""
+    found = []
+    for name in sorted(os.listdir(models_dir)) if os.path.isdir(models_dir) else []:
+        path = os.path.join(models_dir, name)
+        if name.endswith('.pth'):
+            found.append((model_name(path), checkpoint_kind(path), path))
+        elif os.path.exists(os.path.join(path, 'model.keras')):
+            path = os.path.join(path, 'model.keras')
+            found.append((model_name(path), 'keras', path))
+    for entry in (read_manifest(manifest_file) or {}).get('artifacts', []):
+        if entry['passes'] and runtime_available(entry['format']) and os.path.exists(entry['path']):
+            found.append((entry['name'], entry['format'], entry['path']))
+    return found
+
+def held_out(name, kind, source):
+    """True if the model never trained on the split, False if it did, None if unknown.
+
+    Severity models count as not held out: train_severity.py now leaves the
+    split out, but older checkpoints trained on every labeled image and a
+    checkpoint doesn't say which it is. The Keras models were trained outside
+    this repo, and a re-derived split may not be the one the classifier
+    actually held out.
+    """
+    if kind == 'severity' or name.startswith('severity.'):
+        return False
+    return True if kind != 'keras' and source == 'saved' else None
+
+def load_runner(kind, path):
+    if kind == 'keras':
+        return KerasRunner(path)
+    if kind in ('severity', 'classifier'):
+        return TorchRunner(build_model(kind, path))
+    return TorchRunner(load_artifact(kind, path))
+
+# ---------- Scoring ----------
+
+def score(runner, arrays, labels, severity, num_classes):
+    """Accuracy, confusion matrix (rows: true class, columns: predicted) and severity MAE on labeled images."""
+    probs, sevs = [], []
+    for start in range(0, len(arrays), EVAL_BATCH_SIZE):
+        p, s = runner(arrays[start:start + EVAL_BATCH_SIZE])
+        probs.append(p)
+        if s is not None:
+            sevs.append(s)
+    predicted = np.concatenate(probs).argmax(axis=1)
+    confusion = np.zeros((num_classes, num_classes), dtype=np.int64)
+    np.add.at(confusion, (labels, predicted), 1)
+    result = {
+        'accuracy': round(float((predicted == labels).mean()), 4),
+        'per_class_accuracy': [round(float(row[i] / row.sum()), 4) if row.sum() else None
+                               for i, row in enumerate(confusion)],
+        'confusion_matrix': confusion.tolist(),
+        'severity_mae': None,
+    }
+    if sevs and severity is not None:
+        labeled = ~np.isnan(severity)
+        if labeled.any():
+            result['severity_mae'] = round(float(np.abs(np.concatenate(sevs) - severity)[labeled].mean()), 4)
+            result['severity_images'] = int(labeled.sum())
+    return result
+
+def thread_counts(counts=BENCH_THREADS):
+    cores = os.cpu_count() or 1
+    return sorted({cores if t == 0 else t for t in counts if t <= cores})
+
+def benchmark(runner, arrays, batch_sizes=BENCH_BATCH_SIZES, threads=None, runs=BENCH_RUNS):
+    """Median latency of one batch at every (batch size, threads), on real held-out images."""
+    previous = torch.get_num_threads()
+    results = []
+    try:
+        for num_threads in threads or thread_counts():
+            torch.set_num_threads(num_threads)
+            for batch_size in batch_sizes:
+                batch = [arrays[i % len(arrays)] for i in range(batch_size)]
+                runner(batch)   # Warm-up
+                times = []
+                for _ in range(runs):
+                    start = time.perf_counter()
+                    runner(batch)
+                    times.append(time.perf_counter() - start)
+                median = sorted(times)[len(times) // 2]
+                results.append({'batch_size': batch_size, 'threads': num_threads,
+                                'batch_ms': round(median * 1000, 2),
+                                'per_image_ms': round(median * 1000 / batch_size, 3),
+                                'images_per_sec': round(batch_size / median, 1)})
+    finally:
+        torch.set_num_threads(previous)
+    return results
+
+def pareto(models):
+    """Names of the models no other model beats on both accuracy and best per-image latency."""
+    front = []
+    for m in models:
+        dominated = any(o['accuracy'] >= m['accuracy'] and o['best_per_image_ms'] <= m['best_per_image_ms']
+                        and (o['accuracy'], -o['best_per_image_ms']) != (m['accuracy'], -m['best_per_image_ms'])
+                        for o in models)
+        if not dominated:
+            front.append(m['name'])
+    return front
+
+def evaluate_models(paths=None, num_workers=NUM_WORKERS, threads=None, batch_sizes=BENCH_BATCH_SIZES,
+                    report_file=REPORT_FILE):
+    if not os.path.exists(DATA_DIR):
+        print(f"Error: '{DATA_DIR}' not found. Please set DATA_DIR in the script.")
+        return
+    try:
+        candidates = [describe(p) for p in paths] if paths else discover()
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}")
+        return
+    if not candidates:
+        print(f"Error: no checkpoints found in {MODELS_DIR}.")
+        return
+
+    dataset = datasets.ImageFolder(DATA_DIR)
+    indices, source = heldout_split(dataset)
+    if source == 'reproduced':
+        print(f"Warning: {SPLIT_FILE} not found; re-deriving the split (seed {SPLIT_SEED}). It only matches "
+              f"train_classifier.py if it trained on the same images in the same order.")
+    print(f"Decoding {len(indices)} held-out images with {num_workers} workers...")
+    arrays, labels = load_heldout(dataset, indices, num_workers)
+    severity = heldout_severity([dataset.samples[i][0] for i in indices])
+    if severity is None:
+        print(f"No severity labels ({CSV_FILE}); severity MAE is skipped.")
+
+    results = []
+    for name, kind, path in candidates:
+        print(f"\n== {name} ({kind}, {path}) ==")
+        try:
+            runner = load_runner(kind, path)
+        except ImportError as e:
+            print(f"Skipped: {e}")
+            continue
+        result = {'name': name, 'kind': kind, 'path': path, 'held_out': held_out(name, kind, source),
+                  'digest': _file_digest(path),
+                  'size_mb': round(os.path.getsize(path) / 2**20, 2),
+                  **score(runner, arrays, labels, severity, len(dataset.classes))}
+        result['latency'] = benchmark(runner, arrays, batch_sizes, threads)
+        result['best_per_image_ms'] = min(r['per_image_ms'] for r in result['latency'])
+        results.append(result)
+        print(f"accuracy {result['accuracy']:.4f}, severity MAE {result['severity_mae']}, "
+              f"best {result['best_per_image_ms']} ms/image")
+        if result['held_out'] is False:
+            print("  Not held out: this model trained on these images, so its numbers are training-set numbers.")
+        for r in result['latency']:
+            print(f"  batch {r['batch_size']:3d} x {r['threads']:2d} threads: {r['batch_ms']:9.2f} ms/batch, "
+                  f"{r['images_per_sec']:7.1f} images/sec")
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'torch': torch.__version__,
+        'cpu_count': os.cpu_count(),
+        'classes': dataset.classes,
+        'split': {'source': source, 'file': SPLIT_FILE if source == 'saved' else None, 'seed': SPLIT_SEED,
+                  'images': len(indices),
+                  'severity_labels': int((~np.isnan(severity)).sum()) if severity is not None else 0},
+        'models': results,
+        'pareto': pareto(results),
+    }
+    os.makedirs(os.path.dirname(report_file) or '.', exist_ok=True)
+    tmp_file = report_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(report, f, indent=2)
+    os.replace(tmp_file, report_file)
+
+    print("\nmodel                              accuracy  severity MAE  best ms/image  held out")
+    for r in sorted(results, key=lambda r: (-r['accuracy'], r['best_per_image_ms'])):
+        mae = '' if r['severity_mae'] is None else f"{r['severity_mae']:.4f}"
+        mark = '*' if r['name'] in report['pareto'] else ' '
+        seen = {True: 'yes', False: 'NO', None: '?'}[r['held_out']]
+        print(f"{mark}{r['name']:34s} {r['accuracy']:8.4f}  {mae:>12s}  {r['best_per_image_ms']:13.3f}  {seen:>8s}")
+    print(f"(* best accuracy/latency tradeoffs; held out NO = scored on its own training images)\n"
+          f"Done! Report saved to {report_file}")
+    return report
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Score checkpoints on the held-out split and benchmark their latency.")
+    parser.add_argument('checkpoints', nargs='*',
+                        help=f"Checkpoints (.pth or model.keras) or exported .pt/.onnx artifacts to evaluate "
+                             f"(default: everything in {MODELS_DIR})")
+    parser.add_argument('--workers', type=int, default=NUM_WORKERS, help="DataLoader workers decoding images")
+    parser.add_argument('--threads', type=int, nargs='+', help="Thread counts to benchmark (default: BENCH_THREADS)")
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=BENCH_BATCH_SIZES)
+    parser.add_argument('--out', default=REPORT_FILE)
+    args = parser.parse_args()
+    evaluate_models(args.checkpoints, args.workers, args.threads, args.batch_sizes, args.out)
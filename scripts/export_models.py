@@ -0,0 +1,378 @@
+import torch
+import torch.nn as nn
+from torchvision import datasets, models, transforms
+from torch.utils.data import DataLoader, Subset
+import importlib.util
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+from shard_cache import SHARD_DIR, ShardDataset, shard_exists
+from train_severity import PotatoSeverityModel, _file_digest
+
+# ---------- CONFIG ----------
+DATA_DIR = 'PlantVillage'
+CLASSIFIER_PATH = 'models/best_classifier.pth'  # From train_classifier.py
+SEVERITY_PATH = 'models/severity_model.pth'     # From train_severity.py
+EXPORT_DIR = 'models/export'
+MANIFEST_FILE = 'models/export/manifest.json'   # Read by api/inference.py to pick a serving artifact
+CALIBRATION_IMAGES = 256   # Images fed through the static INT8 observers
+PARITY_IMAGES = 512        # Held-out images compared against the fp32 model (disjoint from calibration)
+MIN_AGREEMENT = 0.99       # Fraction of images where the artifact predicts the same class as fp32
+MAX_SEVERITY_MAE = 0.02    # Mean absolute severity difference to fp32 (severity is 0-1)
+BENCH_BATCH_SIZES = [1, 16]
+BENCH_RUNS = 20
+QUANT_BACKEND = 'x86'      # 'x86'/'fbgemm' on Intel/AMD servers, 'qnnpack' on ARM
+SEED = 0
+# ----------------------------
+
+IMG_SIZE = 224
+
+# (format, precision) of every artifact the tool tries to produce
+VARIANTS = [
+    ('torchscript', 'fp32'),
+    ('torchscript', 'int8_dynamic'),   # Linear layers only; the convolutions stay fp32
+    ('torchscript', 'int8_static'),    # Convolutions too, calibrated on CALIBRATION_IMAGES
+    ('onnx', 'fp32'),
+    ('onnx', 'int8_static'),
+]
+
+def build_model(name, ckpt_path):
+    """The fp32 reference model, returning a tuple of outputs like the exported artifacts."""
+    if name == 'severity':
+        model = PotatoSeverityModel(num_classes=3, pretrained=False)
+    else:
+        model = models.resnet34(pretrained=False)
+        model.fc = nn.Linear(model.fc.in_features, 3)
+
+    state = torch.load(ckpt_path, map_location='cpu')
+    if 'model_state' in state: state = state['model_state']
+    model.load_state_dict(state)
+    return model.eval()
+
+def _as_tuple(outputs):
+    return tuple(outputs) if isinstance(outputs, (tuple, list)) else (outputs,)
+
+class OnnxRunner:
+    """Calls an ONNX file through onnxruntime with torch tensors in and out."""
+
+    def __init__(self, path):
+        import onnxruntime as ort
+
+        self.session = ort.InferenceSession(path, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, x):
+        outputs = self.session.run(None, {self.input_name: x.detach().cpu().numpy()})
+        return tuple(torch.from_numpy(o) for o in outputs)
+
+def runtime_available(fmt):
+    """TorchScript needs only torch; ONNX artifacts also need onnxruntime."""
+    return fmt != 'onnx' or importlib.util.find_spec('onnxruntime') is not None
+
+def load_artifact(fmt, path):
+    """Load an exported artifact as a callable mapping a CPU batch to a tuple of outputs."""
+    if fmt == 'onnx':
+        return OnnxRunner(path)
+    module = torch.jit.load(path, map_location='cpu').eval()
+    return lambda x: _as_tuple(module(x))
+
+# ---------- Data ----------
+
+def load_dataset():
+    transform = transforms.Compose([
+        transforms.Resize((IMG_SIZE, IMG_SIZE)),
+        transforms.ToTensor(),
+        transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+    ])
+    if shard_exists(SHARD_DIR):
+        print(f"Reading pre-decoded images from {SHARD_DIR}")
+        return ShardDataset(SHARD_DIR)
+    return datasets.ImageFolder(DATA_DIR, transform=transform)
+
+def split_indices(n, seed=SEED):
+    """Disjoint, seeded calibration and parity subsets of the dataset."""
+    order = list(range(n))
+    random.Random(seed).shuffle(order)
+    calibration = order[:CALIBRATION_IMAGES]
+    parity = order[CALIBRATION_IMAGES:CALIBRATION_IMAGES + PARITY_IMAGES]
+    return calibration, parity
+
+def batches(dataset, indices, batch_size=32):
+    loader = DataLoader(Subset(dataset, indices), batch_size=batch_size, shuffle=False)
+    for item in loader:
+        yield item[0]
+
+# ---------- Export ----------
+
+def export_torchscript(model, path):
+    example = torch.randn(1, 3, IMG_SIZE, IMG_SIZE)
+    with torch.no_grad():
+        traced = torch.jit.freeze(torch.jit.trace(model, example).eval())
+    traced.save(path)
+
+def quantize_dynamic(model):
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+def quantize_static(model, calibration):
+    """Post-training static INT8 via FX graph mode, observers fed with calibration batches."""
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    torch.backends.quantized.engine = QUANT_BACKEND
+    example = (torch.randn(1, 3, IMG_SIZE, IMG_SIZE),)
+    prepared = prepare_fx(model, get_default_qconfig_mapping(QUANT_BACKEND), example)
+    with torch.no_grad():
+        for imgs in calibration:
+            prepared(imgs)
+    return convert_fx(prepared)
+
+def export_onnx(model, path, output_names):
+    torch.onnx.export(
+        model, (torch.randn(1, 3, IMG_SIZE, IMG_SIZE),), path,
+        input_names=['input'], output_names=output_names,
+        dynamic_axes={'input': {0: 'batch'}, **{name: {0: 'batch'} for name in output_names}},
+        opset_version=17, dynamo=False,
+    )
+
+def quantize_onnx_static(fp32_path, path, calibration):
+    from onnxruntime.quantization import (CalibrationDataReader, QuantFormat, QuantType,
+                                          quantize_static as ort_quantize_static)
+
+    class Reader(CalibrationDataReader):
+        def __init__(self):
+            self.batches = iter([{'input': imgs.numpy()} for imgs in calibration])
+
+        def get_next(self):
+            return next(self.batches, None)
+
+    ort_quantize_static(fp32_path, path, Reader(), quant_format=QuantFormat.QDQ, per_channel=True,
+                        activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+
+def export_variant(name, model, fmt, precision, path, calibration):
+    """Write one artifact; returns False when its toolchain is not installed here."""
+    output_names = ['logits', 'severity'] if name == 'severity' else ['logits']
+    if fmt == 'torchscript':
+        if precision == 'int8_dynamic':
+            model = quantize_dynamic(model)
+        elif precision == 'int8_static':
+            model = quantize_static(model, calibration)
+        export_torchscript(model, path)
+        return True
+
+    if importlib.util.find_spec('onnx') is None:
+        print(f"Skipping {path}: the onnx package is not installed.")
+        return False
+    if precision == 'fp32':
+        export_onnx(model, path, output_names)
+        return True
+    if not runtime_available('onnx'):
+        print(f"Skipping {path}: onnxruntime is not installed.")
+        return False
+    fp32_path = os.path.join(EXPORT_DIR, f"{name}.fp32.onnx")
+    if not os.path.exists(fp32_path):
+        export_onnx(model, fp32_path, output_names)
+    quantize_onnx_static(fp32_path, path, calibration)
+    return True
+
+# ---------- Parity and benchmarks ----------
+
+def run_outputs(runner, parity_batches):
+    """Predicted classes and severities (None for the classifier) over the parity set."""
+    classes, severities = [], []
+    with torch.no_grad():
+        for imgs in parity_batches:
+            outputs = runner(imgs)
+            classes.append(outputs[0].argmax(dim=1))
+            if len(outputs) > 1:
+                severities.append(outputs[1].reshape(-1).float())
+    return torch.cat(classes), torch.cat(severities) if severities else None
+
+def parity(reference, outputs):
+    ref_classes, ref_sev = reference
+    classes, sev = outputs
+    report = {'agreement': round((classes == ref_classes).float().mean().item(), 4)}
+    if ref_sev is not None and sev is not None:
+        report['severity_mae'] = round((sev - ref_sev).abs().mean().item(), 4)
+    return report
+
+def passes(report):
+    return (report['agreement'] >= MIN_AGREEMENT
+            and report.get('severity_mae', 0.0) <= MAX_SEVERITY_MAE)
+
+def benchmark(runner):
+    """Median wall time (ms) of one forward at each of BENCH_BATCH_SIZES."""
+    latency = {}
+    with torch.no_grad():
+        for batch_size in BENCH_BATCH_SIZES:
+            x = torch.randn(batch_size, 3, IMG_SIZE, IMG_SIZE)
+            for _ in range(3):
+                runner(x)
+            times = []
+            for _ in range(BENCH_RUNS):
+                start = time.perf_counter()
+                runner(x)
+                times.append(time.perf_counter() - start)
+            latency[str(batch_size)] = round(sorted(times)[len(times) // 2] * 1000, 2)
+    return latency
+
+def per_image_ms(latency):
+    batch_size = max(BENCH_BATCH_SIZES)
+    return round(latency[str(batch_size)] / batch_size, 3)
+
+def peak_rss_mb(fmt, path, name=''):
+    """Peak RSS (MB) of a fresh interpreter that loads the artifact and runs one image.
+
+    Measured out of process so earlier exports don't pollute the number; the
+    cost of importing torch alone (fmt 'none') is subtracted by the caller.
+    """
+    proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--probe-rss', fmt, path, name],
+                          capture_output=True, text=True)
+    if proc.returncode != 0:
+        print(f"Memory probe failed for {path}:\n{proc.stderr}")
+        return None
+    return float(proc.stdout.strip().splitlines()[-1])
+
+def _probe_rss(fmt, path, name=''):
+    if fmt != 'none':
+        runner = load_artifact(fmt, path) if fmt != 'checkpoint' else build_model(name, path)
+        with torch.no_grad():
+            runner(torch.randn(1, 3, IMG_SIZE, IMG_SIZE))
+    # VmHWM is reset by exec; ru_maxrss on Linux would still include the parent's peak
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                print(int(line.split()[1]) / 1024)
+
+# ---------- Manifest ----------
+
+def read_manifest(manifest_path=MANIFEST_FILE):
+    """The manifest with artifact paths resolved next to it, or None if it doesn't exist."""
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    for entry in manifest.get('artifacts', []):
+        entry['path'] = os.path.join(base_dir, entry['path'])
+    return manifest
+
+def select_fastest(name, manifest_path=MANIFEST_FILE, ckpt_path=None):
+    """Fastest artifact for `name` that passed parity and can run here.
+
+    Returns None when there is no manifest, nothing passed, the fp32 checkpoint
+    is at least as fast, or the manifest was built from a different checkpoint
+    than `ckpt_path`.
+    """
+    manifest = read_manifest(manifest_path)
+    source = (manifest or {}).get('sources', {}).get(name)
+    if source is None:
+        return None
+    if ckpt_path is not None and os.path.exists(ckpt_path) and _file_digest(ckpt_path) != source['digest']:
+        print(f"Ignoring exported {name} artifacts: built from a different checkpoint than {ckpt_path}.")
+        return None
+
+    candidates = [e for e in manifest['artifacts']
+                  if e['model'] == name and e['passes'] and runtime_available(e['format'])
+                  and os.path.exists(e['path'])]
+    if not candidates:
+        return None
+    best = min(candidates, key=lambda e: e['per_image_ms'])
+    return best if best['per_image_ms'] < source['per_image_ms'] else None
+
+def export_models():
+    if not os.path.exists(DATA_DIR) and not shard_exists(SHARD_DIR):
+        print(f"Error: '{DATA_DIR}' not found. Please set DATA_DIR in the script.")
+        return
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    torch.manual_seed(SEED)
+
+    dataset = load_dataset()
+    calibration_idx, parity_idx = split_indices(len(dataset))
+    calibration = list(batches(dataset, calibration_idx))
+    parity_batches = list(batches(dataset, parity_idx))
+    print(f"{len(calibration_idx)} calibration images, {len(parity_idx)} parity images.")
+
+    base_rss = peak_rss_mb('none', '')
+    manifest = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'quant_backend': QUANT_BACKEND,
+        'torch': torch.__version__,
+        'thresholds': {'min_agreement': MIN_AGREEMENT, 'max_severity_mae': MAX_SEVERITY_MAE},
+        'parity_images': len(parity_idx),
+        'sources': {},
+        'artifacts': [],
+    }
+
+    for name, ckpt_path in [('classifier', CLASSIFIER_PATH), ('severity', SEVERITY_PATH)]:
+        if not os.path.exists(ckpt_path):
+            print(f"Skipping {name}: {ckpt_path} not found.")
+            continue
+        print(f"\n== {name} ({ckpt_path}) ==")
+        model = build_model(name, ckpt_path)
+        runner = lambda x, m=model: _as_tuple(m(x))
+        reference = run_outputs(runner, parity_batches)
+        latency = benchmark(runner)
+        rss = peak_rss_mb('checkpoint', ckpt_path, name)
+        manifest['sources'][name] = {
+            'path': ckpt_path, 'digest': _file_digest(ckpt_path),
+            'size_mb': round(os.path.getsize(ckpt_path) / 2**20, 2),
+            'rss_mb': round(rss - base_rss, 1) if rss is not None else None,
+            'latency_ms': latency, 'per_image_ms': per_image_ms(latency),
+        }
+        print(f"fp32 checkpoint: {latency} ms")
+
+        for fmt, precision in VARIANTS:
+            ext = 'onnx' if fmt == 'onnx' else 'pt'
+            path = os.path.join(EXPORT_DIR, f"{name}.{precision}.{ext}")
+            # Quantization rewrites the module, so every variant starts from a fresh copy
+            if not export_variant(name, build_model(name, ckpt_path), fmt, precision, path, calibration):
+                continue
+            if not runtime_available(fmt):
+                print(f"Exported {path} (not benchmarked: runtime missing)")
+                continue
+
+            runner = load_artifact(fmt, path)
+            report = parity(reference, run_outputs(runner, parity_batches))
+            latency = benchmark(runner)
+            rss = peak_rss_mb(fmt, path)
+            entry = {
+                'name': f"{name}.{fmt}.{precision}", 'model': name, 'format': fmt, 'precision': precision,
+                'path': os.path.relpath(path, os.path.dirname(MANIFEST_FILE)),
+                'size_mb': round(os.path.getsize(path) / 2**20, 2),
+                'rss_mb': round(rss - base_rss, 1) if rss is not None else None,
+                'latency_ms': latency, 'per_image_ms': per_image_ms(latency),
+                **report, 'passes': passes(report),
+            }
+            manifest['artifacts'].append(entry)
+            print(f"{entry['name']:32s} {'PASS' if entry['passes'] else 'FAIL'} {report} "
+                  f"{latency} ms, {entry['size_mb']} MB on disk, {entry['rss_mb']} MB RSS")
+
+    tmp_file = MANIFEST_FILE + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_file, MANIFEST_FILE)
+
+    for name in manifest['sources']:
+        best = select_fastest(name)
+        print(f"Serving choice for {name}: {best['name'] if best else 'fp32 checkpoint'}")
+    print(f"Done! Manifest saved to {MANIFEST_FILE}")
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--probe-rss':
+        _probe_rss(*sys.argv[2:5])
+        sys.exit(0)
+
+    import argparse
+    parser = argparse.ArgumentParser(description="Export TorchScript/ONNX (fp32 and INT8) serving artifacts.")
+    parser.add_argument('--backend', default=QUANT_BACKEND, help="Quantized engine: x86, fbgemm or qnnpack")
+    parser.add_argument('--min-agreement', type=float, default=MIN_AGREEMENT)
+    parser.add_argument('--max-severity-mae', type=float, default=MAX_SEVERITY_MAE)
+    args = parser.parse_args()
+    QUANT_BACKEND = args.backend
+    MIN_AGREEMENT = args.min_agreement
+    MAX_SEVERITY_MAE = args.max_severity_mae
+    export_models()
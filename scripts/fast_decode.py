@@ -0,0 +1,91 @@
+import threading
+
+import numpy as np
+import torch
+from PIL import Image
+
+# ---------- CONFIG ----------
+IMG_SIZE = 224
+MAX_PIXELS = 50_000_000   # Largest input accepted (48 MP phone photos fit), checked from the header
+# ----------------------------
+
+MEAN = [0.485, 0.456, 0.406]
+STD = [0.229, 0.224, 0.225]
+
+class ImageTooLarge(ValueError):
+    pass
+
+def open_checked(source, max_pixels=MAX_PIXELS):
+    """Open an image (path or file object) and check its size from the header, before decoding any pixels."""
+    image = Image.open(source)
+    width, height = image.size
+    if width * height > max_pixels:
+        raise ImageTooLarge(f"Image is {width}x{height} ({width * height / 1e6:.0f} MP), "
+                            f"the limit is {max_pixels / 1e6:.0f} MP")
+    return image
+
+def decode_resized(source, size=IMG_SIZE, max_pixels=MAX_PIXELS):
+    """Decode straight to a size x size RGB image, the way transforms.Resize((size, size)) would see it.
+
+    JPEGs are downscaled in the DCT domain while decoding (``draft``: 1/2, 1/4
+    or 1/8 scale, never below the target), so a 48 MP photo is never fully
+    decoded. Other formats are shrunk by an integer box ``reduce`` first. The
+    final bilinear resize is the same one torchvision applies.
+    """
+    image = open_checked(source, max_pixels)
+    if image.format == 'JPEG':
+        image.draft('RGB', (size, size))
+    image = image.convert('RGB')
+
+    factor = min(image.width // size, image.height // size)
+    if factor >= 2:
+        image = image.reduce(factor)
+    if image.size != (size, size):
+        image = image.resize((size, size), Image.BILINEAR)
+    return image
+
+def to_uint8(image):
+    """(H, W, 3) uint8 array of a decoded image; four times smaller than a float tensor while queued."""
+    return np.array(image, dtype=np.uint8)
+
+def resize_array(array, size=IMG_SIZE):
+    """Bilinear resize of a uint8 HWC array to size x size."""
+    return np.array(Image.fromarray(array).resize((size, size), Image.BILINEAR))
+
+class BufferPool:
+    """Reusable (N, 3, size, size) float32 batch buffers, so steady-state serving allocates nothing per batch."""
+
+    def __init__(self, max_batch_size, size=IMG_SIZE, keep=2):
+        self.shape = (max_batch_size, 3, size, size)
+        self.keep = keep
+        self.free = []
+        self.lock = threading.Lock()
+
+    def acquire(self, n):
+        """A buffer with room for n images; batches larger than the pool's get a one-off buffer."""
+        if n > self.shape[0]:
+            return torch.empty((n,) + self.shape[1:])
+        with self.lock:
+            if self.free:
+                return self.free.pop()
+        return torch.empty(self.shape)
+
+    def release(self, buffer):
+        with self.lock:
+            if buffer.shape == self.shape and len(self.free) < self.keep:
+                self.free.append(buffer)
+
+# (x / 255 - mean) / std  ==  x * scale - offset
+_scale = (1 / (255 * torch.tensor(STD))).view(1, 3, 1, 1)
+_offset = (torch.tensor(MEAN) / torch.tensor(STD)).view(1, 3, 1, 1)
+
+def normalize_into(arrays, buffer):
+    """Write ImageNet-normalized copies of uint8 HWC arrays into the first len(arrays) slots of buffer.
+
+    Same values as ToTensor() + Normalize(MEAN, STD), computed in place.
+    """
+    batch = buffer[:len(arrays)]
+    for slot, array in zip(batch, arrays):
+        slot.copy_(torch.from_numpy(array).permute(2, 0, 1))
+    batch.mul_(_scale).sub_(_offset)
+    return batch
@@ -0,0 +1,198 @@
+import numpy as np
+import csv
+import hashlib
+import json
+import os
+
+# ---------- CONFIG ----------
+CSV_FILE = 'pseudo_severity.csv'                 # Written by severity_prep.py
+STORE_DIR = 'cache/pseudo_severity.labels'       # Read by train_severity.py
+CHUNK_ROWS = 1 << 20                             # Rows per pass when scanning columns
+WRITE_ROWS = 1 << 16                             # Rows buffered by LabelWriter between writes
+# ----------------------------
+
+# Column files are raw little-endian arrays opened with np.memmap, so opening a
+# store and slicing it costs the same for 2,000 images as for 20 million.
+COLUMNS = {
+    'class': '<i1',         # Class index (ImageFolder order)
+    'severity': '<f4',      # Pseudo severity, 0-1
+    'dir': '<u4',           # Index into meta.json "dirs" (interned parent folders)
+    'name_end': '<u8',      # End offset of the file name in names.bin (the start is the previous row's end)
+}
+
+def normalize_path(path):
+    """Compare paths written on Windows (PlantVillage\\...) and Linux alike."""
+    return os.path.normpath(path.replace('\\', '/'))
+
+def _posix(path):
+    return normalize_path(path).replace(os.sep, '/')
+
+class LabelWriter:
+    """Streams (path, class, severity) rows into a new store directory.
+
+    Rows go straight to the column files, so converting a CSV of any size
+    needs constant memory. meta.json is written last, on close(), so a store
+    without it is incomplete (like the shard cache).
+    """
+
+    def __init__(self, store_dir, source=None):
+        os.makedirs(store_dir, exist_ok=True)
+        self.store_dir = store_dir
+        self.meta_path = os.path.join(store_dir, 'meta.json')
+        if os.path.exists(self.meta_path):
+            os.remove(self.meta_path)
+        self.source = source
+        self.files = {name: open(os.path.join(store_dir, f'{name}.bin'), 'wb') for name in COLUMNS}
+        self.names = open(os.path.join(store_dir, 'names.bin'), 'wb')
+        self.dirs = {}
+        self.count = 0
+        self.name_end = 0
+        self.digest = hashlib.sha256()
+        self.pending = []
+
+    def add(self, path, label, severity):
+        parent, name = os.path.split(_posix(path))
+        encoded = name.encode('utf-8')
+        self.names.write(encoded)
+        self.name_end += len(encoded)
+        self.digest.update(f"{parent}/{name},{int(label)},{float(severity):.6f}\n".encode('utf-8'))
+        self.pending.append((int(label), float(severity), self.dirs.setdefault(parent, len(self.dirs)), self.name_end))
+        self.count += 1
+        if len(self.pending) >= WRITE_ROWS:
+            self._flush()
+
+    def _flush(self):
+        if not self.pending:
+            return
+        for name, column in zip(COLUMNS, zip(*self.pending)):
+            self.files[name].write(np.asarray(column, dtype=COLUMNS[name]).tobytes())
+        self.pending = []
+
+    def close(self):
+        self._flush()
+        for f in [*self.files.values(), self.names]:
+            f.close()
+        dirs = sorted(self.dirs, key=self.dirs.get)
+        with open(self.meta_path, 'w') as f:
+            json.dump({'count': self.count, 'columns': COLUMNS, 'dirs': dirs,
+                       'digest': self.digest.hexdigest()[:16], 'source': self.source}, f, indent=2)
+
+class LabelStore:
+    """Read side of a store written by LabelWriter (or convert_csv).
+
+    `classes` and `severity` are memory-mapped typed columns, `select()` returns
+    the rows matching a class and/or severity range, and `path(row)` rebuilds
+    a row's image path for the current OS.
+    """
+
+    def __init__(self, store_dir=STORE_DIR):
+        with open(os.path.join(store_dir, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.store_dir = store_dir
+        self.digest = self.meta['digest']
+        self.dirs = [normalize_path(d) if d else '' for d in self.meta['dirs']]
+        self._columns = None  # Mapped lazily so each DataLoader worker maps its own view
+
+    def __len__(self):
+        return self.meta['count']
+
+    def __getstate__(self):
+        return {**self.__dict__, '_columns': None}
+
+    def column(self, name):
+        if self._columns is None:
+            count = self.meta['count']
+            self._columns = {}
+            for key, dtype in [*COLUMNS.items(), ('names', 'u1')]:
+                file = os.path.join(self.store_dir, f'{key}.bin')
+                # np.memmap cannot map empty files
+                self._columns[key] = (np.memmap(file, dtype=dtype, mode='r') if os.path.getsize(file)
+                                      else np.zeros(0, dtype=dtype))
+            if len(self._columns['class']) != count:
+                raise ValueError(f"{self.store_dir} is truncated: {len(self._columns['class'])} of {count} rows")
+        return self._columns[name]
+
+    @property
+    def classes(self):
+        return self.column('class')
+
+    @property
+    def severity(self):
+        return self.column('severity')
+
+    def path(self, row):
+        ends = self.column('name_end')
+        start = int(ends[row - 1]) if row else 0
+        name = bytes(self.column('names')[start:int(ends[row])]).decode('utf-8')
+        return os.path.join(self.dirs[int(self.column('dir')[row])], name)
+
+    def paths(self, rows=None):
+        for row in range(len(self)) if rows is None else rows:
+            yield self.path(int(row))
+
+    def select(self, classes=None, min_severity=None, max_severity=None):
+        """Row indices (int64) with a class in `classes` and severity within [min, max], in store order.
+
+        Scans the columns CHUNK_ROWS at a time, so only the result is held in memory.
+        """
+        wanted = None if classes is None else np.asarray(list(classes), dtype=COLUMNS['class'])
+        found = []
+        for start in range(0, len(self), CHUNK_ROWS):
+            end = min(start + CHUNK_ROWS, len(self))
+            mask = np.ones(end - start, dtype=bool)
+            if wanted is not None:
+                mask &= np.isin(self.classes[start:end], wanted)
+            if min_severity is not None or max_severity is not None:
+                severity = self.severity[start:end]
+                if min_severity is not None:
+                    mask &= severity >= min_severity
+                if max_severity is not None:
+                    mask &= severity <= max_severity
+            found.append(np.flatnonzero(mask) + start)
+        return np.concatenate(found) if found else np.zeros(0, dtype=np.int64)
+
+def _file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def convert_csv(csv_file=CSV_FILE, store_dir=STORE_DIR):
+    """Convert a path,class,severity CSV (as written by severity_prep.py) into a store."""
+    writer = LabelWriter(store_dir, source={'path': csv_file, 'sha256': _file_sha256(csv_file)})
+    with open(csv_file, 'r', newline='') as f:
+        for item in csv.DictReader(f):
+            writer.add(item['path'], int(item['class']), float(item['severity']))
+    writer.close()
+    print(f"Converted {writer.count} labels from {csv_file} into {store_dir} ({len(writer.dirs)} folders)")
+    return LabelStore(store_dir)
+
+def load_labels(csv_file=CSV_FILE, store_dir=STORE_DIR):
+    """The store for csv_file, (re)converting it first if it is missing or the CSV has changed.
+
+    Without the CSV (e.g. a store built elsewhere) the store is used as is.
+    """
+    meta_path = os.path.join(store_dir, 'meta.json')
+    if os.path.exists(meta_path):
+        store = LabelStore(store_dir)
+        source = store.meta.get('source') or {}
+        if not os.path.exists(csv_file) or source.get('sha256') == _file_sha256(csv_file):
+            return store
+    return convert_csv(csv_file, store_dir)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Convert pseudo_severity.csv into a binary label store.")
+    parser.add_argument('csv', nargs='?', default=CSV_FILE)
+    parser.add_argument('--out', default=STORE_DIR)
+    parser.add_argument('--class', dest='classes', type=int, nargs='+', help="Only count rows of these classes")
+    parser.add_argument('--min-severity', type=float)
+    parser.add_argument('--max-severity', type=float)
+    args = parser.parse_args()
+
+    store = convert_csv(args.csv, args.out)
+    rows = store.select(args.classes, args.min_severity, args.max_severity)
+    print(f"{len(rows)} of {len(store)} rows match")
+    for path in store.paths(rows[:5]):
+        print(f"  {path}")
@@ -0,0 +1,169 @@
+import torch
+from contextlib import nullcontext
+
+from distributed import NUM_WORKERS, launch
+
+# ---------- CONFIG ----------
+# Opt-in CPU throughput mode for train_classifier.py and train_severity.py (--perf).
+# It pays off on CPUs with AVX512-BF16/AMX; measure it on yours with
+#   python scripts/train_severity.py --perf-report
+# The first steps are slower while torch.compile builds the graph.
+BF16 = True             # torch.autocast(dtype=bfloat16) around forward and loss
+CHANNELS_LAST = True    # NHWC weights and inputs (what the oneDNN bf16 kernels want)
+COMPILE = True          # torch.compile the forward + loss step
+ACCUM_STEPS = 1         # Micro-batches per optimizer step (effective batch = BATCH_SIZE * ACCUM_STEPS * procs)
+SEED = 0                # Same initialization and data order for both modes in --perf-report
+EVAL_BATCHES = 20       # Batches scored after --perf-report training
+ACCURACY_TOLERANCE = 0.02  # Largest accuracy drop of perf mode against baseline that still passes
+MIN_ACCURACY_STEPS = 300   # Shorter runs leave both modes near chance, so their accuracies say nothing
+# ----------------------------
+
+class PerfMode:
+    """How a training step runs: plain fp32 eager (enabled=False) or the throughput mode."""
+
+    def __init__(self, enabled=False, accum_steps=ACCUM_STEPS, bf16=BF16, channels_last=CHANNELS_LAST,
+                 compile=COMPILE):
+        self.enabled = enabled
+        self.accum_steps = max(1, accum_steps)
+        self.bf16 = enabled and bf16
+        self.channels_last = enabled and channels_last
+        self.compile = enabled and compile
+
+    def describe(self):
+        if not self.enabled:
+            return f"fp32 eager, {self.accum_steps} micro-batch(es) per step"
+        parts = [name for name, on in (('bf16 autocast', self.bf16), ('channels_last', self.channels_last),
+                                        ('torch.compile', self.compile)) if on]
+        return f"{', '.join(parts) or 'perf mode'}, {self.accum_steps} micro-batch(es) per step"
+
+    def prepare(self, model):
+        """Call before wrapping the model in DDP."""
+        return model.to(memory_format=torch.channels_last) if self.channels_last else model
+
+    def inputs(self, images, device):
+        images = images.to(device, non_blocking=True)
+        return images.contiguous(memory_format=torch.channels_last) if self.channels_last else images
+
+    def autocast(self, device):
+        if not self.bf16:
+            return nullcontext()
+        return torch.autocast(device.type, dtype=torch.bfloat16)
+
+    def loss_fn(self, fn, device):
+        """Wrap fn(*batch) -> loss in autocast and, if enabled, torch.compile."""
+        def step(*batch):
+            with self.autocast(device):
+                return fn(*batch)
+        # Static shapes: an epoch's smaller last batch gets its own graph once instead of
+        # turning every step into a slower dynamic-shape graph
+        return torch.compile(step, dynamic=False) if self.compile else step
+
+class Trainer:
+    """Runs forward/backward for each micro-batch and steps the optimizer every accum_steps of them.
+
+    The running loss stays a device tensor (no .item() host sync per step);
+    read it once per epoch with epoch_loss().
+    """
+
+    def __init__(self, model, optimizer, loss_fn, perf, device):
+        self.model = model
+        self.optimizer = optimizer
+        self.perf = perf
+        self.loss_fn = perf.loss_fn(loss_fn, device)
+        self.device = device
+        self.micro_step = 0
+        self.loss_sum = torch.zeros((), device=device)
+
+    def step(self, *batch, count):
+        """One micro-batch of `count` images; returns True when the optimizer stepped."""
+        accum = self.perf.accum_steps
+        last = (self.micro_step + 1) % accum == 0
+        # DDP would all-reduce on every backward; only sync on the micro-batch that steps
+        sync = last or not hasattr(self.model, 'no_sync')
+        with nullcontext() if sync else self.model.no_sync():
+            loss = self.loss_fn(*batch)
+            (loss / accum).backward()
+        self.loss_sum += loss.detach().float() * count
+        self.micro_step += 1
+        if last:
+            self.optimizer.step()
+            self.optimizer.zero_grad(set_to_none=True)
+        return last
+
+    def flush(self):
+        """Step on gradients left over from an epoch that did not end on a full accumulation."""
+        if self.micro_step % self.perf.accum_steps:
+            self.optimizer.step()
+            self.optimizer.zero_grad(set_to_none=True)
+            self.micro_step = 0
+
+    def epoch_loss(self):
+        """Summed per-image loss since the last call (one host sync)."""
+        total = self.loss_sum.item()
+        self.loss_sum.zero_()
+        return total
+
+def evaluate(model, loader, device, perf, max_batches=None):
+    """Accuracy (and severity MAE for (image, label, severity) batches) of `model` in eval mode.
+
+    Also returns the raw `correct` and `total` counts, for summing over processes.
+    """
+    model.eval()
+    correct = torch.zeros((), dtype=torch.int64, device=device)
+    abs_err = torch.zeros((), dtype=torch.float64, device=device)
+    total, has_severity = 0, False
+    with torch.no_grad():
+        for i, batch in enumerate(loader):
+            if max_batches is not None and i >= max_batches:
+                break
+            images, labels = perf.inputs(batch[0], device), batch[1].to(device)
+            with perf.autocast(device):
+                outputs = model(images)
+            logits = outputs[0] if isinstance(outputs, tuple) else outputs
+            correct += (logits.argmax(1) == labels).sum()
+            total += labels.size(0)
+            if len(batch) > 2:
+                has_severity = True
+                abs_err += (outputs[1].float().squeeze(1) - batch[2].to(device)).abs().sum()
+    model.train()
+    correct = correct.item()
+    result = {'accuracy': correct / total if total else 0.0, 'correct': correct, 'total': total}
+    if has_severity:
+        result['severity_mae'] = abs_err.item() / total if total else 0.0
+    return result
+
+def seed_everything(seed=SEED):
+    torch.manual_seed(seed)
+
+def perf_report(fn, max_steps, accum_steps=ACCUM_STEPS, threads=None, args=(), tolerance=ACCURACY_TOLERANCE,
+                num_workers=NUM_WORKERS):
+    """Train max_steps steps in baseline and perf mode from the same seed, then compare.
+
+    fn(rank, world_size, *args, max_steps, perf, eval_batches) must return a
+    dict with 'images_per_sec' and 'accuracy' (and optionally 'severity_mae').
+    Returns True if perf mode's accuracy is within `tolerance` of baseline.
+    Below MIN_ACCURACY_STEPS the images/sec are still reported, but the
+    accuracy check is inconclusive and returns None.
+    """
+    results = {}
+    for name, perf in (('baseline', PerfMode(False, accum_steps)), ('perf', PerfMode(True, accum_steps))):
+        print(f"\n{name}: {perf.describe()}")
+        results[name] = launch(fn, 1, threads, args=(*args, max_steps, perf, EVAL_BATCHES), num_workers=num_workers)
+
+    base = results['baseline']
+    print("\nmode      images/sec  speedup  accuracy  severity MAE")
+    for name, result in results.items():
+        speedup = result['images_per_sec'] / base['images_per_sec'] if base['images_per_sec'] else 0.0
+        mae = result.get('severity_mae')
+        print(f"{name:8s}  {result['images_per_sec']:10.1f}  {speedup:6.2f}x  {result['accuracy']:8.4f}  "
+              f"{'' if mae is None else f'{mae:12.4f}'}")
+
+    drop = base['accuracy'] - results['perf']['accuracy']
+    if max_steps < MIN_ACCURACY_STEPS:
+        print(f"\nAccuracy check inconclusive: {max_steps} steps leave both modes near chance "
+              f"(perf mode {drop:+.4f} below baseline). Rerun with --max-steps {MIN_ACCURACY_STEPS} or more.")
+        return None
+    ok = drop <= tolerance
+    print(f"\nAccuracy {'within' if ok else 'OUTSIDE'} tolerance: perf mode is {drop:+.4f} below baseline "
+          f"(allowed {tolerance})")
+    return ok
@@ -5,15 +5,29 @@ from torchvision import models, transforms, datasets
 import numpy as np
 import cv2
 import csv
+import hashlib
 import os
+from torch.utils.data import DataLoader, Subset
+
+from label_store import STORE_DIR, convert_csv
+from shard_cache import SHARD_DIR, ShardDataset, shard_exists
 
 # ---------- CONFIG ----------
 # Update this path to point to your image dataset folder
 DATA_DIR = 'PlantVillage' 
 CKPT_PATH = 'models/best_classifier.pth'
 CSV_FILE = 'pseudo_severity.csv'
+CACHE_FILE = 'pseudo_severity.cache.csv'  # Resumable label log, keyed by image hash + checkpoint
+CHUNK_SIZE = 256                          # Labels per durable append to CACHE_FILE
+CAM_MODE = 'cam'      # 'cam' (batched, no backward pass) or 'gradcam' (original per-image path)
+BATCH_SIZE = 64
+NUM_WORKERS = 4
 # ----------------------------
 
+CAM_THRESHOLD = 0.4   # Activation above which a pixel counts as lesion
+SEVERITY_SCALE = 3.0  # GradCAM is coarse, so we scale up small activations
+IMG_SIZE = 224
+
 class GradCAM:
     def __init__(self, model, target_layer):
         self.model = model
@@ -52,7 +66,142 @@ class GradCAM:
             
         return cam.detach().cpu().numpy()[0, 0]
 
-def generate_pseudo_labels():
+def layer4_features(model, x):
+    """Run a torchvision ResNet up to layer4 and return its (B, 512, 7, 7) activations."""
+    x = model.maxpool(model.relu(model.bn1(model.conv1(x))))
+    x = model.layer4(model.layer3(model.layer2(model.layer1(x))))
+    return x
+
+def cam_severity(features, fc_weight, class_idx):
+    """Thresholded CAM severity for a whole batch.
+
+    With global average pooling followed by a linear layer, the Grad-CAM channel
+    weights are just ``fc.weight[class] / (H * W)``, so the normalized map equals
+    the plain CAM and no backward pass is needed.
+    """
+    weights = fc_weight[class_idx]                                   # (B, C)
+    cam = F.relu(torch.einsum('bc,bchw->bhw', weights, features)).unsqueeze(1)
+
+    # Normalize each map to 0-1 (all-zero maps stay zero)
+    peak = cam.amax(dim=(2, 3), keepdim=True)
+    cam = torch.where(peak > 0, cam / peak.clamp_min(1e-12), cam)
+
+    # Same bilinear upsampling as cv2.resize, then threshold to a lesion mask
+    cam = F.interpolate(cam, size=(IMG_SIZE, IMG_SIZE), mode='bilinear', align_corners=False)
+    lesion_pixels = (cam > CAM_THRESHOLD).flatten(1).sum(dim=1)
+    severity = lesion_pixels.float() / (IMG_SIZE * IMG_SIZE)
+    return (severity * SEVERITY_SCALE).clamp(max=1.0)
+
+def _label_with_gradcam(model, dataset, indices, device):
+    """Yield (index, label, severity) for each dataset index, one image at a time."""
+    # Hook into the last convolutional layer (layer4 for ResNet)
+    grad_cam = GradCAM(model, model.layer4)
+
+    for n, i in enumerate(indices):
+        img, label = dataset[i]
+        
+        img_tensor = img.unsqueeze(0).to(device).requires_grad_(True)
+        
+        # Get Heatmap
+        mask = grad_cam(img_tensor, label)
+        
+        # Resize heatmap to original image size
+        mask_resized = cv2.resize(mask, (IMG_SIZE, IMG_SIZE))
+        
+        # Threshold to approximate lesion mask (intensity > 0.4)
+        lesion_pixels = np.sum(mask_resized > CAM_THRESHOLD)
+        total_pixels = IMG_SIZE * IMG_SIZE
+        
+        # Calculate severity ratio
+        severity = lesion_pixels / total_pixels
+        
+        # Heuristic scaling (GradCAM is coarse, so we scale up small activations)
+        severity = min(severity * SEVERITY_SCALE, 1.0)
+        
+        yield i, label, severity
+        
+        if n % 50 == 0:
+            print(f"Processed {n}/{len(indices)}")
+
+def _label_with_cam(model, dataset, indices, device, batch_size=BATCH_SIZE, num_workers=NUM_WORKERS):
+    """Yield (index, label, severity) for each dataset index, a batch at a time."""
+    loader = DataLoader(Subset(dataset, indices), batch_size=batch_size, shuffle=False,
+                        num_workers=num_workers, pin_memory=device.type == 'cuda')
+    fc_weight = model.fc.weight.detach()
+    done = 0
+
+    with torch.no_grad():
+        for imgs, labels in loader:
+            imgs, labels = imgs.to(device, non_blocking=True), labels.to(device)
+            severities = cam_severity(layer4_features(model, imgs), fc_weight, labels)
+
+            for label, severity in zip(labels.tolist(), severities.tolist()):
+                yield indices[done], label, severity
+                done += 1
+
+            print(f"Processed {done}/{len(indices)}")
+
+def file_sha256(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def labeling_fingerprint(ckpt_path):
+    """Identify everything that changes a label: checkpoint bytes plus the severity heuristic."""
+    return hashlib.sha256(
+        f"{file_sha256(ckpt_path)}:{CAM_THRESHOLD}:{SEVERITY_SCALE}:{IMG_SIZE}".encode()
+    ).hexdigest()[:16]
+
+class LabelCache:
+    """Append-only log of computed labels keyed by (image sha256, class, fingerprint).
+
+    Rows are flushed and fsynced every ``CHUNK_SIZE`` labels, so an interrupted run
+    loses at most one chunk and the next run picks up where it stopped. A torn
+    last line from a crash is ignored on load.
+    """
+    FIELDS = ['sha256', 'class', 'fingerprint', 'severity']
+
+    def __init__(self, path, fingerprint):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.entries = {}
+        self.pending = []
+
+        if os.path.exists(path):
+            with open(path, 'r', newline='') as f:
+                for row in csv.DictReader(f):
+                    try:
+                        if row['fingerprint'] == fingerprint:
+                            self.entries[(row['sha256'], int(row['class']))] = float(row['severity'])
+                    except (KeyError, TypeError, ValueError):
+                        continue
+
+    def get(self, sha, label):
+        return self.entries.get((sha, label))
+
+    def add(self, sha, label, severity):
+        self.entries[(sha, label)] = severity
+        self.pending.append({'sha256': sha, 'class': label,
+                             'fingerprint': self.fingerprint, 'severity': f"{severity:.6f}"})
+        if len(self.pending) >= CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        is_new = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        with open(self.path, 'a', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=self.FIELDS)
+            if is_new:
+                writer.writeheader()
+            writer.writerows(self.pending)
+            f.flush()
+            os.fsync(f.fileno())
+        self.pending = []
+
+def generate_pseudo_labels(mode=CAM_MODE):
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     print(f"Generating labels on {device}...")
     
@@ -66,15 +215,15 @@ def generate_pseudo_labels():
         # Handle if state dict is wrapped
         if 'model_state' in state: state = state['model_state']
         model.load_state_dict(state, strict=False)
+        fingerprint = labeling_fingerprint(CKPT_PATH)
     else:
         print(f"Warning: {CKPT_PATH} not found. Using random weights (results will be garbage).")
+        # Random weights differ every run, so nothing can be reused or cached
+        fingerprint = None
     
     model = model.to(device)
     model.eval()
     
-    # Hook into the last convolutional layer (layer4 for ResNet)
-    grad_cam = GradCAM(model, model.layer4)
-    
     # 2. Setup Data
     transform = transforms.Compose([
         transforms.Resize((224, 224)),
@@ -86,50 +235,66 @@ def generate_pseudo_labels():
         print(f"Error: '{DATA_DIR}' not found. Please set DATA_DIR in the script.")
         return
 
-    dataset = datasets.ImageFolder(DATA_DIR, transform=transform)
+    if shard_exists(SHARD_DIR):
+        print(f"Reading pre-decoded images from {SHARD_DIR}")
+        dataset = ShardDataset(SHARD_DIR)
+    else:
+        dataset = datasets.ImageFolder(DATA_DIR, transform=transform)
     print(f"Found {len(dataset)} images.")
     
+    # 3. Skip images already labeled with this checkpoint
+    hashes = [file_sha256(path) for path, _ in dataset.samples]
+    if fingerprint is not None:
+        cache = LabelCache(CACHE_FILE, fingerprint)
+        todo = [i for i, (sha, (_, label)) in enumerate(zip(hashes, dataset.samples))
+                if cache.get(sha, label) is None]
+        print(f"{len(dataset) - len(todo)} images already labeled, {len(todo)} to process.")
+    else:
+        cache = None
+        todo = list(range(len(dataset)))
+
+    # 4. Process Images
+    if mode == 'cam':
+        labeled = _label_with_cam(model, dataset, todo, device)
+    elif mode == 'gradcam':
+        labeled = _label_with_gradcam(model, dataset, todo, device)
+    else:
+        raise ValueError(f"Unknown CAM mode '{mode}' (expected 'cam' or 'gradcam')")
+
+    severities = {}
+    try:
+        for i, label, severity in labeled:
+            severities[i] = severity
+            if cache is not None:
+                cache.add(hashes[i], label, severity)
+    finally:
+        if cache is not None:
+            cache.flush()
+
     results = []
-    
-    # 3. Process Images
-    for i in range(len(dataset)):
-        img, label = dataset[i]
-        path = dataset.samples[i][0]
-        
-        img_tensor = img.unsqueeze(0).to(device).requires_grad_(True)
-        
-        # Get Heatmap
-        mask = grad_cam(img_tensor, label)
-        
-        # Resize heatmap to original image size
-        mask_resized = cv2.resize(mask, (224, 224))
-        
-        # Threshold to approximate lesion mask (intensity > 0.4)
-        lesion_pixels = np.sum(mask_resized > 0.4)
-        total_pixels = 224 * 224
-        
-        # Calculate severity ratio
-        severity = lesion_pixels / total_pixels
-        
-        # Heuristic scaling (GradCAM is coarse, so we scale up small activations)
-        severity = min(severity * 3.0, 1.0)
-        
+    for i, (path, label) in enumerate(dataset.samples):
+        severity = severities[i] if i in severities else cache.get(hashes[i], label)
         results.append({
             'path': path,
             'class': label,
             'severity': f"{severity:.4f}"
         })
-        
-        if i % 50 == 0:
-            print(f"Processed {i}/{len(dataset)}")
 
-    # 4. Save to CSV
-    with open(CSV_FILE, 'w', newline='') as f:
+    # 5. Save to CSV (write-then-rename so a crash never leaves a truncated file)
+    tmp_file = CSV_FILE + '.tmp'
+    with open(tmp_file, 'w', newline='') as f:
         writer = csv.DictWriter(f, fieldnames=['path', 'class', 'severity'])
         writer.writeheader()
         writer.writerows(results)
-        
+    os.replace(tmp_file, CSV_FILE)
+    # Typed, memory-mapped copy that train_severity.py reads
+    convert_csv(CSV_FILE, STORE_DIR)
+
     print(f"Done! Pseudo-labels saved to {CSV_FILE}")
 
 if __name__ == "__main__":
-    generate_pseudo_labels()
\ No newline at end of file
+    import argparse
+    parser = argparse.ArgumentParser(description="Generate CAM-based pseudo severity labels.")
+    parser.add_argument('--mode', choices=['cam', 'gradcam'], default=CAM_MODE)
+    args = parser.parse_args()
+    generate_pseudo_labels(mode=args.mode)
\ No newline at end of file
@@ -0,0 +1,173 @@
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from torchvision import datasets
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+import hashlib
+import json
+import os
+
+from label_store import normalize_path
+
+# ---------- CONFIG ----------
+DATA_DIR = 'PlantVillage'
+SHARD_DIR = 'cache/shard_224'   # Read by train_classifier.py, train_severity.py and severity_prep.py
+IMG_SIZE = 224
+NUM_WORKERS = 8
+# ----------------------------
+
+MEAN = [0.485, 0.456, 0.406]
+STD = [0.229, 0.224, 0.225]
+
+def _decode(path, size):
+    try:
+        with Image.open(path) as img:
+            return np.asarray(img.convert('RGB').resize((size, size), Image.BILINEAR), dtype=np.uint8)
+    except Exception as e:
+        return e
+
+def samples_digest(samples, data_dir=DATA_DIR):
+    """Digest of the relative paths, classes, sizes and modification times of ImageFolder samples."""
+    h = hashlib.sha256()
+    for path, label in samples:
+        stat = os.stat(path)
+        h.update(f"{normalize_path(os.path.relpath(path, data_dir))}\0{label}\0{stat.st_size}\0{stat.st_mtime_ns}\n"
+                 .encode())
+    return h.hexdigest()[:16]
+
+def build_shard(data_dir=DATA_DIR, shard_dir=SHARD_DIR, size=IMG_SIZE, num_workers=NUM_WORKERS):
+    """Decode and resize every image under data_dir once into a uint8 memmap shard.
+
+    Layout of shard_dir:
+      images.npy  (N, size, size, 3) uint8, opened with np.load(mmap_mode=...)
+      index.npz   paths and class labels of the decoded rows of images.npy
+                  (rows past the index, left by unreadable files, stay zero)
+      meta.json   classes, image size, the files that could not be decoded and a
+                  digest of data_dir's file list (see shard_exists)
+    meta.json is written last, so a shard without it is incomplete.
+    """
+    folder = datasets.ImageFolder(data_dir)
+    samples = folder.samples
+    digest = samples_digest(samples, data_dir)
+    print(f"Decoding {len(samples)} images from {data_dir} into {shard_dir}...")
+
+    os.makedirs(shard_dir, exist_ok=True)
+    meta_path = os.path.join(shard_dir, 'meta.json')
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+
+    images = np.lib.format.open_memmap(os.path.join(shard_dir, 'images.npy'), mode='w+',
+                                       dtype=np.uint8, shape=(len(samples), size, size, 3))
+    paths, labels, unreadable = [], [], []
+
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        decoded = pool.map(lambda s: _decode(s[0], size), samples)
+        for (path, label), result in zip(samples, decoded):
+            if isinstance(result, Exception):
+                unreadable.append({'path': path, 'error': str(result)})
+                continue
+            images[len(paths)] = result
+            paths.append(normalize_path(path))
+            labels.append(label)
+
+            if len(paths) % 500 == 0:
+                print(f"Decoded {len(paths)}/{len(samples)}")
+
+    images.flush()
+    del images
+
+    np.savez(os.path.join(shard_dir, 'index.npz'),
+             paths=np.array(paths), labels=np.array(labels, dtype=np.int64))
+    with open(meta_path, 'w') as f:
+        json.dump({'classes': folder.classes, 'size': size, 'count': len(paths),
+                   'data_digest': digest, 'unreadable': unreadable}, f, indent=2)
+
+    for bad in unreadable:
+        print(f"Unreadable: {bad['path']} ({bad['error']})")
+    print(f"Done! {len(paths)} images cached, {len(unreadable)} unreadable.")
+
+def shard_exists(shard_dir=SHARD_DIR, data_dir=DATA_DIR):
+    """True if a complete shard is there and still matches data_dir.
+
+    Images added, removed or changed in data_dir since the build would be
+    silently skipped (and never labeled), so a stale shard is reported and
+    not used; the callers then read data_dir directly. Without data_dir
+    (shard-only setups) any complete shard is used.
+    """
+    meta_path = os.path.join(shard_dir, 'meta.json')
+    if not os.path.exists(meta_path):
+        return False
+    if not os.path.isdir(data_dir):
+        return True
+    with open(meta_path) as f:
+        built = json.load(f).get('data_digest')
+    if built != samples_digest(datasets.ImageFolder(data_dir).samples, data_dir):
+        print(f"Warning: {shard_dir} is out of date with {data_dir}; reading {data_dir} instead. "
+              f"Rebuild it with python scripts/shard_cache.py.")
+        return False
+    return True
+
+class ShardDataset(Dataset):
+    """Reads pre-decoded images from a shard built by build_shard().
+
+    Items are (image, label), or (image, label, severity) when `labels` (a
+    label_store.LabelStore) is given. In that case only images in the store,
+    or in its `rows` selection, are served and class and severity come from
+    the store, like SeverityDataset. Images are normalized float tensors;
+    `transform` (e.g. RandomHorizontalFlip) is applied after that.
+    """
+
+    def __init__(self, shard_dir=SHARD_DIR, transform=None, labels=None, rows=None):
+        with open(os.path.join(shard_dir, 'meta.json')) as f:
+            self.meta = json.load(f)
+        index = np.load(os.path.join(shard_dir, 'index.npz'))
+        self.shard_dir = shard_dir
+        self.transform = transform
+        self.classes = self.meta['classes']
+        self._images = None  # Opened lazily so each DataLoader worker maps its own view
+
+        paths = [str(p) for p in index['paths']]
+        self.rows = list(range(len(paths)))
+        self.samples = list(zip(paths, index['labels'].tolist()))
+        self.severity = None
+
+        if labels is not None:
+            row_of = {p: i for i, p in enumerate(paths)}
+            label_rows = np.arange(len(labels)) if rows is None else rows
+            self.rows, self.samples, self.severity = [], [], []
+            missing = 0
+            for label_row, path in zip(label_rows, labels.paths(label_rows)):
+                row = row_of.get(normalize_path(path))
+                if row is None:
+                    missing += 1
+                    continue
+                self.rows.append(row)
+                self.samples.append((paths[row], int(labels.classes[label_row])))
+                self.severity.append(float(labels.severity[label_row]))
+            if missing:
+                print(f"Warning: {missing} labeled images are not in the shard and were skipped.")
+
+        self.mean = torch.tensor(MEAN).view(3, 1, 1)
+        self.std = torch.tensor(STD).view(3, 1, 1)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, idx):
+        if self._images is None:
+            # Copy-on-write mapping: slices are zero-copy views that torch can wrap directly
+            self._images = np.load(os.path.join(self.shard_dir, 'images.npy'), mmap_mode='c')
+
+        pixels = torch.from_numpy(self._images[self.rows[idx]])
+        image = (pixels.permute(2, 0, 1).float().div_(255) - self.mean) / self.std
+        if self.transform:
+            image = self.transform(image)
+
+        label = self.samples[idx][1]
+        if self.severity is None:
+            return image, label
+        return image, label, torch.tensor(self.severity[idx], dtype=torch.float32)
+
+if __name__ == '__main__':
+    build_shard()
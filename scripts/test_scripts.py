@@ -0,0 +1,127 @@
+import csv
+import json
+import os
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+cv2 = pytest.importorskip("cv2")
+pytest.importorskip("torchvision")
+
+from PIL import Image
+from torchvision import models
+
+import severity_prep
+from distributed import make_loader, threads_per_process
+from label_store import LabelStore, convert_csv, normalize_path
+from severity_prep import CAM_THRESHOLD, IMG_SIZE, SEVERITY_SCALE, GradCAM, LabelCache, cam_severity, layer4_features
+from shard_cache import ShardDataset, build_shard, shard_exists
+
+
+def test_batched_cam_matches_gradcam():
+    torch.manual_seed(0)
+    model = models.resnet18(num_classes=3).eval()   # Same layer4 + GAP + fc layout as the ResNet34
+    images = torch.randn(3, 3, IMG_SIZE, IMG_SIZE)
+    labels = torch.tensor([0, 1, 2])
+
+    with torch.no_grad():
+        batched = cam_severity(layer4_features(model, images), model.fc.weight, labels)
+
+    grad_cam = GradCAM(model, model.layer4)
+    for image, label, severity in zip(images, labels.tolist(), batched.tolist()):
+        mask = grad_cam(image.unsqueeze(0).requires_grad_(True), label)
+        with torch.no_grad():
+            features = layer4_features(model, image.unsqueeze(0))
+            cam = torch.relu(torch.einsum('c,chw->hw', model.fc.weight[label], features[0]))
+            cam = cam / cam.max() if cam.max() > 0 else cam
+        assert np.allclose(mask, cam.numpy(), atol=1e-4)
+
+        # Only pixels right at the threshold can land on different sides after upsampling
+        resized = cv2.resize(mask, (IMG_SIZE, IMG_SIZE))
+        expected = min(np.sum(resized > CAM_THRESHOLD) / IMG_SIZE ** 2 * SEVERITY_SCALE, 1.0)
+        assert abs(severity - expected) < 0.01
+
+
+def test_label_cache_resumes_and_skips_torn_rows(tmp_path, monkeypatch):
+    monkeypatch.setattr(severity_prep, "CHUNK_SIZE", 2)
+    path = str(tmp_path / "labels.cache.csv")
+
+    cache = LabelCache(path, "fp1")
+    cache.add("aa", 0, 0.25)
+    cache.add("bb", 1, 0.5)      # Second row fills the chunk: flushed and fsynced
+    cache.add("cc", 2, 0.75)     # Still pending when the run "crashes"
+
+    with open(path, "a") as f:
+        f.write("dd,1,fp1,")     # Torn last line
+    resumed = LabelCache(path, "fp1")
+    assert resumed.entries == {("aa", 0): 0.25, ("bb", 1): 0.5}
+    assert resumed.get("cc", 2) is None
+
+    # Labels from another checkpoint or heuristic are never reused
+    assert LabelCache(path, "fp2").entries == {}
+
+
+def test_label_store_round_trips_csv(tmp_path):
+    rows = [
+        ("PlantVillage\\Potato___Early_blight\\a.JPG", 0, 0.125),   # Written on Windows
+        ("PlantVillage/Potato___Late_blight/b c.jpg", 1, 0.5),
+        ("PlantVillage/Potato___healthy/é.jpg", 2, 0.0),
+        ("PlantVillage/Potato___Late_blight/d.jpg", 1, 0.875),
+    ]
+    csv_file = str(tmp_path / "pseudo_severity.csv")
+    with open(csv_file, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["path", "class", "severity"])
+        writer.writerows(rows)
+
+    store = convert_csv(csv_file, str(tmp_path / "labels"))
+    reopened = LabelStore(str(tmp_path / "labels"))
+    assert len(reopened) == len(rows)
+    assert list(reopened.paths()) == [normalize_path(p) for p, _, _ in rows]
+    assert reopened.classes.tolist() == [c for _, c, _ in rows]
+    assert np.allclose(reopened.severity, [s for _, _, s in rows])
+    assert reopened.digest == store.digest
+    assert reopened.select(classes=[1]).tolist() == [1, 3]
+    assert reopened.select(min_severity=0.1, max_severity=0.6).tolist() == [0, 1]
+
+
+def test_shard_holds_decoded_images_and_skips_unreadable(tmp_path):
+    data_dir = tmp_path / "PlantVillage"
+    for name, color in (("a_class", (200, 10, 10)), ("b_class", (10, 200, 10))):
+        (data_dir / name).mkdir(parents=True)
+        Image.new("RGB", (64, 48), color).save(data_dir / name / "leaf.png")
+    (data_dir / "b_class" / "broken.jpg").write_bytes(b"not an image")
+
+    shard_dir = str(tmp_path / "shard")
+    build_shard(str(data_dir), shard_dir, size=32, num_workers=2)
+    with open(os.path.join(shard_dir, "meta.json")) as f:
+        meta = json.load(f)
+    assert meta["count"] == 2 and len(meta["unreadable"]) == 1
+    assert shard_exists(shard_dir, str(data_dir))
+
+    dataset = ShardDataset(shard_dir)
+    assert len(dataset) == 2 and dataset.classes == ["a_class", "b_class"]
+    image, label = dataset[1]
+    assert image.shape == (3, 32, 32) and label == 1
+    # Normalized green pixel: red channel well below zero, green channel above
+    assert image[0].mean() < 0 < image[1].mean()
+
+    # An image added after the build makes the shard stale instead of silently skipped
+    Image.new("RGB", (64, 48), (10, 10, 200)).save(data_dir / "a_class" / "new.png")
+    assert not shard_exists(shard_dir, str(data_dir))
+    assert shard_exists(shard_dir, str(tmp_path / "moved"))   # Shard-only: nothing to compare against
+
+
+def test_validation_shards_score_every_image_once():
+    dataset = torch.utils.data.TensorDataset(torch.arange(7))
+    seen = [int(x) for rank in range(3)
+            for (batch,) in make_loader(dataset, 2, False, rank, 3, num_workers=0) for x in batch]
+    assert sorted(seen) == list(range(7))   # DistributedSampler would pad this to 9
+
+
+def test_threads_leave_room_for_the_loader_workers(monkeypatch):
+    monkeypatch.setattr(os, "cpu_count", lambda: 16)
+    assert threads_per_process(2, num_workers=0) == 8
+    assert threads_per_process(2, num_workers=6) == 2
+    assert threads_per_process(4, num_workers=8) == 1
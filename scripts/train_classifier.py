@@ -1,27 +1,68 @@
 import torch
 import torch.nn as nn
 import torch.optim as optim
+from torch.nn.parallel import DistributedDataParallel
 from torchvision import datasets, models, transforms
-from torch.utils.data import DataLoader, random_split
+from torch.utils.data import random_split
+import json
 import os
 
+from distributed import NUM_WORKERS, SCALING_STEPS, Throughput, all_reduce_sum, launch, make_loader, scaling_report
+from label_store import normalize_path
+from perf_mode import ACCUM_STEPS, MIN_ACCURACY_STEPS, PerfMode, Trainer, evaluate, perf_report, seed_everything
+from shard_cache import SHARD_DIR, ShardDataset, shard_exists
+
 # ---------- CONFIG ----------
 DATA_DIR = 'PlantVillage'
 MODEL_SAVE_PATH = 'models/best_classifier.pth'
-BATCH_SIZE = 32
+BATCH_SIZE = 32          # Per process; the effective batch is BATCH_SIZE * number of processes
 EPOCHS = 5 
 LEARNING_RATE = 0.001
+SPLIT_SEED = 42          # Same train/val split in every process
+SPLIT_FILE = 'models/classifier_split.json'  # Validation image paths, read by evaluate_models.py
 # ----------------------------
 
-def train_classifier():
+def save_split(dataset, val_indices, split_file=SPLIT_FILE):
+    """Record which images were held out, so evaluate_models.py scores the same ones."""
+    split = {'seed': SPLIT_SEED, 'images': len(dataset), 'checkpoint': MODEL_SAVE_PATH,
+             'val_paths': [normalize_path(dataset.samples[i][0]) for i in sorted(val_indices)]}
+    tmp_file = split_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(split, f)
+    os.replace(tmp_file, split_file)
+
+def load_split(split_file=SPLIT_FILE):
+    """Normalized paths of the images save_split() held out, or None if it has not run."""
+    if not os.path.exists(split_file):
+        return None
+    with open(split_file) as f:
+        return {normalize_path(p) for p in json.load(f)['val_paths']}
+
+def train_classifier(rank=0, world_size=1, num_workers=NUM_WORKERS, max_steps=None, perf=None, eval_batches=0):
+    """Train on one process, or as one rank of a gloo process group (see distributed.py).
+
+    `perf` (a perf_mode.PerfMode) picks fp32 eager or the bf16/channels_last/
+    compiled throughput mode. With max_steps set, stops after that many steps
+    without validating or saving and returns the measured images/sec (used by
+    --scaling), or with eval_batches also the accuracy on that many validation
+    batches (used by --perf-report).
+    """
+    distributed = world_size > 1
+    log = print if rank == 0 else (lambda *args, **kwargs: None)
+    perf = perf or PerfMode()
+    if eval_batches:
+        seed_everything()
+
     # 1. Setup Directories and Device
     if not os.path.exists(DATA_DIR):
-        print(f"Error: {DATA_DIR} not found.")
+        log(f"Error: {DATA_DIR} not found.")
         return
     os.makedirs('models', exist_ok=True)
     
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    print(f"Training on {device}...")
+    # gloo all-reduces CPU tensors, so distributed runs stay on the CPU
+    device = torch.device("cuda" if torch.cuda.is_available() and not distributed else "cpu")
+    log(f"Training on {device} with {world_size} process(es), {torch.get_num_threads()} threads each...")
+    log(f"Step mode: {perf.describe()}")
 
     # 2. Prepare Data
     data_transforms = transforms.Compose([
@@ -31,64 +72,102 @@ def train_classifier():
         transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
     ])
 
-    full_dataset = datasets.ImageFolder(DATA_DIR, transform=data_transforms)
-    print(f"Classes found: {full_dataset.classes}")
+    if shard_exists(SHARD_DIR):
+        # Pre-decoded 224x224 images (python scripts/shard_cache.py), only augmentation left to do
+        log(f"Reading pre-decoded images from {SHARD_DIR}")
+        full_dataset = ShardDataset(SHARD_DIR, transform=transforms.RandomHorizontalFlip())
+    else:
+        full_dataset = datasets.ImageFolder(DATA_DIR, transform=data_transforms)
+    log(f"Classes found: {full_dataset.classes}")
     
     train_size = int(0.8 * len(full_dataset))
     val_size = len(full_dataset) - train_size
-    train_dataset, val_dataset = random_split(full_dataset, [train_size, val_size])
+    train_dataset, val_dataset = random_split(full_dataset, [train_size, val_size],
+                                              generator=torch.Generator().manual_seed(SPLIT_SEED))
 
-    train_loader = DataLoader(train_dataset, batch_size=BATCH_SIZE, shuffle=True)
-    val_loader = DataLoader(val_dataset, batch_size=BATCH_SIZE, shuffle=False)
+    if rank == 0 and max_steps is None:
+        save_split(full_dataset, val_dataset.indices)
+
+    train_loader = make_loader(train_dataset, BATCH_SIZE, True, rank, world_size, num_workers)
+    val_loader = make_loader(val_dataset, BATCH_SIZE, False, rank, world_size, num_workers)
 
     # 3. Setup Model (ResNet34)
-    model = models.resnet34(weights=models.ResNet34_Weights.DEFAULT)
+    # Only rank 0 needs the ImageNet weights: DDP broadcasts its parameters to the other ranks
+    weights = models.ResNet34_Weights.DEFAULT if rank == 0 else None
+    model = models.resnet34(weights=weights)
     num_ftrs = model.fc.in_features
     model.fc = nn.Linear(num_ftrs, len(full_dataset.classes))
-    model = model.to(device)
+    model = perf.prepare(model.to(device))
+    if distributed:
+        model = DistributedDataParallel(model)   # All-reduces gradients during backward()
 
     criterion = nn.CrossEntropyLoss()
     optimizer = optim.Adam(model.parameters(), lr=LEARNING_RATE)
+    trainer = Trainer(model, optimizer, lambda inputs, labels: criterion(model(inputs), labels), perf, device)
 
     # 4. Training Loop
     best_acc = 0.0
+    meter = Throughput()
 
     for epoch in range(EPOCHS):
-        print(f"\nEpoch {epoch+1}/{EPOCHS}")
+        log(f"\nEpoch {epoch+1}/{EPOCHS}")
+        if distributed:
+            train_loader.sampler.set_epoch(epoch)
         model.train()
-        running_loss = 0.0
         for inputs, labels in train_loader:
-            inputs, labels = inputs.to(device), labels.to(device)
-            optimizer.zero_grad()
-            outputs = model(inputs)
-            loss = criterion(outputs, labels)
-            loss.backward()
-            optimizer.step()
-            running_loss += loss.item() * inputs.size(0)
-            
-        print(f"  Train Loss: {running_loss / len(train_dataset):.4f}")
-
-        # Validation
-        model.eval()
-        correct = 0
-        total = 0
-        with torch.no_grad():
-            for inputs, labels in val_loader:
-                inputs, labels = inputs.to(device), labels.to(device)
-                outputs = model(inputs)
-                _, predicted = torch.max(outputs.data, 1)
-                total += labels.size(0)
-                correct += (predicted == labels).sum().item()
-        
+            trainer.step(perf.inputs(inputs, device), labels.to(device), count=inputs.size(0))
+            meter.step(inputs.size(0))
+            if max_steps is not None and meter.steps >= max_steps:
+                if eval_batches:
+                    return {'images_per_sec': meter.result(world_size),
+                            **evaluate(model, val_loader, device, perf, eval_batches)}
+                return meter.result(world_size)
+        trainer.flush()
+
+        running_loss, = all_reduce_sum([trainer.epoch_loss()], world_size)
+        log(f"  Train Loss: {running_loss / len(train_dataset):.4f}")
+
+        # Validation (each process scores its unpadded slice, the counts are summed)
+        val = evaluate(model, val_loader, device, perf)
+        correct, total = all_reduce_sum([val['correct'], val['total']], world_size)
         acc = correct / total
-        print(f"  Val Acc: {acc:.4f}")
+        log(f"  Val Acc: {acc:.4f}")
 
         if acc > best_acc:
             best_acc = acc
-            torch.save(model.state_dict(), MODEL_SAVE_PATH)
-            print(f"  Saved new best model to {MODEL_SAVE_PATH}")
+            if rank == 0:
+                state = model.module.state_dict() if distributed else model.state_dict()
+                torch.save(state, MODEL_SAVE_PATH)
+                log(f"  Saved new best model to {MODEL_SAVE_PATH}")
 
-    print("\nTraining complete.")
+    log("\nTraining complete.")
 
 if __name__ == "__main__":
-    train_classifier()
\ No newline at end of file
+    import argparse
+    parser = argparse.ArgumentParser(description="Train the ResNet34 disease classifier.")
+    parser.add_argument('--nproc', type=int, default=1, help="Data-parallel training processes (gloo)")
+    parser.add_argument('--threads', type=int, help="Intra-op threads per process (default: cores / nproc)")
+    parser.add_argument('--workers', type=int, default=NUM_WORKERS, help="DataLoader workers per process")
+    parser.add_argument('--scaling', type=int, nargs='+', metavar='N',
+                        help="Report images/sec for each process count instead of training")
+    parser.add_argument('--max-steps', type=int,
+                        help=f"Steps per process count with --scaling (default {SCALING_STEPS}), "
+                             f"or per mode with --perf-report (default {MIN_ACCURACY_STEPS})")
+    parser.add_argument('--perf', action='store_true',
+                        help="CPU throughput mode: bf16 autocast, channels_last and torch.compile (see perf_mode.py)")
+    parser.add_argument('--accum-steps', type=int, default=ACCUM_STEPS,
+                        help="Micro-batches per optimizer step (gradient accumulation)")
+    parser.add_argument('--perf-report', action='store_true',
+                        help="Compare images/sec and accuracy of --perf against fp32 eager instead of training")
+    args = parser.parse_args()
+    max_steps = args.max_steps or (MIN_ACCURACY_STEPS if args.perf_report else SCALING_STEPS)
+
+    perf = PerfMode(args.perf, args.accum_steps)
+    if args.perf_report:
+        raise SystemExit(0 if perf_report(train_classifier, max_steps, args.accum_steps, args.threads,
+                                          args=(args.workers,), num_workers=args.workers) else 1)
+    elif args.scaling:
+        scaling_report(train_classifier, args.scaling, max_steps, args.threads, args=(args.workers,),
+                       extra_args=(perf,), num_workers=args.workers)
+    else:
+        launch(train_classifier, args.nproc, args.threads, args=(args.workers, None, perf), num_workers=args.workers)
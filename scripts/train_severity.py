@@ -1,26 +1,48 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.optim as optim
-from torch.utils.data import Dataset, DataLoader
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import Dataset, DataLoader, Subset, TensorDataset
 from torchvision import transforms, models
-from PIL import Image
-import csv
+import numpy as np
+import hashlib
 import os
 
+from distributed import NUM_WORKERS, SCALING_STEPS, Throughput, all_reduce_sum, launch, make_loader, scaling_report
+from fast_decode import decode_resized
+from label_store import load_labels, normalize_path
+from perf_mode import ACCUM_STEPS, MIN_ACCURACY_STEPS, PerfMode, Trainer, evaluate, perf_report, seed_everything
+from shard_cache import SHARD_DIR, ShardDataset, shard_exists
+from train_classifier import SPLIT_FILE, load_split
+
 # ---------- CONFIG ----------
 CSV_FILE = 'pseudo_severity.csv'        # Generated by severity_prep.py
+LABELS_DIR = 'cache/pseudo_severity.labels'  # Binary copy of CSV_FILE, rebuilt whenever the CSV changes
 CKPT_PATH = 'models/best_classifier.pth' # Your existing classifier
 SAVE_PATH = 'models/severity_model.pth'
-BATCH_SIZE = 16
+BATCH_SIZE = 16          # Per process; the effective batch is BATCH_SIZE * number of processes
 LR = 1e-4
 EPOCHS = 10
+SEV_LOSS_WEIGHT = 10.0   # Weight the severity loss more to focus learning there
+
+# Heads-only mode: freeze the backbone, cache its 512-d embeddings once and
+# train fc_class/fc_severity on them (seconds per epoch instead of minutes)
+HEADS_ONLY = False
+EMBED_FILE = 'cache/severity_embeddings.pt'
+HEAD_EPOCHS = 200
+HEAD_BATCH_SIZE = 256
+HEAD_LR = 1e-3
+# Heads-only runs are loss-weight sweeps, so each weight gets its own file;
+# --save writes SAVE_PATH (the served model) instead
+HEAD_SWEEP_PATH = 'models/sweeps/severity_heads_w{weight:g}.pth'
 # ----------------------------
 
 class PotatoSeverityModel(nn.Module):
-    def __init__(self, num_classes=3):
+    def __init__(self, num_classes=3, pretrained=True):
         super().__init__()
-        # Base ResNet backbone
-        self.backbone = models.resnet34(pretrained=True)
+        # Base ResNet backbone (skip the ImageNet download when a checkpoint is loaded right after)
+        self.backbone = models.resnet34(pretrained=pretrained)
         in_features = self.backbone.fc.in_features
         
         # Remove original fc to use backbone as feature extractor
@@ -47,40 +69,167 @@ class PotatoSeverityModel(nn.Module):
         sev_pred = self.fc_severity(x)
         return cls_logits, sev_pred
 
+    def forward_with_cam(self, x):
+        """forward() plus a (B, 7, 7) class activation map per image for its predicted class.
+
+        The backbone ends in global average pooling, so the CAM is just the
+        fc_class weights of that class applied to the layer4 activations (see
+        cam_severity in severity_prep.py) and costs no extra pass. Maps are
+        normalized to 0-1 per image.
+        """
+        b = self.backbone
+        features = b.layer4(b.layer3(b.layer2(b.layer1(b.maxpool(b.relu(b.bn1(b.conv1(x))))))))
+        pooled = torch.flatten(b.avgpool(features), 1)
+        cls_logits = self.fc_class(pooled)
+        sev_pred = self.fc_severity(pooled)
+
+        weights = self.fc_class.weight[cls_logits.argmax(dim=1)]       # (B, C)
+        cam = F.relu(torch.einsum('bc,bchw->bhw', weights, features))
+        peak = cam.amax(dim=(1, 2), keepdim=True)
+        cam = torch.where(peak > 0, cam / peak.clamp_min(1e-12), cam)
+        return cls_logits, sev_pred, cam
+
 class SeverityDataset(Dataset):
-    def __init__(self, csv_file, transform=None):
-        self.data = []
-        with open(csv_file, 'r') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                self.data.append(row)
+    """Images named by a label_store.LabelStore (all rows, or a `rows` selection from select())."""
+
+    def __init__(self, labels, transform=None, rows=None):
+        self.labels = labels
+        self.rows = np.arange(len(labels)) if rows is None else np.asarray(rows)
         self.transform = transform
 
     def __len__(self):
-        return len(self.data)
+        return len(self.rows)
 
     def __getitem__(self, idx):
-        item = self.data[idx]
-        img_path = item['path']
-        
-        # Load image
-        try:
-            image = Image.open(img_path).convert('RGB')
-        except Exception:
-            # Fallback for broken paths if necessary
-            image = Image.new('RGB', (224, 224))
-            
+        row = int(self.rows[idx])
+
+        # Decoded straight to 224x224, so the Resize in transform is a no-op. Store paths are
+        # normalized for this OS, so a missing file is a real error rather than a Windows path.
+        image = decode_resized(self.labels.path(row))
         if self.transform:
             image = self.transform(image)
-            
-        label = int(item['class'])
-        severity = float(item['severity'])
-        
+
+        label = int(self.labels.classes[row])
+        severity = float(self.labels.severity[row])
         return image, label, torch.tensor(severity, dtype=torch.float32)
 
-def train():
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    print(f"Training on {device}")
+def _file_digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()[:16]
+
+def compute_embeddings(model, dataset, device):
+    """Run the backbone once over the dataset and return (features, labels, severities)."""
+    loader = DataLoader(dataset, batch_size=BATCH_SIZE * 4, shuffle=False)
+    feats, labels, sevs = [], [], []
+
+    model.backbone.eval()
+    with torch.no_grad():
+        for imgs, lbls, sv in loader:
+            feats.append(model.backbone(imgs.to(device)).cpu())
+            labels.append(lbls)
+            sevs.append(sv)
+            print(f"Embedded {sum(len(f) for f in feats)}/{len(dataset)}")
+
+    return torch.cat(feats), torch.cat(labels), torch.cat(sevs)
+
+def load_or_compute_embeddings(model, dataset, labels, device):
+    """Reuse EMBED_FILE unless the backbone checkpoint or the labels have changed."""
+    key = f"{_file_digest(CKPT_PATH) if os.path.exists(CKPT_PATH) else 'imagenet'}:{labels.digest}"
+
+    if os.path.exists(EMBED_FILE):
+        cached = torch.load(EMBED_FILE)
+        if cached.get('key') == key:
+            print(f"Loaded cached embeddings from {EMBED_FILE}")
+            return cached['features'], cached['labels'], cached['severities']
+
+    feats, labels, sevs = compute_embeddings(model, dataset, device)
+    os.makedirs(os.path.dirname(EMBED_FILE) or '.', exist_ok=True)
+    torch.save({'key': key, 'features': feats, 'labels': labels, 'severities': sevs}, EMBED_FILE)
+    print(f"Embeddings saved to {EMBED_FILE}")
+    return feats, labels, sevs
+
+def dataset_paths(dataset):
+    """Image path of every item of a SeverityDataset or labeled ShardDataset, in order."""
+    if isinstance(dataset, ShardDataset):
+        return [path for path, _ in dataset.samples]
+    return list(dataset.labels.paths(dataset.rows))
+
+def heldout_mask(paths, split_file=SPLIT_FILE):
+    """Boolean mask of the paths in train_classifier.py's saved validation split, or None without it."""
+    wanted = load_split(split_file)
+    if wanted is None:
+        return None
+    return torch.tensor([normalize_path(p) in wanted for p in paths], dtype=torch.bool)
+
+def train_heads(model, feats, labels, sevs, device, sev_weight=SEV_LOSS_WEIGHT, val_mask=None):
+    """Train fc_class and fc_severity on cached backbone embeddings.
+
+    With val_mask the masked images are held out and the returned accuracy
+    and severity MAE are measured on them, so runs with different weights
+    compare fairly; without it they are training-set numbers.
+    """
+    if val_mask is None:
+        train_mask = val_mask = torch.ones(len(labels), dtype=torch.bool)
+    else:
+        train_mask = ~val_mask
+    loader = DataLoader(TensorDataset(feats[train_mask], labels[train_mask], sevs[train_mask]),
+                        batch_size=HEAD_BATCH_SIZE, shuffle=True)
+    heads = nn.ModuleList([model.fc_class, model.fc_severity]).train()
+    optimizer = optim.Adam(heads.parameters(), lr=HEAD_LR)
+    criterion_cls = nn.CrossEntropyLoss()
+    criterion_sev = nn.L1Loss()
+
+    for epoch in range(HEAD_EPOCHS):
+        running_loss = 0.0
+        for x, y, sv in loader:
+            x, y, sv = x.to(device), y.to(device), sv.to(device)
+
+            optimizer.zero_grad()
+            loss_c = criterion_cls(model.fc_class(x), y)
+            loss_s = criterion_sev(model.fc_severity(x).squeeze(1), sv)
+            loss = loss_c + sev_weight * loss_s
+
+            loss.backward()
+            optimizer.step()
+            running_loss += loss.item()
+
+        if (epoch + 1) % 20 == 0 or epoch == 0:
+            print(f"Epoch {epoch+1}/{HEAD_EPOCHS} | Loss: {running_loss/len(loader):.4f}")
+
+    heads.eval()
+    held_out = bool((~train_mask).any())
+    with torch.no_grad():
+        x = feats[val_mask].to(device)
+        acc = (model.fc_class(x).argmax(1).cpu() == labels[val_mask]).float().mean().item()
+        mae = (model.fc_severity(x).squeeze(1).cpu() - sevs[val_mask]).abs().mean().item()
+    split = f"Val ({int(val_mask.sum())} held-out images)" if held_out else "Train"
+    print(f"Severity weight {sev_weight} | {split} Acc: {acc:.4f} | Severity MAE: {mae:.4f}")
+    return {'sev_weight': sev_weight, 'held_out': held_out, 'accuracy': acc, 'severity_mae': mae}
+
+def train(rank=0, world_size=1, heads_only=HEADS_ONLY, sev_weight=SEV_LOSS_WEIGHT, num_workers=NUM_WORKERS,
+          max_steps=None, perf=None, eval_batches=0, save_heads=False):
+    """Train on one process, or as one rank of a gloo process group (see distributed.py).
+
+    `perf` (a perf_mode.PerfMode) picks fp32 eager or the bf16/channels_last/
+    compiled throughput mode. With max_steps set, stops after that many steps
+    without saving and returns the measured images/sec (used by --scaling), or
+    with eval_batches also the accuracy and severity MAE on that many batches
+    of evenly spaced images (used by --perf-report). Heads-only runs save to
+    HEAD_SWEEP_PATH, or to SAVE_PATH with save_heads.
+    """
+    distributed = world_size > 1
+    log = print if rank == 0 else (lambda *args, **kwargs: None)
+    perf = perf or PerfMode()
+    if eval_batches:
+        seed_everything()
+
+    # gloo all-reduces CPU tensors, so distributed runs stay on the CPU
+    device = torch.device("cuda" if torch.cuda.is_available() and not distributed else "cpu")
+    log(f"Training on {device} with {world_size} process(es), {torch.get_num_threads()} threads each")
+    log(f"Step mode: {perf.describe()}")
 
     # 1. Setup Data
     tf = transforms.Compose([
@@ -89,19 +238,39 @@ def train():
         transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
     ])
     
-    if not os.path.exists(CSV_FILE):
-        print(f"Error: {CSV_FILE} not found. Run severity_prep.py first.")
+    if not os.path.exists(CSV_FILE) and not os.path.exists(os.path.join(LABELS_DIR, 'meta.json')):
+        log(f"Error: {CSV_FILE} not found. Run severity_prep.py first.")
         return
+    # Only rank 0 converts; the other ranks wait for it and then open the same store
+    labels = load_labels(CSV_FILE, LABELS_DIR) if rank == 0 else None
+    if distributed:
+        torch.distributed.barrier()
+    if labels is None:
+        labels = load_labels(CSV_FILE, LABELS_DIR)
 
-    dataset = SeverityDataset(CSV_FILE, transform=tf)
-    loader = DataLoader(dataset, batch_size=BATCH_SIZE, shuffle=True)
+    if shard_exists(SHARD_DIR):
+        log(f"Reading pre-decoded images from {SHARD_DIR}")
+        dataset = ShardDataset(SHARD_DIR, labels=labels)
+    else:
+        dataset = SeverityDataset(labels, transform=tf)
+    # Images train_classifier.py held out are left out here too, so the cascade
+    # calibration and --perf-report can score this model on unseen images
+    val_mask = heldout_mask(dataset_paths(dataset))
+    if val_mask is None:
+        log(f"Warning: {SPLIT_FILE} not found (run train_classifier.py); training and scoring on every image.")
+        train_set, val_set = dataset, dataset
+    else:
+        train_set = Subset(dataset, torch.nonzero(~val_mask).flatten().tolist())
+        val_set = Subset(dataset, torch.nonzero(val_mask).flatten().tolist())
+    loader = make_loader(train_set, BATCH_SIZE, True, rank, world_size, num_workers)
 
     # 2. Setup Model
-    model = PotatoSeverityModel(num_classes=3).to(device)
+    # Only rank 0 needs the ImageNet weights: DDP broadcasts its parameters to the other ranks
+    model = PotatoSeverityModel(num_classes=3, pretrained=rank == 0).to(device)
     
     # Load previous classifier weights if available
     if os.path.exists(CKPT_PATH):
-        print(f"Loading backbone from {CKPT_PATH}...")
+        log(f"Loading backbone from {CKPT_PATH}...")
         ckpt = torch.load(CKPT_PATH, map_location=device)
         state_dict = ckpt['model_state'] if 'model_state' in ckpt else ckpt
         
@@ -117,37 +286,95 @@ def train():
         # Load compatible keys (strict=False allows missing fc_severity weights)
         model.load_state_dict(new_state, strict=False)
     
+    if heads_only:
+        feats, labels, sevs = load_or_compute_embeddings(model, dataset, labels, device)
+        result = train_heads(model, feats, labels, sevs, device, sev_weight, val_mask)
+        save_path = SAVE_PATH if save_heads else HEAD_SWEEP_PATH.format(weight=sev_weight)
+        os.makedirs(os.path.dirname(save_path) or '.', exist_ok=True)
+        torch.save(model.state_dict(), save_path)
+        print(f"Model saved to {save_path}")
+        return result
+
+    model = perf.prepare(model)
+    if distributed:
+        model = DistributedDataParallel(model)   # All-reduces gradients during backward()
+
     # 3. Optimization
     optimizer = optim.Adam(model.parameters(), lr=LR)
     criterion_cls = nn.CrossEntropyLoss()
     criterion_sev = nn.L1Loss() # L1 Loss is robust for regression
 
+    def loss_fn(imgs, labels, sevs):
+        cls_out, sev_out = model(imgs)
+        # Combine losses (weight severity more to focus learning there)
+        return criterion_cls(cls_out, labels) + sev_weight * criterion_sev(sev_out.squeeze(), sevs)
+
+    trainer = Trainer(model, optimizer, loss_fn, perf, device)
+
     # 4. Training Loop
     model.train()
+    meter = Throughput()
     for epoch in range(EPOCHS):
-        running_loss = 0.0
+        if distributed:
+            loader.sampler.set_epoch(epoch)
         for imgs, labels, sevs in loader:
-            imgs, labels, sevs = imgs.to(device), labels.to(device), sevs.to(device)
-            
-            optimizer.zero_grad()
-            cls_out, sev_out = model(imgs)
-            
-            # Calculate losses
-            loss_c = criterion_cls(cls_out, labels)
-            loss_s = criterion_sev(sev_out.squeeze(), sevs)
-            
-            # Combine losses (weight severity more to focus learning there)
-            loss = loss_c + 10.0 * loss_s 
-            
-            loss.backward()
-            optimizer.step()
-            running_loss += loss.item()
-            
-        print(f"Epoch {epoch+1}/{EPOCHS} | Loss: {running_loss/len(loader):.4f}")
+            trainer.step(perf.inputs(imgs, device), labels.to(device), sevs.to(device), count=imgs.size(0))
+            meter.step(imgs.size(0))
+            if max_steps is not None and meter.steps >= max_steps:
+                if eval_batches:
+                    # Evenly spaced held-out images, so every class is scored
+                    stride = max(1, len(val_set) // (eval_batches * BATCH_SIZE))
+                    eval_set = Subset(val_set, range(0, len(val_set), stride))
+                    eval_loader = make_loader(eval_set, BATCH_SIZE, False, num_workers=0)
+                    return {'images_per_sec': meter.result(world_size),
+                            **evaluate(model, eval_loader, device, perf, eval_batches)}
+                return meter.result(world_size)
+        trainer.flush()
+
+        running_loss, = all_reduce_sum([trainer.epoch_loss()], world_size)
+        log(f"Epoch {epoch+1}/{EPOCHS} | Loss: {running_loss/(len(loader.sampler) * world_size):.4f}")
 
     # Save
-    torch.save(model.state_dict(), SAVE_PATH)
-    print(f"Model saved to {SAVE_PATH}")
+    if rank == 0:
+        torch.save(model.module.state_dict() if distributed else model.state_dict(), SAVE_PATH)
+        print(f"Model saved to {SAVE_PATH}")
 
 if __name__ == '__main__':
-    train()
\ No newline at end of file
+    import argparse
+    parser = argparse.ArgumentParser(description="Train the dual-head severity model.")
+    parser.add_argument('--heads-only', action='store_true', default=HEADS_ONLY,
+                        help="Freeze the backbone and train the heads on cached embeddings")
+    parser.add_argument('--sev-weight', type=float, default=SEV_LOSS_WEIGHT,
+                        help="Weight of the severity L1 loss")
+    parser.add_argument('--save', action='store_true',
+                        help=f"With --heads-only, write {SAVE_PATH} instead of a per-weight sweep file")
+    parser.add_argument('--nproc', type=int, default=1, help="Data-parallel training processes (gloo)")
+    parser.add_argument('--threads', type=int, help="Intra-op threads per process (default: cores / nproc)")
+    parser.add_argument('--workers', type=int, default=NUM_WORKERS, help="DataLoader workers per process")
+    parser.add_argument('--scaling', type=int, nargs='+', metavar='N',
+                        help="Report images/sec for each process count instead of training")
+    parser.add_argument('--max-steps', type=int,
+                        help=f"Steps per process count with --scaling (default {SCALING_STEPS}), "
+                             f"or per mode with --perf-report (default {MIN_ACCURACY_STEPS})")
+    parser.add_argument('--perf', action='store_true',
+                        help="CPU throughput mode: bf16 autocast, channels_last and torch.compile (see perf_mode.py)")
+    parser.add_argument('--accum-steps', type=int, default=ACCUM_STEPS,
+                        help="Micro-batches per optimizer step (gradient accumulation)")
+    parser.add_argument('--perf-report', action='store_true',
+                        help="Compare images/sec, accuracy and severity MAE of --perf against fp32 eager")
+    args = parser.parse_args()
+    max_steps = args.max_steps or (MIN_ACCURACY_STEPS if args.perf_report else SCALING_STEPS)
+
+    benchmark = args.scaling or args.perf_report
+    train_args = (False if benchmark else args.heads_only, args.sev_weight, args.workers)
+    perf = PerfMode(args.perf, args.accum_steps)
+    if args.perf_report:
+        raise SystemExit(0 if perf_report(train, max_steps, args.accum_steps, args.threads,
+                                          args=train_args, num_workers=args.workers) else 1)
+    elif args.scaling:
+        scaling_report(train, args.scaling, max_steps, args.threads, args=train_args, extra_args=(perf,),
+                       num_workers=args.workers)
+    else:
+        # Heads-only training takes seconds, so it always runs in a single process (its loader has no workers)
+        launch(train, 1 if args.heads_only else args.nproc, args.threads, args=(*train_args, None, perf, 0, args.save),
+               num_workers=0 if args.heads_only else args.workers)